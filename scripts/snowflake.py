@@ -4,19 +4,6 @@ import os
 import sys
 from sfgen import *
 
-def ensure_python():
-    # pylab doesn't play well with pypy
-    # so this will cause us to re-exec if
-    # we are in pypy ... do not use if you want pypy
-    if sys.subversion[0] == "PyPy":
-        msg = "Restarting within CPython environment to accomdate scipy/numpy"
-        logging.warning(msg)
-        args = ["/usr/local/bin/python", "python"] + sys.argv
-        #os.execlp("/usr/bin/env", *args)
-        print args
-        os.execlp(*args)
-
-
 def get_cli():
     parser = argparse.ArgumentParser(description='Snowflake Generator.')
     parser.add_argument(dest="name", nargs='+', help="The name of the snowflake.")
@@ -26,12 +13,26 @@ def get_cli():
     parser.add_argument('-r', '--randomize', dest='randomize', action='store_true', help='randomize environment.')
     parser.add_argument('-x', '--extrude', dest='pipeline_3d', action='store_true', help='Enable 3d pipeline.')
     parser.add_argument('-l', '--laser', dest='pipeline_lasercutter', action='store_true', help='Enable Laser Cutter pipeline.')
+    parser.add_argument('-z', '--relief', dest='pipeline_relief', action='store_true', help='Enable crystal mass relief pipeline.')
     parser.add_argument('-M', '--max-steps', dest='max_steps', type=int, help='Maximum number of iterations.')
     parser.add_argument('-m', '--margin', dest='margin', type=float, help='When to stop snowflake growth (between 0 and 1)')
     parser.add_argument('-c', '--curves', dest='curves', action='store_true', help='run name as curves')
     parser.add_argument('-L', '--datalog', dest='datalog', action='store_true', help='Enable step wise data logging.')
+    parser.add_argument('--log-keyframes', dest='log_keyframes', type=int, help='Log the whole crystal every this many steps, and only the cells that changed between (datalog).')
+    parser.add_argument('--log-stride', dest='log_stride', type=int, help='Only log the diffusive mass every this many steps (datalog).')
+    parser.add_argument('--log-precision', dest='log_precision', type=float, help='Round the logged diffusive mass to a multiple of this (datalog).')
     parser.add_argument('-D', '--debug', dest='debug', action='store_true', help='Show every step.')
-    parser.add_argument('-V', '--movie', dest='movie', action='store_true', help='Render a movie.')
+    parser.add_argument('-N', '--numpy', dest='numpy', action='store_true', help='Grow with the numpy array engine.')
+    parser.add_argument('-S', '--symmetric', dest='symmetric', action='store_true', help='Grow a perfectly symmetric snowflake from one twelfth of the lattice.')
+    parser.add_argument('-A', '--halo', dest='halo', type=int, help='Only step cells within this many cells of the crystal, at least 30 (array engine).')
+    parser.add_argument('-j', '--workers', dest='workers', type=int, help='Grow with this many worker processes (array engine).')
+    parser.add_argument('-C', '--checkpoint', dest='checkpoint', type=int, help='Save a resumable checkpoint every this many steps.')
+    parser.add_argument('-R', '--resume', dest='resume', action='store_true', help='Resume growing from the last checkpoint.')
+    parser.add_argument('-V', '--movie', dest='movie', action='store_true', help='Render a movie from the cell log (datalog). Frames replay the diffusive mass, crystal mass and attached cells, but not the boundary mass.')
+    parser.add_argument('--movie-file', dest='movie_file', help='Movie to render, .mp4 or another ffmpeg format, or .png for an animated PNG (default: <name>.mp4).')
+    parser.add_argument('--movie-size', dest='movie_size', type=int, nargs=2, help='Width and height of the movie.')
+    parser.add_argument('--frame-stride', dest='frame_stride', type=int, help='Render every this many steps.')
+    parser.add_argument('--fps', dest='fps', type=float, help='Frames per second of the movie.')
     parser.add_argument('-W', '--width', dest='width', type=float, help="Width of target render.")
     parser.add_argument('-H', '--height', dest='height', type=float, help="Height of target render.")
 
@@ -46,15 +47,51 @@ def get_cli():
         args.name = args.name[:-1]
     if not os.path.exists(args.name):
         os.mkdir(args.name)
-    if args.pipeline_lasercutter:
-        ensure_python()
     if args.pipeline_3d:
         args.bw = True
-    if args.pipeline_3d or args.pipeline_lasercutter:
-        ensure_python()
     return args
 
+def get_batch_cli(argv):
+    parser = argparse.ArgumentParser(prog="snowflake.py batch", description='Grow a batch of snowflakes.')
+    parser.add_argument('-n', '--names', dest='names', help='File with one snowflake name per line.')
+    parser.add_argument('-g', '--grid', dest='grid', action='append', help='key=val1,val2,... grows a snowflake for every combination of values (repeatable).')
+    parser.add_argument('-p', '--prefix', dest='prefix', default='snowflake', help='Name prefix for grid snowflakes.')
+    parser.add_argument('-e', '--set', dest='settings', action='append', help='key=val setting for every snowflake in the batch (repeatable).')
+    parser.add_argument('-s', '--size', dest='size', type=int, help="The size of the snowflakes.")
+    parser.add_argument('-M', '--max-steps', dest='max_steps', type=int, help='Maximum number of iterations.')
+    parser.add_argument('-c', '--curves', dest='curves', action='store_true', help='run names as curves')
+    parser.add_argument('-C', '--checkpoint', dest='checkpoint', type=int, help='Save a resumable checkpoint every this many steps.')
+    parser.add_argument('-P', '--processes', dest='processes', type=int, help='Number of snowflakes to grow at once (default: one per cpu).')
+    parser.add_argument('-f', '--manifest', dest='manifest', default='batch.manifest', help='Where to record the batch.')
+    args = parser.parse_args(argv)
+    # the flags are shorthand for settings
+    args.settings = args.settings or []
+    for key in ("size", "max_steps", "checkpoint"):
+        if getattr(args, key) != None:
+            args.settings.append("%s=%s" % (key, getattr(args, key)))
+    if args.curves:
+        args.settings.append("curves=true")
+    return args
+
+def get_sweep_cli(argv):
+    parser = argparse.ArgumentParser(prog="snowflake.py sweep", description='Sweep a grid of environment values.')
+    parser.add_argument(dest="name", help="The name of the sweep, and the directory it is grown in.")
+    parser.add_argument('-g', '--grid', dest='grid', action='append', required=True, help='key=val1,val2,... sweeps an environment key over these values (repeatable).')
+    parser.add_argument('-B', '--branch-step', dest='branch_step', type=int, default=0, help='Step the swept values take effect at; the steps before are grown once and shared.')
+    parser.add_argument('-E', '--early', dest='early', action='append', help='Swept key that takes effect from the start, like gamma (repeatable).')
+    parser.add_argument('-s', '--size', dest='size', type=int, default=300, help="The size of the snowflakes.")
+    parser.add_argument('-M', '--max-steps', dest='max_steps', type=int, default=SNOWFLAKE_DEFAULTS["max_steps"], help='Maximum number of iterations.')
+    parser.add_argument('-m', '--margin', dest='margin', type=float, default=SNOWFLAKE_DEFAULTS["margin"], help='When to stop snowflake growth (between 0 and 1)')
+    parser.add_argument('-P', '--processes', dest='processes', type=int, help='Number of snowflakes to grow at once (default: one per cpu).')
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["batch"]:
+        run_batch(get_batch_cli(sys.argv[2:]))
+        sys.exit(0)
+    if sys.argv[1:2] == ["sweep"]:
+        run_sweep(get_sweep_cli(sys.argv[2:]))
+        sys.exit(0)
     args = get_cli()
     os.chdir(args.name)
     try:
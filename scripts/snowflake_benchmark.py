@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import argparse
+import multiprocessing
+import random
+import time
+from sfgen import *
+
+# reports the wall clock scaling of ParallelLattice against the core count
+
+def time_steps(lattice, steps):
+    start = time.time()
+    for step in range(steps):
+        lattice.step()
+    return time.time() - start
+
+def benchmark(args):
+    random.seed(args.seed)
+    serial = ArrayLattice(args.size, margin=1, hashed_noise=True)
+    base = time_steps(serial, args.steps)
+    print "%d x %d lattice, %d steps" % (args.size, args.size, args.steps)
+    print "%-10s %10s %10s %10s" % ("workers", "seconds", "speedup", "match")
+    print "%-10s %10.2f %10.2f %10s" % ("serial", base, 1.0, "-")
+    for workers in args.workers:
+        random.seed(args.seed)
+        lattice = ParallelLattice(args.size, workers=workers, margin=1)
+        try:
+            elapsed = time_steps(lattice, args.steps)
+        finally:
+            lattice.close()
+        match = (lattice.crystal_mass == serial.crystal_mass).all()
+        print "%-10d %10.2f %10.2f %10s" % (workers, elapsed, base / elapsed, match)
+
+def get_cli():
+    cores = multiprocessing.cpu_count()
+    workers = sorted(set([1, 2, 4, 8, cores]))
+    parser = argparse.ArgumentParser(description='Snowflake parallel engine benchmark.')
+    parser.add_argument('-s', '--size', dest="size", type=int, default=1000, help="The size of the lattice.")
+    parser.add_argument('-n', '--steps', dest="steps", type=int, default=100, help="Number of steps to time.")
+    parser.add_argument('-j', '--workers', dest="workers", type=int, nargs='+', default=[w for w in workers if w <= cores], help="Worker counts to time.")
+    parser.add_argument('--seed', dest="seed", default="benchmark", help="Random seed.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    benchmark(get_cli())
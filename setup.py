@@ -16,6 +16,17 @@ snowflake = {
                     "sfgen.splines", 
                     "sfgen.engine", 
                     "sfgen.graphics", 
+                    "sfgen.checkpoint", 
+                    "sfgen.celllog", 
+                    "sfgen.arrays", 
+                    "sfgen.parallel", 
+                    "sfgen.ensemble", 
+                    "sfgen.stream", 
+                    "sfgen.batch", 
+                    "sfgen.sweep", 
+                    "sfgen.jobqueue", 
+                    "sfgen.vector", 
+                    "sfgen.mesh", 
                 ],
     "install_requires": [
         "pillow",
@@ -23,6 +34,7 @@ snowflake = {
     "package_data": {"sfgen": ["etc/*.ini"]},
     "scripts":[
                 "scripts/snowflake.py",
+                "scripts/snowflake_benchmark.py",
                ],
     "version": "0.3",
 }
@@ -20,3 +20,14 @@ def log_output(name):
 from curves import *
 from graphics import *
 from engine import *
+from checkpoint import *
+from celllog import *
+from arrays import *
+from parallel import *
+from ensemble import *
+from stream import *
+from batch import *
+from sweep import *
+from jobqueue import *
+from vector import *
+from mesh import *
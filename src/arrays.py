@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+
+import random
+import math
+
+NUMPY_ENABLED = True
+try:
+    import numpy as np
+except ImportError:
+    NUMPY_ENABLED = False
+
+# local
+from sfgen import *
+
+class ArrayLattice(CrystalLattice):
+    """
+    A drop-in replacement for CrystalLattice that keeps every cell field in a
+    flat numpy array instead of a SnowflakeCell object.  Each step runs the
+    same diffusion, freezing, attachment, melting and noise rules as the cell
+    model, only as whole-array operations over the hex neighborhood, and for
+    a given random seed it grows the same snowflake.
+
+    Every field array carries one trailing "ghost" cell.  Missing neighbors
+    at the edge of the lattice point at the ghost, which is never stepped,
+    is never attached and holds no mass.
+
+    With a halo, only the cells within halo cells of the crystal boundary are
+    stepped.  Everything beyond that reach is a far field that holds one
+    uniform diffusive mass, which is only adjusted by the mass diffusing in
+    and out of the active region, so the lattice totals stay exact.  The far
+    field gets no noise, and the reach grows as the crystal does.  A halo
+    under MinHalo cells lets the far field reach the crystal and change how
+    it grows, so it isn't allowed.
+
+    With hashed_noise, the noise comes from a hash of each cell and the
+    iteration rather than from the random stream, so the snowflake no longer
+    matches the cell model, but it no longer depends on the stepping order.
+    """
+    # same order as CrystalLattice.get_neighbors(), as (dx, dy)
+    NeighborOffsets = [(0, 1), (0, -1), (-1, 0), (1, 0), (-1, -1), (1, 1)]
+    MinHalo = 30
+
+    def __init__(self, size, environment=None, celltype=None, max_steps=0, margin=None, curves=None, datalog=False, debug=False, halo=None, hashed_noise=False):
+        assert NUMPY_ENABLED, "the array engine requires numpy."
+        assert halo == None or halo >= self.MinHalo, "a halo of %d cells is too small, it needs at least %d." % (halo, self.MinHalo)
+        self.halo = halo
+        self.noise_seed = None
+        if hashed_noise:
+            self.noise_seed = random.getrandbits(63)
+        super(ArrayLattice, self).__init__(size, environment=environment, celltype=celltype, max_steps=max_steps, margin=margin, curves=curves, datalog=datalog, debug=debug)
+
+    def _init_cells(self):
+        self._init_topology()
+        n = self.ncells
+        self.far_field = self.environment.gamma
+        self.diffusive_mass = np.empty(n + 1, dtype=np.float64)
+        self.diffusive_mass[:n] = self.environment.gamma
+        self.diffusive_mass[n] = 0.0
+        self.boundary_mass = np.zeros(n + 1, dtype=np.float64)
+        self.crystal_mass = np.zeros(n + 1, dtype=np.float64)
+        self.attached = np.zeros(n + 1, dtype=bool)
+        self.boundary = np.zeros(n + 1, dtype=bool)
+        self.age = np.zeros(n + 1, dtype=np.int64)
+        self.attached_count = np.zeros(n + 1, dtype=np.int8)
+        self.reach = -1
+        self.crystal_reach = 0
+        center_pt = self.index[self._cell_index((self.size / 2, self.size / 2))]
+        self.attach(np.array([center_pt]), 1)
+        self.update_reach()
+
+    def _init_topology(self):
+        """
+        Set up the stored cells and their neighbor table:
+
+            points      lattice index of each stored cell
+            index       stored cell of each lattice index, or the ghost
+            neighbors   stored cell of each neighbor, or the ghost
+            divisor     one plus the number of real neighbors
+            weight      number of lattice cells each stored cell stands for
+            distance    hex distance of each stored cell from the center
+        """
+        n = self.ncells = self.size * self.size
+        self.points = np.arange(n)
+        self.index = np.arange(n)
+        self.far_cells = 0
+        (ys, xs) = np.divmod(self.points, self.size)
+        self.neighbors = np.empty((len(self.NeighborOffsets), n), dtype=np.intp)
+        for (k, (dx, dy)) in enumerate(self.NeighborOffsets):
+            nx = xs + dx
+            ny = ys + dy
+            ok = (nx >= 0) & (nx < self.size) & (ny >= 0) & (ny < self.size)
+            self.neighbors[k] = np.where(ok, ny * self.size + nx, n)
+        self._init_metrics()
+
+    def _init_metrics(self):
+        n = self.ncells
+        # SnowflakeCell.diffusion_calc() averages over itself and its neighbors
+        self.divisor = (self.neighbors < n).sum(axis=0) + 1.0
+        self.weight = np.bincount(self.index[self.index < n], minlength=n + 1).astype(np.float64)
+        center = self.size / 2
+        (ys, xs) = np.divmod(self.points, self.size)
+        self.distance = np.append(self.hex_distance(xs - center, ys - center), self.size)
+
+    @staticmethod
+    def hex_distance(u, v):
+        return np.maximum(np.maximum(abs(u), abs(v)), abs(u - v))
+
+    def update_reach(self):
+        """
+        Grow the active region to cover the crystal, its boundary and the
+        halo.  Cells joining the region start out with the far field mass.
+        """
+        n = self.ncells
+        reach = self.distance[:n].max()
+        if self.halo != None:
+            reach = min(reach, self.crystal_reach + 1 + self.halo)
+        if reach <= self.reach:
+            return
+        joining = (self.distance[:n] > self.reach) & (self.distance[:n] <= reach)
+        self.diffusive_mass[:n][joining] = self.far_field
+        self.age[:n][joining] = self.iteration - 1
+        self._set_reach(reach)
+
+    def _set_reach(self, reach):
+        n = self.ncells
+        self.reach = reach
+        inside = self.distance[:n] <= reach
+        self.active = np.flatnonzero(inside)
+        self.rim = np.flatnonzero(self.distance[:n] == reach + 1)
+        self.active_weight = np.append(np.where(inside, self.weight[:n], 0.0), 0.0)
+        self.far_weight = self.far_cells + self.weight[:n][~inside].sum()
+
+    def diffusive_field(self):
+        """
+        The diffusive mass of every stored cell, with the far field filled in.
+        """
+        return np.where(self.distance <= self.reach, self.diffusive_mass, self.far_field)
+
+    def total_diffusive_mass(self):
+        return (self.diffusive_mass * self.active_weight).sum() + self.far_weight * self.far_field
+
+    def expand(self, values, fill=0):
+        """
+        Map a stored cell field back onto the whole size x size lattice,
+        filling lattice cells that are not stored with fill.
+        """
+        values = np.array(values[:self.ncells + 1])
+        values[self.ncells] = fill
+        return values[self.index]
+
+    def total(self, values):
+        """
+        Sum a stored cell field over the whole lattice.
+        """
+        return (values * self.weight).sum()
+
+    def get_neighbors(self, xy):
+        idx = self.index[self._cell_index(xy)]
+        return tuple([nidx for nidx in self.neighbors[:, idx] if nidx < self.ncells])
+
+    def reality_check(self):
+        pass
+
+    def attach(self, cells, offset=0.0):
+        self.crystal_mass[cells] = self.boundary_mass[cells] + self.crystal_mass[cells] + offset
+        self.boundary_mass[cells] = 0
+        self.attached[cells] = True
+        if len(cells):
+            self.crystal_reach = max(self.crystal_reach, self.distance[cells].max())
+            self.update_frontier(cells)
+
+    def update_frontier(self, cells):
+        """
+        Recount the attached neighbors around newly attached cells, and mark
+        their unattached neighbors as boundary.
+        """
+        n = self.ncells
+        touched = np.unique(self.neighbors[:, cells])
+        touched = touched[touched < n]
+        self.attached_count[touched] = self.attached[self.neighbors[:, touched]].sum(axis=0)
+        self.boundary[touched[~self.attached[touched]]] = True
+
+    def rebuild_frontier(self):
+        """
+        Recount the attached neighbors of every cell in one pass, and set the
+        boundary to the unattached cells with an attached neighbor.  Attached
+        cells keep the boundary flag they attached with.
+        """
+        # the cells may have been reloaded without a step
+        self._crystal_layers = None
+        n = self.ncells
+        self.attached_count[:n] = self.attached[self.neighbors].sum(axis=0)
+        attached = self.attached[:n]
+        self.boundary[:n] = (attached & self.boundary[:n]) | (~attached & (self.attached_count[:n] > 0))
+
+    def adjust_humidity(self, val):
+        val = abs(val)
+        n = self.ncells
+        cells = ~(self.attached[:n] | self.boundary[:n])
+        self.diffusive_mass[:n][cells] += val * self.environment.sigma
+
+    def log_status(self):
+        if self.datalog == None:
+            return
+        row = []
+        row.append(self.total_diffusive_mass())
+        row.append(self.total(self.crystal_mass))
+        row.append(self.total(self.boundary_mass))
+        row.append(int(self.total(self.attached)))
+        row.append(int(self.total(self.boundary)))
+        row.append(self.snowflake_radius())
+        row.append(self.environment.beta)
+        row.append(self.environment.theta)
+        row.append(self.environment.alpha)
+        row.append(self.environment.kappa)
+        row.append(self.environment.mu)
+        row.append(self.environment.upsilon)
+        self.datalog.append(row)
+        # log the cells
+        dm = self.expand(self.diffusive_field(), self.far_field)
+        cm = self.expand(self.crystal_mass)
+        attached = self.expand(self.attached)
+        self.celllog.append((self.iteration, dm, cm, attached))
+        self.write_celllog()
+
+    def print_status(self):
+        dm = self.total_diffusive_mass()
+        cm = self.total(self.crystal_mass)
+        bm = self.total(self.boundary_mass)
+        acnt = int(self.total(self.attached))
+        bcnt = int(self.total(self.boundary))
+        d = self.snowflake_radius()
+        msg = "Step #%d/%dp (%.2f%% scl), %d/%d (%.2f%%), %.2f dM, %.2f bM, %.2f cM, tot %.2f M" % (self.iteration, d, (float(d * 2 * X_SCALE_FACTOR) / self.iteration) * 100, acnt, bcnt, (float(bcnt) / acnt) * 100, dm, bm, cm, dm + cm + bm)
+        log(msg)
+
+    def step(self):
+        self.log_status()
+        self.update_reach()
+        if len(self.rim):
+            # the rim is the edge of the far field the active region sees
+            self.diffusive_mass[self.rim] = self.far_field
+            diffused = self.step_cells(self.active)
+            self.far_field -= diffused / self.far_weight
+        else:
+            self.step_cells(self.active)
+        # run curves
+        self.iteration += 1
+        self.environment.step(self.iteration)
+
+    def step_cells(self, cells):
+        """
+        Advance the given (ascending) cell indices by one step.  This mirrors
+        the three passes of CrystalLattice.step() over SnowflakeCell.  Returns
+        the diffusive mass the cells gained by diffusion.
+        """
+        new_dm = self.diffusive_mass.copy()
+        (live, boundary, diffused) = self.step_one(cells, new_dm)
+        pending = self.step_two(live, boundary, new_dm)
+        attaching = self.step_three(pending, new_dm)
+        self.step_four(pending, new_dm)
+        self.diffusive_mass = new_dm
+        self.attach(attaching)
+        return diffused
+
+    def step_one(self, cells, new_dm):
+        """
+        Diffusion.  Writes the diffused mass of the unattached cells into
+        new_dm, and returns them along with their boundary flags and the mass
+        they gained.
+        """
+        dm = self.diffusive_mass
+        attached = self.attached
+        # only unattached cells take part, just like the cell model
+        live = cells[~attached[cells]]
+        nbrs = self.neighbors[:, live]
+        boundary = self.boundary[live]
+        # only the frontier has attached neighbors
+        own = dm[live]
+        next_dm = own.copy()
+        for k in range(len(nbrs)):
+            next_dm += dm[nbrs[k]]
+        f_nbrs = nbrs[:, boundary]
+        f_own = own[boundary]
+        f_next = f_own.copy()
+        for k in range(len(f_nbrs)):
+            f_next += np.where(attached[f_nbrs[k]], f_own, dm[f_nbrs[k]])
+        next_dm[boundary] = f_next
+        next_dm /= self.divisor[live]
+        self.age[live] += 1
+        new_dm[live] = next_dm
+        return (live, boundary, (self.weight[live] * (next_dm - own)).sum())
+
+    def step_two(self, live, boundary, new_dm):
+        """
+        Freezing and melting on the frontier.  Writes the melted mass into
+        new_dm and returns what step_three() needs to settle attachment.
+        """
+        env = self.environment
+        frontier = live[boundary]
+        acount = self.attached_count[frontier]
+        frozen = new_dm[frontier]
+        bm = self.boundary_mass[frontier] + (1 - env.kappa) * frozen
+        cm = self.crystal_mass[frontier] + (env.kappa * frozen)
+        flags = ((acount <= 2) & (bm > env.beta)) | (acount >= 4)
+        # melting happens after attachment is decided, but neighbors that
+        # were already visited by the cell model see their melted mass
+        new_dm[frontier] = 0.0 + (env.mu * bm + env.upsilon * cm)
+        return (live[~boundary], frontier, acount, bm, cm, flags)
+
+    def step_three(self, pending, new_dm):
+        """
+        Attachment.  Needs the melted mass of every neighbor in new_dm,
+        before any noise, and returns the cells that attach.
+        """
+        env = self.environment
+        (quiet, frontier, acount, bm, cm, flags) = pending
+        three = np.flatnonzero(acount == 3)
+        if len(three):
+            flags[three] = self._three_attached(frontier[three], bm[three], new_dm, self.diffusive_mass)
+        self.boundary_mass[frontier] = (1 - env.mu) * bm
+        self.crystal_mass[frontier] = (1 - env.upsilon) * cm
+        return frontier[flags]
+
+    def step_four(self, pending, new_dm):
+        """
+        Noise on the cells off the frontier.  It writes new_dm, so it only
+        runs once step_three() has read it for every cell.
+        """
+        self._noise(pending[0], new_dm)
+
+    def _three_attached(self, cells, bm, new_dm, old_dm):
+        # SnowflakeCell.attachment_step() runs in cell order, so neighbors
+        # with a lower index have finished step two and those with a higher
+        # index still hold their mass from the last step.
+        env = self.environment
+        nbrs = self.neighbors[:, cells]
+        summed = np.zeros(len(cells))
+        for k in range(len(nbrs)):
+            summed += np.where(nbrs[k] < cells, new_dm[nbrs[k]], old_dm[nbrs[k]])
+        return (bm >= 1) | ((summed < env.theta) & (bm >= env.alpha))
+
+    def _noise(self, cells, dm):
+        sigma = self.environment.sigma
+        if self.noise_seed == None:
+            # draw from the shared random stream in cell order, like noise_step()
+            coin = np.array([random.random() for idx in range(len(cells))]) >= .5
+        else:
+            coin = self.hashed_coins(cells)
+        dm[cells] = np.where(coin, (1 - sigma) * dm[cells], (1 + sigma) * dm[cells])
+
+    def hashed_coins(self, cells):
+        """
+        Flip one coin per cell from a splitmix64 hash of the noise seed, the
+        iteration and the lattice index of the cell, so the noise a cell gets
+        does not depend on the order cells are stepped in.
+        """
+        (m1, m2, m3) = (0x9E3779B97F4A7C15, np.uint64(0xBF58476D1CE4E5B9), np.uint64(0x94D049BB133111EB))
+        z = self.points[cells].astype(np.uint64)
+        z += np.uint64((self.noise_seed + self.iteration * m1) & 0xFFFFFFFFFFFFFFFF)
+        z *= np.uint64(m1)
+        z = (z ^ (z >> np.uint64(30))) * m2
+        z = (z ^ (z >> np.uint64(27))) * m3
+        z ^= z >> np.uint64(31)
+        return (z >> np.uint64(63)) == 1
+
+    def snowflake_radius(self, angle=135):
+        # we cast a ray on the 135 degeree axis
+        radius = 0
+        half = self.size / 2.0
+        while radius < half:
+            radius += 1
+            idx = self.index[self._cell_index(self.polar_to_xy((angle, radius)))]
+            if self.attached[idx] or self.boundary[idx]:
+                continue
+            return radius
+        # uhh
+        return int(round(half))
+
+    def lattice_header(self):
+        header = super(ArrayLattice, self).lattice_header()
+        for key in ("halo", "noise_seed", "far_field", "reach"):
+            header[key] = getattr(self, key)
+        return header
+
+    def cell_fields(self):
+        """
+        Every cell field as an array over the whole lattice.
+        """
+        age = np.where(self.distance <= self.reach, self.age, self.iteration - 1)
+        return {
+            "diffusive_mass": self.expand(self.diffusive_field(), self.far_field),
+            "boundary_mass": self.expand(self.boundary_mass),
+            "crystal_mass": self.expand(self.crystal_mass),
+            "attached": self.expand(self.attached),
+            "boundary": self.expand(self.boundary),
+            "age": self.expand(age, self.iteration - 1),
+        }
+
+    @classmethod
+    def from_fields(cls, header, fields):
+        obj = cls.__new__(cls)
+        for key in cls.HeaderKeys:
+            setattr(obj, key, header.get(key))
+        obj.datalog = header.get("datalog")
+        obj.celllog = None
+        if obj.datalog != None:
+            obj.celllog = []
+        obj.celllog_writer = None
+        obj.halo = header.get("halo")
+        obj.noise_seed = header.get("noise_seed")
+        obj.far_field = header.get("far_field", obj.environment.gamma)
+        obj._init_topology()
+        n = obj.ncells
+        for (key, dtype) in (("diffusive_mass", np.float64), ("boundary_mass", np.float64), ("crystal_mass", np.float64), ("attached", bool), ("boundary", bool), ("age", np.int64)):
+            values = np.zeros(n + 1, dtype=dtype)
+            field = np.asarray(fields[key])
+            if len(field) == n:
+                # every cell is stored, so copy straight from the field,
+                # which may be mapped from a checkpoint
+                values[:n] = field
+            else:
+                values[:n] = field[obj.points]
+            setattr(obj, key, values)
+        obj.attached_count = np.zeros(n + 1, dtype=np.int8)
+        obj.rebuild_frontier()
+        obj.crystal_reach = obj.distance[np.flatnonzero(obj.attached)].max()
+        obj._set_reach(header.get("reach", obj.distance[:n].max()))
+        return obj
+
+    def to_lattice(self):
+        """
+        Build a CrystalLattice of SnowflakeCell objects from the arrays.
+        """
+        return CrystalLattice.from_fields(self.lattice_header(), self.cell_fields())
+
+    @classmethod
+    def from_lattice(cls, lattice):
+        """
+        Build an ArrayLattice from a CrystalLattice of SnowflakeCell objects.
+        """
+        return cls.from_fields(lattice.lattice_header(), lattice.cell_fields())
+
+    def save_lattice(self, fn):
+        if fn.endswith(".pickle"):
+            self.to_lattice().save_lattice(fn)
+            return
+        super(ArrayLattice, self).save_lattice(fn)
+
+    @classmethod
+    def load_lattice(cls, fn):
+        if Checkpoint.is_checkpoint(fn):
+            return super(ArrayLattice, cls).load_lattice(fn)
+        return cls.from_lattice(CrystalLattice.load_lattice(fn))
+
+class SymmetricLattice(ArrayLattice):
+    """
+    An ArrayLattice that only grows one twelfth of the snowflake.  Apart from
+    the noise, the model is symmetric under the twelve rotations and
+    reflections of the hexagon (D6), so it is enough to step the fundamental
+    wedge between a lattice axis and the bisector of the next one, with
+    neighbors across the wedge edges reflected back inside.  The whole
+    lattice is only rebuilt, by symmetry, when an image, a pickle or a cell
+    log frame is needed.
+
+    The wedge is cut from the largest hexagon that fits in the lattice.
+    Lattice cells outside of that hexagon are never stepped and hold the
+    initial diffusive mass.  Since every wedge cell draws one noise sample
+    for all of its images, the snowflake comes out perfectly symmetric.
+    """
+
+    def _init_topology(self):
+        size = self.size
+        center = size / 2
+        radius = min(center, size - 1 - center)
+        (ys, xs) = np.divmod(np.arange(size * size), size)
+        (us, vs) = self.fold(xs - center, ys - center)
+        inside = self.hex_distance(xs - center, ys - center) <= radius
+        folded = (vs + center) * size + (us + center)
+        self.points = np.unique(folded[inside])
+        n = self.ncells = len(self.points)
+        self.index = np.empty(size * size, dtype=np.intp)
+        self.index[inside] = np.searchsorted(self.points, folded[inside])
+        self.index[~inside] = n
+        self.far_cells = int((~inside).sum())
+        (ys, xs) = np.divmod(self.points, size)
+        self.neighbors = np.empty((len(self.NeighborOffsets), n), dtype=np.intp)
+        for (k, (dx, dy)) in enumerate(self.NeighborOffsets):
+            nx = xs + dx
+            ny = ys + dy
+            ok = self.hex_distance(nx - center, ny - center) <= radius
+            self.neighbors[k] = np.where(ok, self.index[np.where(ok, ny * size + nx, 0)], n)
+        self._init_metrics()
+
+    @staticmethod
+    def fold(u, v):
+        """
+        Map hex offsets from the center into the fundamental wedge
+        0 <= 2v <= u, trying each of the twelve symmetries in turn.
+        """
+        u = np.array(u)
+        v = np.array(v)
+        (fu, fv) = (u.copy(), v.copy())
+        done = np.zeros(u.shape, dtype=bool)
+        for mirror in (False, True):
+            (ru, rv) = (v, u) if mirror else (u, v)
+            for turn in range(6):
+                hit = ~done & (rv >= 0) & (2 * rv <= ru)
+                fu[hit] = ru[hit]
+                fv[hit] = rv[hit]
+                done |= hit
+                # rotate by sixty degrees
+                (ru, rv) = (ru - rv, ru)
+        return (fu, fv)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+import os
+import time
+import logging
+import argparse
+import itertools
+import traceback
+import multiprocessing
+
+# local
+from sfgen import *
+
+def batch_name(name):
+    # the same clean up the snowflake command gives its name
+    return str.join('', map(str.lower, name.split()))
+
+def read_names(fn):
+    f = open(fn)
+    try:
+        return [batch_name(name) for name in f if name.strip()]
+    finally:
+        f.close()
+
+# settings without a default to take their type from
+SETTING_PARSERS = {
+    "halo": int,
+    "movie_file": str,
+    "movie_size": lambda val: tuple([int(size) for size in val.lower().split('x')]),
+}
+
+def parse_value(key, val):
+    """
+    Turn a command line value into the type of its snowflake default.
+    Movie sizes are given as WIDTHxHEIGHT.
+    """
+    assert key in SNOWFLAKE_DEFAULTS, "'%s' is not a snowflake setting." % key
+    if key in SETTING_PARSERS:
+        return SETTING_PARSERS[key](val)
+    default = SNOWFLAKE_DEFAULTS[key]
+    assert default != None, "'%s' has no parser." % key
+    if isinstance(default, bool):
+        return val.lower() in ("1", "true", "yes", "on")
+    if isinstance(default, int):
+        return int(val)
+    if isinstance(default, float):
+        return float(val)
+    return val
+
+def grid_jobs(grid, prefix="snowflake"):
+    """
+    One job for every combination of the values in grid, a dict of setting
+    to a list of values, named after the values it was given.
+    """
+    keys = sorted(grid)
+    jobs = []
+    for values in itertools.product(*[grid[key] for key in keys]):
+        job = dict(zip(keys, values))
+        tags = ["%s%s" % (key, val) for (key, val) in zip(keys, values)]
+        job["name"] = batch_name(str.join('_', [prefix] + tags))
+        jobs.append(job)
+    return jobs
+
+class BatchManifest(object):
+    """
+    A tab separated record of every job a batch started and finished, with
+    when it started, how long it took, and how it ended.  The manifest is
+    only ever appended to, one whole line per write, so the worker processes
+    can share it and a batch killed part way leaves a readable manifest.
+    """
+    Fields = ("name", "status", "started", "elapsed", "message")
+
+    def __init__(self, fn):
+        self.fn = fn
+        if not os.path.exists(fn):
+            self.write(dict(zip(self.Fields, self.Fields)))
+
+    def write(self, record):
+        line = [str(record.get(key, '')).replace('\t', ' ').replace('\n', ' ') for key in self.Fields]
+        line = str.join('\t', line) + '\n'
+        fd = os.open(self.fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def status(self):
+        """
+        The last status recorded for each job.
+        """
+        status = {}
+        f = open(self.fn)
+        try:
+            f.readline()
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == len(self.Fields):
+                    status[fields[0]] = fields[1]
+        finally:
+            f.close()
+        return status
+
+def grow_job(job, root, defaults=None):
+    """
+    Grow the snowflake of one job, a dict of snowflake settings over
+    defaults, in root/<name>, just as the snowflake command would.
+    """
+    args = dict(SNOWFLAKE_DEFAULTS)
+    args.update(defaults or {})
+    args.update(job)
+    args = argparse.Namespace(**args)
+    args.target_size = None
+    logger = logging.getLogger()
+    handlers = list(logger.handlers)
+    path = os.path.join(root, args.name)
+    try:
+        if not os.path.exists(path):
+            os.mkdir(path)
+        os.chdir(path)
+        run(args)
+    finally:
+        os.chdir(root)
+        # each job logs to a file of its own
+        for handler in logger.handlers[len(handlers):]:
+            logger.removeHandler(handler)
+            handler.close()
+
+def reset_job(job, root):
+    """
+    Get a job that was cut short ready to run again.  It resumes from its
+    checkpoint when it has one, and otherwise its half grown lattice, which
+    is no use, is thrown away so it starts over.
+    """
+    name = job["name"]
+    path = os.path.join(root, name)
+    job = dict(job)
+    if os.path.exists(os.path.join(path, "%s.checkpoint" % name)):
+        job["resume"] = True
+        return job
+    for ext in ("lattice", "png"):
+        fn = os.path.join(path, "%s.%s" % (name, ext))
+        if os.path.exists(fn):
+            os.remove(fn)
+    return job
+
+# the worker's copy of the batch settings
+_batch = {}
+
+def _init_worker(root, manifest, defaults):
+    _batch["root"] = root
+    _batch["manifest"] = BatchManifest(manifest)
+    _batch["defaults"] = defaults
+
+def _run_job(job):
+    manifest = _batch["manifest"]
+    record = {"name": job["name"], "status": "started", "started": time.strftime("%Y-%m-%d %H:%M:%S")}
+    manifest.write(record)
+    start = time.time()
+    try:
+        grow_job(job, _batch["root"], _batch["defaults"])
+        record["status"] = "done"
+    except Exception, err:
+        record["status"] = "failed"
+        record["message"] = repr(err)
+        log(traceback.format_exc())
+    record["elapsed"] = "%.1f" % (time.time() - start)
+    manifest.write(record)
+    return record
+
+class BatchRunner(object):
+    """
+    Grows a batch of snowflakes on a pool of worker processes, sized to
+    the machine by default.  Each job is a dict of snowflake settings over
+    defaults, and runs in a directory named after the job, just as the
+    snowflake command would run it.  The workers are forked once, so sfgen
+    is only imported once however many jobs there are.
+
+    Every job is logged in the manifest.  Jobs the manifest has finished,
+    and jobs that already have an image from an earlier run, are skipped,
+    so running the same batch again picks up where it left off.  A job
+    that was cut short resumes from its checkpoint when it has one, and
+    starts over when it doesn't.
+
+    Jobs grow one lattice each on the serial engines; the workers of a
+    pool can't start pools of their own.
+    """
+    def __init__(self, jobs, manifest="batch.manifest", workers=None, defaults=None):
+        self.jobs = jobs
+        self.manifest = os.path.abspath(manifest)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.defaults = dict(defaults or {})
+        settings = dict(self.defaults)
+        for job in jobs:
+            settings.update(job)
+        assert not settings.get("workers") and not settings.get("movie"), "batch jobs can't use worker processes or render movies."
+
+    def pending(self):
+        root = os.getcwd()
+        status = BatchManifest(self.manifest).status()
+        todo = []
+        for job in self.jobs:
+            name = job["name"]
+            path = os.path.join(root, name)
+            ifn = os.path.join(path, "%s.png" % name)
+            if status.get(name) == "done":
+                continue
+            if name not in status and os.path.exists(ifn):
+                msg = "Skipping %s, it already exists" % name
+                log(msg)
+                continue
+            if name in status:
+                job = reset_job(job, root)
+            todo.append(job)
+        return todo
+
+    def run(self):
+        root = os.getcwd()
+        todo = self.pending()
+        msg = "Running %d of %d jobs on %d workers" % (len(todo), len(self.jobs), self.workers)
+        log(msg)
+        if not todo:
+            return []
+        results = []
+        pool = multiprocessing.Pool(self.workers, _init_worker, (root, self.manifest, self.defaults))
+        try:
+            for record in pool.imap_unordered(_run_job, todo):
+                results.append(record)
+                msg = "%s %s in %ss (%d of %d)" % (record["name"], record["status"], record["elapsed"], len(results), len(todo))
+                log(msg)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return results
+
+def run_batch(args):
+    jobs = []
+    defaults = {}
+    for keyval in args.settings or []:
+        (key, val) = keyval.split('=', 1)
+        defaults[key] = parse_value(key, val)
+    if args.names:
+        jobs.extend([{"name": name} for name in read_names(args.names)])
+    if args.grid:
+        grid = {}
+        for keyval in args.grid:
+            (key, vals) = keyval.split('=', 1)
+            grid[key] = [parse_value(key, val) for val in vals.split(',')]
+        jobs.extend(grid_jobs(grid, args.prefix))
+    assert jobs, "a batch needs a list of names or a parameter grid."
+    runner = BatchRunner(jobs, manifest=args.manifest, workers=args.processes, defaults=defaults)
+    return runner.run()
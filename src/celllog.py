@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import zlib
+import array
+import struct
+import bisect
+
+NUMPY_ENABLED = True
+try:
+    import numpy as np
+except ImportError:
+    NUMPY_ENABLED = False
+
+# local
+from sfgen import *
+
+class CellLog(object):
+    """
+    An append-only replay of the diffusive and crystal mass of every cell,
+    and of which cells are attached, one frame per step.  Masses are stored
+    as float64, and the attached cells as a list of indices, with their bytes
+    shuffled into planes, most significant byte last, and compressed with
+    zlib, which packs the far field, the mostly empty crystal and the slowly
+    varying exponents down to a fraction of their size.
+
+    The frames live in <name>.replay, and <name>.index holds a fixed size
+    record of (step, offset, dm length, cm length, attached length, flags)
+    for each, so any frame is one seek and one read away.  A frame is only in the
+    log once its index record is, so a run killed mid-write leaves a
+    readable log behind, and appending a step at or before the last one
+    logged drops everything from that step on, which is what a resumed run
+    wants.
+
+    By default every frame is logged in full.  With keyframes, only every
+    keyframes'th frame keeps the whole crystal mass and every attached
+    cell, and the frames between only keep the (index, value) pairs of the
+    cells whose crystal mass changed and the cells that attached, which is
+    still exact.  With stride, the diffusive mass is only logged every
+    stride frames and the frames between replay the last one, and with
+    precision it is rounded to a multiple of precision.  A frame whose mass
+    is too large for its multiples to fit in 32 bits is logged in full
+    instead, and flagged DMFull in its record.  The boundary mass is never
+    logged.
+    """
+    Magic = "SFCL"
+    Version = 3
+    Header = struct.Struct("<4sII")
+    Options = struct.Struct("<IId")
+    Record = struct.Struct("<iQIIIB")
+    # record flags
+    DMFull = 1
+    # logs before version 3 don't keep the attached cells or flags
+    OldRecord = struct.Struct("<iQII")
+    Widths = {"<f8": 8, "<i4": 4}
+    TypeCodes = {"<f8": 'd', "<i4": 'i'}
+    Level = 6
+
+    def __init__(self, name="cell_log", mode='r', ncells=None, keyframes=1, stride=1, precision=0.0):
+        self.name = name
+        self.mode = mode
+        self.datafn = "%s.replay" % name
+        self.indexfn = "%s.index" % name
+        self.ncells = ncells
+        self.keyframes = keyframes or 1
+        self.stride = stride or 1
+        self.precision = precision or 0.0
+        assert self.precision >= 0, "the log precision can't be negative."
+        if self.keyframes > 1 or self.precision:
+            assert NUMPY_ENABLED, "sparse cell logging requires numpy."
+        self.version = self.Version
+        self.steps = []
+        self.records = []
+        # the last crystal mass and attached cells read or written, as
+        # (frame index, cm, attached)
+        self.current = None
+        self.overflowed = False
+        if os.path.exists(self.indexfn):
+            self._read_index()
+        else:
+            assert mode != 'r', "%s does not exist." % self.indexfn
+        if mode == 'r':
+            self.data = open(self.datafn, 'rb')
+            self.index = None
+            return
+        if not os.path.exists(self.indexfn):
+            self.data = open(self.datafn, 'wb')
+            self.index = open(self.indexfn, 'wb')
+            self._write_header()
+            return
+        self.data = open(self.datafn, 'r+b')
+        self.index = open(self.indexfn, 'r+b')
+        # forget any frame that was written without its index record
+        self._truncate(len(self.records))
+
+    @property
+    def header_size(self):
+        return self.Header.size + self.Options.size
+
+    def _write_header(self):
+        self.index.seek(0)
+        self.index.write(self.Header.pack(self.Magic, self.Version, self.ncells or 0))
+        self.index.write(self.Options.pack(self.keyframes, self.stride, self.precision))
+        self.index.seek(0, os.SEEK_END)
+        self.index.flush()
+
+    def _read_index(self):
+        f = open(self.indexfn, 'rb')
+        try:
+            (magic, version, ncells) = self.Header.unpack(f.read(self.Header.size))
+            assert magic == self.Magic, "%s is not a cell log index." % self.indexfn
+            assert version <= self.Version, "%s is cell log version %d, expected %d or earlier." % (self.indexfn, version, self.Version)
+            assert version == self.Version or self.mode == 'r', "%s is cell log version %d, it can only be read." % (self.indexfn, version)
+            if ncells:
+                self.ncells = ncells
+            # the log keeps the options it was started with
+            (self.keyframes, self.stride, self.precision) = (1, 1, 0.0)
+            if version > 1:
+                (self.keyframes, self.stride, self.precision) = self.Options.unpack(f.read(self.Options.size))
+            self.version = version
+            recordtype = self.Record
+            if version < 3:
+                recordtype = self.OldRecord
+            while True:
+                record = f.read(recordtype.size)
+                if len(record) < recordtype.size:
+                    break
+                record = recordtype.unpack(record)
+                if version < 3:
+                    record += (0, 0)
+                self.records.append(record)
+                self.steps.append(record[0])
+        finally:
+            f.close()
+
+    def _truncate(self, count):
+        del self.records[count:]
+        del self.steps[count:]
+        self.current = None
+        end = 0
+        if self.records:
+            (step, offset, dmlen, cmlen, attlen, flags) = self.records[-1]
+            end = offset + dmlen + cmlen + attlen
+        self.data.truncate(end)
+        self.data.seek(end)
+        self.index.truncate(self.header_size + count * self.Record.size)
+        self.index.seek(0, os.SEEK_END)
+
+    def truncate(self, step):
+        """
+        Drop every frame from step on.
+        """
+        self._truncate(bisect.bisect_left(self.steps, step))
+
+    @staticmethod
+    def _shuffle(raw, width=8):
+        return str.join('', [raw[plane::width] for plane in range(width)])
+
+    @staticmethod
+    def _unshuffle(raw, width=8):
+        count = len(raw) / width
+        values = bytearray(len(raw))
+        for plane in range(width):
+            values[plane::width] = raw[plane * count:(plane + 1) * count]
+        return str(values)
+
+    def _pack(self, values, dtype="<f8"):
+        if NUMPY_ENABLED:
+            raw = np.asarray(values).astype(dtype).tostring()
+        else:
+            values = array.array(self.TypeCodes[dtype], values)
+            if sys.byteorder != "little":
+                values.byteswap()
+            raw = values.tostring()
+        width = self.Widths[dtype]
+        return zlib.compress(self._shuffle(raw, width), self.Level)
+
+    def _unpack(self, blob, dtype="<f8"):
+        width = self.Widths[dtype]
+        raw = self._unshuffle(zlib.decompress(blob), width)
+        if NUMPY_ENABLED:
+            return np.fromstring(raw, dtype=dtype)
+        values = array.array(self.TypeCodes[dtype])
+        values.fromstring(raw)
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values.tolist()
+
+    def _pack_dm(self, dm):
+        """
+        The diffusive mass as a blob, and the record flags it needs.
+        """
+        if not self.precision:
+            return (self._pack(dm), 0)
+        steps = np.round(np.asarray(dm) / self.precision)
+        # the rounded mass is stored in 32 bits, so a precision too fine
+        # for the mass would wrap around, and the frame is kept in full
+        limit = np.iinfo(np.int32).max
+        if not (np.isfinite(steps).all() and np.abs(steps).max() <= limit):
+            if not self.overflowed:
+                msg = "The diffusive mass doesn't fit a log precision of %g, logging it in full." % self.precision
+                log(msg)
+                self.overflowed = True
+            return (self._pack(dm), self.DMFull)
+        return (self._pack(steps, "<i4"), 0)
+
+    def _unpack_dm(self, blob, flags=0):
+        if not self.precision or flags & self.DMFull:
+            return self._unpack(blob)
+        return self._unpack(blob, "<i4") * self.precision
+
+    def _pack_cm(self, idx, cm):
+        if idx % self.keyframes == 0:
+            return self._pack(cm)
+        # only the cells that changed since the last frame
+        (last, previous, attached) = self.current
+        assert last == idx - 1
+        cells = np.flatnonzero(cm != previous)
+        return self._pack(cells, "<i4") + self._pack(cm[cells])
+
+    def _pack_attached(self, idx, attached):
+        if idx % self.keyframes == 0:
+            if NUMPY_ENABLED:
+                return self._pack(np.flatnonzero(attached), "<i4")
+            return self._pack([cell for (cell, flag) in enumerate(attached) if flag], "<i4")
+        # only the cells that attached, or came loose, since the last frame
+        previous = self.current[2]
+        return self._pack(np.flatnonzero(attached != previous), "<i4")
+
+    def append(self, step, dm, cm, attached):
+        assert self.mode != 'r', "%s is open for reading." % self.datafn
+        if self.steps and step <= self.steps[-1]:
+            self.truncate(step)
+        if not self.ncells:
+            self.ncells = len(dm)
+            self._write_header()
+        idx = len(self.records)
+        if self.keyframes > 1:
+            cm = np.array(cm, dtype=np.float64)
+            attached = np.array(attached, dtype=bool)
+            if idx % self.keyframes and (self.current == None or self.current[0] != idx - 1):
+                self.current = (idx - 1, self.get_cm(idx - 1), self.get_attached(idx - 1))
+        cmblob = self._pack_cm(idx, cm)
+        attblob = self._pack_attached(idx, attached)
+        dmblob = ''
+        flags = 0
+        if idx % self.stride == 0:
+            (dmblob, flags) = self._pack_dm(dm)
+        self.data.seek(0, os.SEEK_END)
+        offset = self.data.tell()
+        self.data.write(dmblob)
+        self.data.write(cmblob)
+        self.data.write(attblob)
+        self.data.flush()
+        record = (step, offset, len(dmblob), len(cmblob), len(attblob), flags)
+        self.index.write(self.Record.pack(*record))
+        self.index.flush()
+        self.records.append(record)
+        self.steps.append(step)
+        if self.keyframes > 1:
+            self.current = (idx, cm, attached)
+
+    def close(self):
+        self.data.close()
+        if self.index != None:
+            self.index.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    def _read(self, idx):
+        (step, offset, dmlen, cmlen, attlen, flags) = self.records[idx]
+        self.data.seek(offset)
+        return (self.data.read(dmlen), self.data.read(cmlen), self.data.read(attlen))
+
+    def get_dm(self, idx):
+        idx -= idx % self.stride
+        (dmblob, cmblob, attblob) = self._read(idx)
+        return self._unpack_dm(dmblob, self.records[idx][5])
+
+    def _unpack_attached(self, blob):
+        cells = self._unpack(blob, "<i4")
+        if not NUMPY_ENABLED:
+            attached = [False] * self.ncells
+            for cell in cells:
+                attached[cell] = True
+            return attached
+        attached = np.zeros(self.ncells, dtype=bool)
+        attached[cells] = True
+        return attached
+
+    def _replay(self, idx):
+        # replay the changes since the last keyframe, or since the last frame read
+        start = idx - idx % self.keyframes
+        if self.current != None and start <= self.current[0] <= idx:
+            (start, cm, attached) = self.current
+            cm = cm.copy()
+            if attached is not None:
+                attached = attached.copy()
+        else:
+            (dmblob, cmblob, attblob) = self._read(start)
+            cm = self._unpack(cmblob)
+            attached = None
+            if self.version > 2:
+                attached = self._unpack_attached(attblob)
+        for frame in range(start + 1, idx + 1):
+            (dmblob, cmblob, attblob) = self._read(frame)
+            # the cell indices are zlib streams of their own, ahead of the values
+            stream = zlib.decompressobj()
+            cells = self._unshuffle(stream.decompress(cmblob), 4)
+            cells = np.fromstring(cells, dtype="<i4")
+            cm[cells] = self._unpack(stream.unused_data)
+            if attached is not None:
+                flipped = self._unpack(attblob, "<i4")
+                attached[flipped] = ~attached[flipped]
+        self.current = (idx, cm, attached)
+
+    def get_cm(self, idx):
+        if self.keyframes == 1:
+            (dmblob, cmblob, attblob) = self._read(idx)
+            return self._unpack(cmblob)
+        self._replay(idx)
+        return self.current[1].copy()
+
+    def get_attached(self, idx):
+        """
+        Which cells are attached in the idx'th frame, or None for a log from
+        before the attached cells were kept.
+        """
+        if self.version < 3:
+            return None
+        if self.keyframes == 1:
+            (dmblob, cmblob, attblob) = self._read(idx)
+            return self._unpack_attached(attblob)
+        if self.current == None or self.current[0] != idx:
+            self._replay(idx)
+        return self.current[2].copy()
+
+    def __getitem__(self, idx):
+        """
+        The idx'th frame, as (step, dm, cm, attached).
+        """
+        if idx < 0:
+            idx += len(self.records)
+        if not 0 <= idx < len(self.records):
+            raise IndexError(idx)
+        return (self.records[idx][0], self.get_dm(idx), self.get_cm(idx), self.get_attached(idx))
+
+    def find(self, step):
+        """
+        The index of the frame logged at step.
+        """
+        idx = bisect.bisect_left(self.steps, step)
+        if idx == len(self.steps) or self.steps[idx] != step:
+            raise IndexError(step)
+        return idx
+
+class ReplayFrame(CrystalLattice):
+    """
+    One frame of a cell log as a read-only lattice, enough to render it or
+    to crop around the crystal.  The log keeps the diffusive and crystal
+    mass and the attached cells, so the boundary is the unattached cells
+    next to one, there is no boundary mass and every age is zero.  Logs from
+    before the attached cells were kept count a cell as attached when it
+    holds crystal mass, which takes in the frozen mass of the boundary too.
+    """
+    # same order as CrystalLattice.get_neighbors(), as (dx, dy)
+    NeighborOffsets = [(0, 1), (0, -1), (-1, 0), (1, 0), (-1, -1), (1, 1)]
+
+    def __init__(self, size, step, dm, cm, attached=None):
+        assert NUMPY_ENABLED, "replay frames require numpy."
+        self.size = size
+        self.iteration = step
+        self.datalog = None
+        self.celllog = None
+        dm = np.asarray(dm, dtype=np.float64)
+        cm = np.asarray(cm, dtype=np.float64)
+        if attached is None:
+            attached = cm != 0
+        attached = np.asarray(attached, dtype=bool).reshape(size, size)
+        # attached[y, x], padded by one cell all around
+        padded = np.zeros((size + 2, size + 2), dtype=bool)
+        padded[1:-1, 1:-1] = attached
+        touching = np.zeros((size, size), dtype=bool)
+        for (dx, dy) in self.NeighborOffsets:
+            touching |= padded[1 + dy:size + 1 + dy, 1 + dx:size + 1 + dx]
+        boundary = ~attached & touching
+        self.fields = {
+            "diffusive_mass": dm,
+            "boundary_mass": np.zeros(size * size),
+            "crystal_mass": cm,
+            "attached": attached.ravel(),
+            "boundary": boundary.ravel(),
+            "age": np.zeros(size * size, dtype=int),
+        }
+        for values in self.fields.values():
+            values.flags.writeable = False
+
+    def cell_fields(self):
+        return dict(self.fields)
+
+    def snowflake_radius(self, angle=135):
+        # we cast a ray on the 135 degeree axis
+        radius = 0
+        half = self.size / 2.0
+        edge = self.fields["attached"] | self.fields["boundary"]
+        while radius < half:
+            radius += 1
+            if edge[self._cell_index(self.polar_to_xy((angle, radius)))]:
+                continue
+            return radius
+        # uhh
+        return int(round(half))
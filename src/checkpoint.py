@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+import sys
+import random
+import struct
+import array
+import cPickle as pickle
+
+NUMPY_ENABLED = True
+try:
+    import numpy as np
+except ImportError:
+    NUMPY_ENABLED = False
+
+# local
+from sfgen import *
+
+class Checkpoint(object):
+    """
+    A lattice saved as one small pickled header followed by every cell field
+    as a raw little-endian array, in lattice index order.  Loading it never
+    builds a cell object it doesn't need to, and with numpy the fields can be
+    memory-mapped straight from the file.
+
+    The file layout is the magic, a (version, header length) struct, the
+    pickled header, and then each field padded out to an 8-byte boundary.
+    The header lists the fields as (name, typecode, count).
+    """
+    Magic = "SFCK"
+    Version = 1
+    Struct = struct.Struct("<II")
+    Alignment = 8
+    # array typecode for each cell field, and the numpy dtype it is stored as
+    FieldTypes = {
+        "diffusive_mass": "d",
+        "boundary_mass": "d",
+        "crystal_mass": "d",
+        "attached": "B",
+        "boundary": "B",
+        "age": "i",
+    }
+    DTypes = {"d": "<f8", "B": "u1", "i": "<i4"}
+
+    def __init__(self, header, fields):
+        self.header = header
+        self.fields = fields
+
+    @classmethod
+    def from_lattice(cls, lattice):
+        header = lattice.lattice_header()
+        header["latticetype"] = lattice.__class__
+        return cls(header, lattice.cell_fields())
+
+    def to_lattice(self, latticetype=None):
+        """
+        Rebuild the lattice, by default as the type of lattice that saved it.
+        """
+        if latticetype == None:
+            latticetype = self.header.get("latticetype", CrystalLattice)
+        return latticetype.from_fields(self.header, self.fields)
+
+    @classmethod
+    def is_checkpoint(cls, fn):
+        f = open(fn, 'rb')
+        try:
+            return f.read(len(cls.Magic)) == cls.Magic
+        finally:
+            f.close()
+
+    @classmethod
+    def _pad(cls, offset):
+        return -offset % cls.Alignment
+
+    def _pack(self, key, values):
+        typecode = self.FieldTypes[key]
+        if NUMPY_ENABLED:
+            return np.asarray(values).astype(self.DTypes[typecode]).tostring()
+        values = array.array(typecode, [int(val) if typecode != "d" else val for val in values])
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values.tostring()
+
+    def save(self, fn):
+        keys = sorted(self.fields)
+        blobs = [self._pack(key, self.fields[key]) for key in keys]
+        header = dict(self.header)
+        header["fields"] = [(key, self.FieldTypes[key], len(self.fields[key])) for key in keys]
+        header = pickle.dumps(header, protocol=-1)
+        f = open(fn, 'wb')
+        try:
+            f.write(self.Magic)
+            f.write(self.Struct.pack(self.Version, len(header)))
+            f.write(header)
+            offset = len(self.Magic) + self.Struct.size + len(header)
+            for blob in blobs:
+                pad = self._pad(offset)
+                f.write("\0" * pad)
+                f.write(blob)
+                offset += pad + len(blob)
+        finally:
+            f.close()
+
+    @classmethod
+    def load(cls, fn, mmap=False):
+        """
+        Read a checkpoint.  With mmap, and numpy, the cell fields are left
+        in the file as read-only memory maps.
+        """
+        f = open(fn, 'rb')
+        try:
+            magic = f.read(len(cls.Magic))
+            assert magic == cls.Magic, "%s is not a lattice checkpoint." % fn
+            (version, length) = cls.Struct.unpack(f.read(cls.Struct.size))
+            assert version <= cls.Version, "%s is checkpoint version %d, expected %d or earlier." % (fn, version, cls.Version)
+            header = pickle.loads(f.read(length))
+            offset = len(cls.Magic) + cls.Struct.size + length
+            fields = {}
+            for (key, typecode, count) in header.pop("fields"):
+                offset += cls._pad(offset)
+                nbytes = count * struct.calcsize("<" + typecode)
+                if NUMPY_ENABLED and mmap:
+                    values = np.memmap(fn, dtype=cls.DTypes[typecode], mode='r', offset=offset, shape=(count,))
+                elif NUMPY_ENABLED:
+                    f.seek(offset)
+                    values = np.fromstring(f.read(nbytes), dtype=cls.DTypes[typecode])
+                else:
+                    f.seek(offset)
+                    values = array.array(typecode)
+                    values.fromstring(f.read(nbytes))
+                    if sys.byteorder != "little":
+                        values.byteswap()
+                    values = values.tolist()
+                fields[key] = values
+                offset += nbytes
+        finally:
+            f.close()
+        return cls(header, fields)
+
+def convert_lattice(pfn, fn):
+    """
+    Rewrite a pickled lattice as a checkpoint.
+    """
+    lattice = CrystalLattice.load_lattice(pfn)
+    lattice.save_lattice(fn)
+    return lattice
+
+def resume_lattice(fn):
+    """
+    Load a checkpoint written by CrystalLattice.save_checkpoint() and put the
+    random stream back where it was, so growing it carries on bit for bit.
+    """
+    # the lattice copies the fields out, so they are only read once
+    checkpoint = Checkpoint.load(fn, mmap=True)
+    lattice = checkpoint.to_lattice()
+    if checkpoint.header.get("random_state") != None:
+        random.setstate(checkpoint.header["random_state"])
+    return lattice
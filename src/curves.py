@@ -7,6 +7,18 @@ from bisect import bisect_left
 import random
 import math
 import sys
+import hashlib
+import multiprocessing
+import cPickle as pickle
+
+NUMPY_ENABLED = True
+try:
+    import numpy
+except ImportError:
+    NUMPY_ENABLED = False
+
+# where baked curve tables are kept between runs
+CURVE_CACHE = os.environ.get("SFGEN_CURVE_CACHE", os.path.expanduser("~/.cache/sfgen/curves"))
 
 # matplotlib
 PLOTS_ENABLED = True
@@ -21,6 +33,50 @@ try:
 except ImportError:
     PLOTS_ENABLED = False
 
+# the plots still drawing in the background
+_plots = []
+
+def run_plot(func, args=(), background=True):
+    """
+    Call a plotting function, by default in a worker process, so whoever
+    built the curves doesn't wait on matplotlib until join_plots().
+    Without matplotlib this does nothing.
+    """
+    if not PLOTS_ENABLED:
+        return None
+    # the workers of a pool, such as a batch, can't start processes of their own
+    if not background or multiprocessing.current_process().daemon:
+        func(*args)
+        return None
+    # forked, so the worker already has the curves and doesn't rebuild them
+    proc = multiprocessing.Process(target=func, args=args)
+    proc.start()
+    # checking on the finished ones reaps them
+    _plots[:] = [plot for plot in _plots if plot.is_alive()]
+    _plots.append(proc)
+    return proc
+
+def join_plots():
+    """
+    Wait for the plots run_plot() left drawing in the background.
+    """
+    while _plots:
+        _plots.pop().join()
+
+def spline_points(knots, du=0.1):
+    """
+    Trace a natural cubic spline through knots, every du along it.
+    """
+    ncs = NaturalCubicSpline(tuples2points(knots))
+    us = []
+    u = 0.0
+    lim = len(ncs) + du
+    # accumulate u the way the old point by point trace did
+    while (u < lim):
+        us.append(u)
+        u = u + du
+    return zip(*ncs.evaluate_many(us))
+
 class Interpolate(object):
     def __init__(self, x_list, y_list, squelch=0):
         self.squelch = squelch
@@ -46,6 +102,20 @@ class Interpolate(object):
         i = bisect_left(self.x_list, x) - 1
         return self.y_list[i] + self.slopes[i] * (x - self.x_list[i])
 
+    def sample(self, xs):
+        """
+        Interpolate at every x in xs at once, exactly as __getitem__ would.
+        """
+        if not NUMPY_ENABLED:
+            return [self[x] for x in xs]
+        x_list = numpy.array(self.x_list)
+        y_list = numpy.array(self.y_list)
+        slopes = numpy.array(self.slopes)
+        xs = numpy.asarray(xs, dtype=float)
+        # like the lists, index -1 wraps around to the last interval
+        i = numpy.searchsorted(x_list, xs, side='left') - 1
+        return y_list[i] + slopes[i] * (xs - x_list[i])
+
 class Curve(object):
     def __init__(self, steps, minval, maxval):
         def sumup(lst):
@@ -63,35 +133,64 @@ class Curve(object):
         self.process()
 
     def build_spline(self, knots):
-        ncs = NaturalCubicSpline(tuples2points(knots))
-        points = []
-        u = 0.0
-        du = 0.1
-        lim = len(ncs) + du
-        while (u < lim):
-            p = ncs(u)
-            points.append(tuple(p))
-            u = u + du
-        return points
+        return spline_points(knots)
+
+    def __setstate__(self, state):
+        # curves used to build their spline up front
+        state.setdefault("_curve", state.pop("curve", None))
+        self.__dict__.update(state)
 
     def process(self):
-        knots = []
-        for xy in zip(self.xlist, self.ylist):
-            knots.append(xy)
-        self.curve = Interpolate(*zip(*self.build_spline(knots)))
+        # the spline is only built once something samples it
+        self._curve = None
+
+    @property
+    def curve(self):
+        if self._curve == None:
+            knots = []
+            for xy in zip(self.xlist, self.ylist):
+                knots.append(xy)
+            self._curve = Interpolate(*zip(*self.build_spline(knots)))
+        return self._curve
 
     def __getitem__(self, x):
         x %= (self.steps - 1)
         x += 1
         return self.curve[x]
 
+    def sample(self):
+        """
+        The curve at every step from 0 to steps - 2, after which it repeats.
+        """
+        return self.curve.sample(range(1, self.steps))
+
 class CurveSet(dict):
-    def __init__(self, name, steps, curves):
+    """
+    A named set of random curves.  The curves are baked into one table with
+    a row of values per step, so stepping an environment is a single row
+    lookup, and the table is cached on disk under CURVE_CACHE, unless cache
+    is off.
+    """
+    def __init__(self, name, steps, curves, cache=True):
         self.name = name
         random.seed(name)
         self.steps = steps
         self.curves = curves
+        self.cache = cache
         self.process()
+        self.bake()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the table is baked again, or read from the cache, on load
+        state["table"] = None
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault("columns", None)
+        state.setdefault("table", None)
+        state.setdefault("cache", True)
+        self.__dict__.update(state)
 
     def process(self):
         for cname in self.curves:
@@ -99,24 +198,74 @@ class CurveSet(dict):
             curve = Curve(self.steps, *args)
             self[cname] = curve
 
-    def run_graph(self):
-        mod = os.path.splitext(__file__)[0] + '.py'
-        cmd = "python %s %s \"%s\" %s" % (mod, self.steps, self.curves, self.name)
-        os.system(cmd)
+    def cache_fn(self):
+        key = repr((self.name, self.steps, sorted(self.curves.items())))
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(CURVE_CACHE, "%s_%d.pickle" % (digest, self.steps))
+
+    def bake(self, cache=None):
+        if cache == None:
+            cache = self.cache
+        self.columns = sorted(self)
+        fn = self.cache_fn()
+        if cache and os.path.exists(fn):
+            try:
+                f = open(fn, 'rb')
+                (columns, table) = pickle.load(f)
+                f.close()
+                if columns == self.columns:
+                    self.table = table
+                    return
+            except (IOError, EOFError, pickle.UnpicklingError):
+                pass
+        columns = [self[key].sample() for key in self.columns]
+        if NUMPY_ENABLED:
+            self.table = numpy.column_stack(columns).tolist()
+        else:
+            self.table = map(list, zip(*columns))
+        if not cache:
+            return
+        try:
+            if not os.path.exists(CURVE_CACHE):
+                os.makedirs(CURVE_CACHE)
+            # write then rename, so racing runs never read half a table
+            tmpfn = "%s.%d" % (fn, os.getpid())
+            f = open(tmpfn, 'wb')
+            pickle.dump((self.columns, self.table), f, protocol=-1)
+            f.close()
+            os.rename(tmpfn, fn)
+        except (IOError, OSError):
+            pass
+
+    def row(self, x):
+        """
+        Every curve at step x, as (name, value) pairs.
+        """
+        if self.table == None:
+            self.bake()
+        return zip(self.columns, self.table[x % (self.steps - 1)])
+
+    def run_graph(self, background=True):
+        return run_plot(self.plot, background=background)
 
     def plot(self):
         assert PLOTS_ENABLED, "you do not currently have plots enabled."
+        if self.table == None:
+            self.bake()
+        rows = [self.table[x % (self.steps - 1)] for x in range(self.steps)]
         fig, axs = plt.subplots(nrows=len(self), ncols=1, sharex=True)
         fig.set_size_inches(10, 25)
         for (idx, key) in enumerate(self):
             ax = axs[idx]
-            data = [self[key][x] for x in range(self.steps)]
+            col = self.columns.index(key)
+            data = [row[col] for row in rows]
             ax.plot(data)
             ax.set_xlabel("time (simulation steps)")
             ax.set_ylabel(key)
             ax.set_ylim(self[key].minval, self[key].maxval)
         fn = "%s_runtime.png" % self.name
         plt.savefig(fn)
+        plt.close(fig)
 
 # for backwards compatability
 class NameCurve(object):
@@ -152,16 +301,7 @@ class NameCurve(object):
         return self.hum_curve[step]
 
     def build_spline(self, knots):
-        ncs = NaturalCubicSpline(tuples2points(knots))
-        points = []
-        u = 0.0
-        du = 0.1
-        lim = len(ncs) + du
-        while (u < lim):
-            p = ncs(u)
-            points.append(tuple(p))
-            u = u + du
-        return points
+        return spline_points(knots)
 
     def process(self):
         kv = [(0, 0)]
@@ -177,11 +317,11 @@ class NameCurve(object):
         self.hum_curve = Interpolate(*zip(*self.build_spline(kc)), squelch=5)
         self.temp_curve = Interpolate(*zip(*self.build_spline(kv)), squelch=5)
 
-    def run_graph(self):
-        mod = os.path.splitext(__file__)[0] + '.py'
-        cmd = "python %s %s" % (mod, self.name)
-        os.system(cmd)
-            
+    def run_graph(self, background=True):
+        fn = "%s_runtime.png" % self.name
+        return run_plot(self.graph, (fn,), background=background)
+
+
     def graph(self, fn):
         assert PLOTS_ENABLED, "You do not currently have plots enabled."
         fig = plt.figure()
@@ -200,12 +340,4 @@ class NameCurve(object):
             tl.set_color('b')
         plt.title(self.name)
         plt.savefig(fn)
-
-
-
-if __name__ == "__main__":
-    name = str.join('', sys.argv[3:])
-    curves = eval(sys.argv[2])
-    steps = int(sys.argv[1])
-    nc = CurveSet(name, steps, curves)
-    nc.plot()
+        plt.close(fig)
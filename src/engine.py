@@ -10,10 +10,14 @@ import sys
 import re
 import colorsys
 import bisect
+import threading
+import collections
+import Queue
 import operator
-from xml.dom.minidom import parse
+import traceback
 
 InkscapePath = "/Applications/Inkscape.app/Contents/Resources/bin/inkscape"
+CuraPath = "/Applications/Cura/Cura.app/Contents/Resources/Cura/cura.py"
 
 try:
     import Image
@@ -65,8 +69,7 @@ class CrystalEnvironment(dict):
     def step(self, x):
         if self.curves == None:
             return
-        for key in self.curves:
-            self[key] = self.curves[key][x]
+        self.update(self.curves.row(x))
 
     @classmethod
     def build_env(self, name, steps, min_gamma=0.45, max_gamma=0.85):
@@ -81,7 +84,7 @@ class CrystalEnvironment(dict):
         }
         cs = CurveSet(name, steps, curves)
         cs.run_graph()
-        env = {key: cs[key][0] for key in curves}
+        env = dict(cs.row(0))
         env["gamma"] = random.random() * (max_gamma - min_gamma) + min_gamma
         return CrystalEnvironment(curves=cs, **env)
 
@@ -142,58 +145,189 @@ class RenderMovie(object):
     def run(self):
         if not os.path.exists("frames"):
             os.mkdir("frames")
-        x = iter(self.replay)
-        for (idx, frame) in enumerate(self.replay):
-            fn = "frames/%s_%09d.png" % (self.name, idx + 1)
-            frame.save_image(fn)
+        try:
+            for (idx, frame) in enumerate(self.replay):
+                fn = "frames/%s_%09d.png" % (self.name, idx + 1)
+                frame.save_image(fn)
+        finally:
+            self.replay.close()
 
 class LatticeReplay(object):
-    class ReplayIterator(object):
-        def __init__(self, replay):
-            self.replay = replay
-            self.idx = 0
-
-        def next(self):
-            try:
-                lattice = self.replay.get_lattice(self.idx)
-                self.idx += 1
-                return lattice
-            except IndexError:
-                raise StopIteration
+    """
+    Random access to the frames of a run's cell log, as read-only
+    ReplayFrame views that can be held on to and shared between threads.
+    Every thread reads the log through a reader of its own, and only the
+    bookkeeping of the batch cache is ever locked.
+
+    Frames are decoded a batch at a time, and the most recently used
+    batches are kept up to a memory budget in bytes.  Reading a frame
+    queues up the batch after it on a background thread, so playing a
+    replay forward rarely waits on the disk.  A replay supports len(),
+    replay[idx] and replay[start:stop:step].  close() stops the
+    background thread and lets go of the cached batches.
+    """
+    BatchSize = 50
 
-    def __init__(self, name):
+    def __init__(self, name, budget=256 << 20, prefetch=True):
         self.name = name
-        self.current_frame = None
-        self.current_replay = None
-        pfn = "%s.pickle" % self.name
-        self.lattice = CrystalLattice.load_lattice(pfn)
+        self.budget = budget
+        self._lattice = None
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._local = threading.local()
         self.scan_replays()
+        self._queue = None
+        self._thread = None
+        if prefetch:
+            self._queue = Queue.Queue()
+            self._thread = threading.Thread(target=self._prefetch)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        if self._queue != None:
+            # None tells the prefetch thread to stop
+            self._queue.put(None)
+            self._thread.join()
+            self._queue = None
+            self._thread = None
+        self._close_reader()
+        with self._lock:
+            self._cache.clear()
+            self._cache_bytes = 0
+            self._pending.clear()
+
+    @property
+    def lattice(self):
+        if self._lattice == None:
+            pfn = "%s.lattice" % self.name
+            if not os.path.exists(pfn):
+                pfn = "%s.pickle" % self.name
+            self._lattice = CrystalLattice.load_lattice(pfn)
+        return self._lattice
+
+    def __len__(self):
+        if not self.batches:
+            return 0
+        return self.batches[-1][1]
 
     def __iter__(self):
-        return self.ReplayIterator(self)
+        for idx in xrange(len(self)):
+            yield self[idx]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[frame] for frame in xrange(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        batch = bisect.bisect_right(self.starts, idx) - 1
+        frames = self._get_batch(batch)
+        if batch + 1 < len(self.batches):
+            self._request(batch + 1)
+        return frames[idx - self.starts[batch]]
 
     def get_lattice(self, step):
-        (step, dm, cm) = self.get_step(step)
-        for (idx, cell) in enumerate(zip(dm, cm)):
-            self.lattice.cells[idx].diffusive_mass = cell[0]
-            self.lattice.cells[idx].crystal_mass = cell[1]
-            self.lattice.cells[idx].attached = bool(cell[1])
-        for cell in self.lattice.cells:
-            cell.update_boundary()
+        fields = self[step].cell_fields()
+        cells = zip(fields["diffusive_mass"], fields["crystal_mass"], fields["attached"])
+        for (idx, (dm, cm, attached)) in enumerate(cells):
+            self.lattice.cells[idx].diffusive_mass = dm
+            self.lattice.cells[idx].crystal_mass = cm
+            self.lattice.cells[idx].attached = bool(attached)
+        self.lattice.rebuild_frontier()
         return self.lattice
 
     def get_step(self, step):
-        idx = bisect.bisect_left(self.replay_map, step + 1)
-        if self.current_frame != idx or not self.current_replay:
-            self.current_frame = idx
-            fn = self.replays[self.current_frame]
-            print "loading", fn
-            f = open(fn)
-            self.current_replay = pickle.load(f)
-        offset = self.current_replay[0][0]
-        return self.current_replay[step - offset]
+        frame = self[step]
+        fields = frame.cell_fields()
+        return (frame.iteration, fields["diffusive_mass"], fields["crystal_mass"])
+
+    def _get_batch(self, batch):
+        with self._lock:
+            if batch in self._cache:
+                frames = self._cache.pop(batch)
+                self._cache[batch] = frames
+                return frames
+        frames = self._read_batch(batch)
+        self._store(batch, frames)
+        return frames
+
+    def _store(self, batch, frames):
+        with self._lock:
+            if batch in self._cache:
+                return
+            self._cache[batch] = frames
+            self._cache_bytes += sum([values.nbytes for frame in frames for values in frame.fields.values()])
+            while self._cache_bytes > self.budget and len(self._cache) > 1:
+                (old, old_frames) = self._cache.popitem(last=False)
+                self._cache_bytes -= sum([values.nbytes for frame in old_frames for values in frame.fields.values()])
+
+    def _request(self, batch):
+        if self._queue == None:
+            return
+        with self._lock:
+            if batch in self._cache or batch in self._pending:
+                return
+            self._pending.add(batch)
+        self._queue.put(batch)
+
+    def _prefetch(self):
+        while True:
+            batch = self._queue.get()
+            if batch == None:
+                break
+            try:
+                self._store(batch, self._read_batch(batch))
+            except Exception:
+                # the frames are read again when they are asked for
+                msg = "Could not prefetch batch %d of %s" % (batch, self.name)
+                log(msg)
+                log(traceback.format_exc())
+            finally:
+                with self._lock:
+                    self._pending.discard(batch)
+        self._close_reader()
+
+    def _reader(self):
+        # a cell log reader per thread, so no file position is ever shared
+        import sfgen
+        if getattr(self._local, "celllog", None) == None:
+            self._local.celllog = sfgen.CellLog(self.celllog.name)
+        return self._local.celllog
+
+    def _close_reader(self):
+        celllog = getattr(self._local, "celllog", None)
+        if celllog != None:
+            celllog.close()
+            self._local.celllog = None
+
+    def _read_batch(self, batch):
+        import sfgen
+        (start, stop) = self.batches[batch]
+        if self.celllog != None:
+            celllog = self._reader()
+            frames = [celllog[idx] for idx in xrange(start, stop)]
+        else:
+            f = open(self.replays[batch], 'rb')
+            frames = pickle.load(f)
+            f.close()
+        # pickled cell logs are (step, dm, cm), without the attached cells
+        return [sfgen.ReplayFrame(self.size, *frame) for frame in frames]
 
     def scan_replays(self):
+        self.celllog = None
+        if os.path.exists("cell_log.index"):
+            import sfgen
+            self.celllog = sfgen.CellLog()
+            self.size = int(round(math.sqrt(self.celllog.ncells)))
+            count = len(self.celllog)
+            self.batches = [(start, min(count, start + self.BatchSize)) for start in xrange(0, count, self.BatchSize)]
+            self.starts = [start for (start, stop) in self.batches]
+            return
+        # cell logs from before the replay file, one batch per file
         replays = []
         fn_re = re.compile("cell_log_(\d+).pickle")
         for fn in os.listdir('.'):
@@ -203,10 +337,18 @@ class LatticeReplay(object):
                 replays.append((fn, step))
         replays.sort(key=operator.itemgetter(1))
         self.replays = [rp[0] for rp in replays]
-        self.replay_map = [rp[1] for rp in replays]
+        # each file holds the steps logged since the one before it
+        ends = [rp[1] - 1 for rp in replays]
+        self.batches = zip([0] + ends[:-1], ends)
+        self.starts = [start for (start, stop) in self.batches]
+        self.size = None
+        if self.batches:
+            self.size = self.lattice.size
 
 class CrystalLattice(object):
     LogHeader = ["dm", "cm", "bm", "acnt", "bcnt", "width", "beta", "theta", "alpha", "kappa", "mu", "upsilon"]
+    HeaderKeys = ["size", "iteration", "environment", "curves", "margin", "max_steps", "debug", "celltype", "celllog_options"]
+    CellFields = ["diffusive_mass", "boundary_mass", "crystal_mass", "attached", "boundary", "age"]
 
     def __init__(self, size, environment=None, celltype=None, max_steps=0, margin=None, curves=None, datalog=False, debug=False):
         self.size = size
@@ -218,6 +360,9 @@ class CrystalLattice(object):
         if datalog:
             self.datalog = []
             self.celllog = []
+        # keyword arguments for the CellLog, see CellLog for sparse logging
+        self.celllog_options = None
+        self.celllog_writer = None
         if celltype == None:
             celltype = SnowflakeCell
         self.debug = debug
@@ -229,6 +374,16 @@ class CrystalLattice(object):
         self.max_steps = max_steps
         self._init_cells()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the frontier is rebuilt from the cells on load
+        state.pop("frontier", None)
+        state.pop("quiet", None)
+        state.pop("attaching", None)
+        state.pop("celllog_writer", None)
+        state.pop("_crystal_layers", None)
+        return state
+
     def __setstate__(self, state):
         # 0.1->0.2 format changes
         if "radius" in state:
@@ -236,11 +391,17 @@ class CrystalLattice(object):
             del state["radius"]
         if "angle" in state:
             del state["angle"]
+        state.setdefault("celllog_options", None)
+        state["celllog_writer"] = None
         self.__dict__.update(state)
 
     def save_lattice(self, fn):
         msg = "Saving %s..." % fn
         log(msg)
+        if not fn.endswith(".pickle"):
+            import sfgen
+            sfgen.Checkpoint.from_lattice(self).save(fn)
+            return
         f = open(fn, 'wb')
         pickle.dump(self, f, protocol=-1)
 
@@ -248,12 +409,61 @@ class CrystalLattice(object):
     def load_lattice(cls, fn):
         msg = "Loading %s..." % fn
         log(msg)
+        import sfgen
+        if sfgen.Checkpoint.is_checkpoint(fn):
+            return sfgen.Checkpoint.load(fn, mmap=True).to_lattice(cls)
         f = open(fn, 'rb')
         obj = pickle.load(f)
         for cell in obj.cells:
             cell.lattice = obj
             cell.env = obj.environment
-            cell.update_boundary()
+        obj.rebuild_frontier()
+        return obj
+
+    def lattice_header(self):
+        """
+        Everything but the cells that it takes to rebuild the lattice.
+        """
+        return {key: getattr(self, key, None) for key in self.HeaderKeys}
+
+    def cell_fields(self):
+        """
+        Every cell field as a list, in lattice index order.
+        """
+        return {key: [getattr(cell, key) for cell in self.cells] for key in self.CellFields}
+
+    @classmethod
+    def from_fields(cls, header, fields):
+        """
+        Build a lattice from a lattice header and its cell fields.
+        """
+        obj = cls.__new__(cls)
+        for key in cls.HeaderKeys:
+            setattr(obj, key, header.get(key))
+        if obj.celltype == None:
+            obj.celltype = SnowflakeCell
+        obj.datalog = header.get("datalog")
+        obj.celllog = None
+        if obj.datalog != None:
+            obj.celllog = []
+        obj.celllog_writer = None
+        obj.cells = [None] * (obj.size * obj.size)
+        columns = {}
+        for key in cls.CellFields:
+            values = fields[key]
+            if not isinstance(values, list):
+                values = values.tolist()
+            columns[key] = values
+        for idx in range(len(obj.cells)):
+            cell = obj.celltype(obj._cell_xy(idx), obj)
+            cell.diffusive_mass = columns["diffusive_mass"][idx]
+            cell.boundary_mass = columns["boundary_mass"][idx]
+            cell.crystal_mass = columns["crystal_mass"][idx]
+            cell.attached = bool(columns["attached"][idx])
+            cell.boundary = bool(columns["boundary"][idx])
+            cell.age = columns["age"][idx]
+            obj.cells[idx] = cell
+        obj.rebuild_frontier()
         return obj
 
     def get_neighbors(self, xy):
@@ -267,7 +477,64 @@ class CrystalLattice(object):
         for cell in self.cells:
             cell.reality_check()
 
+    def rebuild_frontier(self):
+        """
+        Recount the attached neighbors of every cell and collect the
+        frontier, the unattached cells with at least one attached neighbor.
+        The frontier and the quiet cells, the rest of the unattached cells,
+        are kept as lists of cell indices in order.
+        """
+        # the cells may have been reloaded without a step
+        self._crystal_layers = None
+        self.attaching = []
+        for cell in self.cells:
+            cell.attached_count = 0
+            # attached cells keep the boundary flag they attached with
+            if not cell.attached:
+                cell.boundary = False
+        for cell in self.cells:
+            if cell.attached:
+                for neighbor in cell.neighbors:
+                    neighbor.attached_count += 1
+                    if not neighbor.attached:
+                        neighbor.boundary = True
+        self.frontier = []
+        self.quiet = []
+        for (idx, cell) in enumerate(self.cells):
+            if cell == None or cell.attached:
+                continue
+            if cell.boundary:
+                self.frontier.append(idx)
+            else:
+                self.quiet.append(idx)
+
+    def update_frontier(self):
+        """
+        Fold the cells that attached since the last call into the frontier.
+        """
+        for cell in self.attaching:
+            if cell.boundary:
+                self._unlist(self.frontier, cell)
+            else:
+                self._unlist(self.quiet, cell)
+            for neighbor in cell.neighbors:
+                neighbor.attached_count += 1
+                if not (neighbor.attached or neighbor.boundary):
+                    neighbor.boundary = True
+                    self._unlist(self.quiet, neighbor)
+                    bisect.insort(self.frontier, self._cell_index(neighbor.xy))
+        self.attaching = []
+
+    def _unlist(self, cells, cell):
+        idx = self._cell_index(cell.xy)
+        pos = bisect.bisect_left(cells, idx)
+        if pos < len(cells) and cells[pos] == idx:
+            del cells[pos]
+
     def _init_cells(self):
+        self.frontier = []
+        self.quiet = range(self.size * self.size)
+        self.attaching = []
         self.cells = [None] * (self.size * self.size)
         for x in range(self.size):
             for y in range(self.size):
@@ -278,6 +545,7 @@ class CrystalLattice(object):
         self.reality_check()
         center_pt = self._cell_index((self.size / 2, self.size / 2))
         self.cells[center_pt].attach(1)
+        self.update_frontier()
         # fun experiments
         #self.cells[center_pt+4].attach(1)
         #self.cells[center_pt-4].attach(1)
@@ -333,11 +601,16 @@ class CrystalLattice(object):
         #row.append(self.environment.gamma)
         self.datalog.append(row)
         # log the cells
-        self.celllog.append((self.iteration, dm, cm))
+        attached = [cell.attached for cell in self.cells if cell]
+        self.celllog.append((self.iteration, dm, cm, attached))
+        self.write_celllog()
 
     def write_log(self):
         self.write_datalog()
         self.write_celllog()
+        if self.celllog_writer != None:
+            self.celllog_writer.close()
+            self.celllog_writer = None
 
     def write_datalog(self):
         if self.datalog == None:
@@ -355,9 +628,11 @@ class CrystalLattice(object):
     def write_celllog(self):
         if not self.celllog:
             return
-        logfn = "cell_log_%d.pickle" % self.iteration
-        f = open(logfn, 'wb')
-        pickle.dump(self.celllog, f, protocol=-1)
+        if self.celllog_writer == None:
+            import sfgen
+            self.celllog_writer = sfgen.CellLog(mode='a', **(self.celllog_options or {}))
+        for (step, dm, cm, attached) in self.celllog:
+            self.celllog_writer.append(step, dm, cm, attached)
         self.celllog = []
 
     def print_status(self):
@@ -373,18 +648,23 @@ class CrystalLattice(object):
 
     def step(self):
         self.log_status()
-        for cell in self.cells:
-            if cell == None or cell.attached:
-                continue
+        cells = self.cells
+        # only the frontier freezes, attaches and melts, in cell order
+        frontier = [cells[idx] for idx in self.frontier]
+        for idx in self.quiet:
+            cells[idx].step_one()
+        for cell in frontier:
             cell.step_one()
-        for cell in self.cells:
-            if cell == None or cell.attached:
-                continue
+        for cell in frontier:
             cell.step_two()
-        for cell in self.cells:
-            if cell == None or cell.attached:
-                continue
+        for cell in frontier:
             cell.step_three()
+        # the rest just take their diffused mass and the noise, in cell
+        # order, so they draw from the random stream as they always have
+        for idx in self.quiet:
+            cells[idx].step_quiet()
+        # boundaries only change once the whole step has attached
+        self.update_frontier()
         # run curves
         self.iteration += 1
         self.environment.step(self.iteration)
@@ -438,6 +718,27 @@ class CrystalLattice(object):
         box = (half_s - distance, half - distance, half_s + distance, half + distance)
         return box
 
+    def crystal_layers(self, layers):
+        """
+        The layer of every cell, when the crystal is split into layers by
+        crystal mass, heaviest first, with -1 for cells outside the crystal.
+        The layers are kept until the lattice steps again or its cells are
+        reloaded.
+        """
+        key = (layers, self.iteration)
+        cached = getattr(self, "_crystal_layers", None)
+        if cached != None and cached[0] == key:
+            return cached[1]
+        fields = self.cell_fields()
+        mass = [cm for (cm, attached) in zip(fields["crystal_mass"], fields["attached"]) if attached]
+        thresholds = quantize(mass, layers)
+        cells = [-1] * len(fields["attached"])
+        for (idx, attached) in enumerate(fields["attached"]):
+            if attached:
+                cells[idx] = layers - 1 - bisect.bisect_right(thresholds, fields["crystal_mass"][idx])
+        self._crystal_layers = (key, cells)
+        return cells
+
     def headroom(self, margin=None):
         if self.max_steps and self.iteration >= self.max_steps:
             return False
@@ -450,11 +751,30 @@ class CrystalLattice(object):
             return False
         return True
 
-    def grow(self):
+    def save_checkpoint(self, fn):
+        """
+        Save the lattice along with the random state and the data logs, so a
+        run resumed from it carries on exactly where this one left off.
+        """
+        import sfgen
+        msg = "Checkpointing %s at step #%d..." % (fn, self.iteration)
+        log(msg)
+        self.write_celllog()
+        checkpoint = sfgen.Checkpoint.from_lattice(self)
+        checkpoint.header["random_state"] = random.getstate()
+        checkpoint.header["datalog"] = self.datalog
+        # never leave a half written checkpoint behind
+        tmpfn = "%s.tmp" % fn
+        checkpoint.save(tmpfn)
+        os.rename(tmpfn, fn)
+
+    def grow(self, checkpoint=None, checkpoint_steps=0):
         while True:
             if self.debug:
                 self.print_status()
             self.step()
+            if checkpoint and self.iteration % checkpoint_steps == 0:
+                self.save_checkpoint(checkpoint)
             if self.iteration % 50 == 0:
                 self.write_celllog()
                 if not self.debug:
@@ -480,7 +800,7 @@ class SnowflakeCell(object):
         self.attached = False
         self.age = 0
         self.boundary = 0
-        self.attached_neighbors = []
+        self.attached_count = 0
         self.__neighbors = None
 
     def __getstate__(self):
@@ -497,6 +817,9 @@ class SnowflakeCell(object):
             self.age = state[5]
         except IndexError:
             self.age = 0
+        # pickles don't keep the boundary flag
+        self.boundary = False
+        self.attached_count = 0
         self.__neighbors = None
         self.lattice = None
         self.env = None
@@ -515,21 +838,25 @@ class SnowflakeCell(object):
             self.__neighbors = self.lattice.get_neighbors(self.xy)
         return self.__neighbors
     
-    #@property
-    #def attached_neighbors(self):
-    #    return [cell for cell in self.neighbors if cell.attached]
+    @property
+    def attached_neighbors(self):
+        return [cell for cell in self.neighbors if cell.attached]
 
     #@property
     #def boundary(self):
     #    return (not self.attached) and any([cell.attached for cell in self.neighbors])
 
     def update_boundary(self):
-        self.boundary = (not self.attached) and any([cell.attached for cell in self.neighbors])
+        self.attached_count = len(self.attached_neighbors)
+        self.boundary = (not self.attached) and self.attached_count > 0
+
+    def order(self):
+        # the order of the cell in CrystalLattice.cells
+        (x, y) = self.xy
+        return (y, x)
 
     def step_one(self):
-        self.update_boundary()
-        if self.boundary:
-            self.attached_neighbors = [cell for cell in self.neighbors if cell.attached]
+        # the boundary is kept up to date by CrystalLattice.update_frontier()
         self._next_dm = self.diffusion_calc()
 
     def step_two(self):
@@ -544,6 +871,22 @@ class SnowflakeCell(object):
             self.attach()
         self.noise_step()
 
+    def step_quiet(self):
+        # step_two() and step_three() for a cell off the frontier
+        self.diffusive_mass = self._next_dm
+        self.noise_step()
+
+    def stepped_mass(self, cell):
+        """
+        The diffusive mass of this cell that a frontier cell sees in its
+        step_two(), as if every cell stepped in cell order.  The frontier
+        steps before the quiet cells, so a quiet cell ahead of it reads as
+        its diffused mass, and any other cell as its mass as it stands.
+        """
+        if not (self.attached or self.boundary) and self.order() < cell.order():
+            return self._next_dm
+        return self.diffusive_mass
+
     def diffusion_calc(self):
         next_dm = self.diffusive_mass
         if self.attached:
@@ -560,6 +903,7 @@ class SnowflakeCell(object):
         self.crystal_mass = self.boundary_mass + self.crystal_mass + offset
         self.boundary_mass = 0
         self.attached = True
+        self.lattice.attaching.append(self)
 
     def freezing_step(self):
         if not self.boundary:
@@ -571,7 +915,7 @@ class SnowflakeCell(object):
     def attachment_step(self):
         if not self.boundary:
             return False
-        attach_count = len(self.attached_neighbors)
+        attach_count = self.attached_count
         if attach_count <= 2:
             if self.boundary_mass > self.env.beta:
                 return True
@@ -581,7 +925,7 @@ class SnowflakeCell(object):
             else:
                 summed_diffusion = self.diffusive_mass
                 for cell in self.neighbors:
-                    summed_diffusion += cell.diffusive_mass
+                    summed_diffusion += cell.stepped_mass(self)
                 if summed_diffusion < self.env.theta and self.boundary_mass >= self.env.alpha:
                     return True
         elif attach_count >= 4:
@@ -603,145 +947,80 @@ class SnowflakeCell(object):
         else:
             self.diffusive_mass = (1 + self.env.sigma) * self.diffusive_mass
 
-def check_basecut(svgfn):
-    # ensure there is only one path
-    svg = parse(svgfn)
-    for (cnt, node) in enumerate(svg.getElementsByTagName("path")):
-        if cnt > 0:
-            return False
-    return True
-
-def merge_svg(file_list, color_list, outfn):
-    first = None
-    idx = 0
-    for (svgfn, color) in zip(file_list, color_list):
-        svg = parse(svgfn)
-        for node in svg.getElementsByTagName("g"):
-            if idx == 0:
-                # cut layer
-                # write a new group
-                container = svg.createElement("g")
-                container.setAttribute("transform", node.attributes["transform"].nodeValue)
-                node.parentNode.replaceChild(container, node)
-                container.appendChild(node)
-                node.attributes["fill"] = "none"
-                node.attributes["stroke"] = "rgb(0, 0, 255)"
-                node.attributes["stroke-opacity"] = "1"
-                node.attributes["stroke-width"] = ".01mm"
-            else:
-                node.attributes["fill"] = color
-            del node.attributes["transform"]
-            idx += 1
-            import_nodes = svg.importNode(node, True)
-            container.appendChild(import_nodes)
-            if first == None:
-                first = svg
-    f = open(outfn, 'w')
-    f.write(first.toxml())
-
-def potrace(svgfn, fn, turd=None, size=None):
-    cmd = ["potrace", "-i", "-b", "svg"]
-    if turd != None:
-        cmd.extend(["-t", str(turd)])
-    if size != None:
-        sz = map(str, size)
-        cmd.extend(["-W", sz[0], "-H", sz[1]])
-    cmd.extend(["-o", svgfn, fn])
-    cmd = str.join(' ', cmd)
-    msg = "Running '%s'" % cmd
-    log(msg)
-    os.system(cmd)
-
 # laser cutter pipeline
-def pipeline_lasercutter(args, lattice, inches=3, dpi=96, turd=10):
-    # layers
+def pipeline_lasercutter(args, lattice, inches=3, dpi=96, turd=10, layers=2, workers=None):
+    import sfgen
     rs = RenderSnowflake(lattice)
     name = str.join('', [c for c in args.name if c.islower()])
-    size = args.target_size
-    layerfn = "%s_layer_%%d.bmp" % name
     resize = inches * dpi
-    fnlist = rs.save_layers(layerfn, 2, resize=resize, margin=1)
-    # we want to drop the heaviest layer
-    del fnlist[0]
-    # try to save o'natural
-    imgfn = "%s_bw.bmp" % name
-    svgfn = "%s_bw.svg" % name
-    lattice.save_image(imgfn, scheme=BlackWhite(lattice), resize=resize, margin=1)
-    potrace(svgfn, imgfn, turd=2000)
-    if not check_basecut(svgfn):
+    # the etch layers, less the heaviest
+    masks = rs.render_layers(layers, resize=resize, margin=1)[1:]
+    # try to cut o'natural
+    masks.insert(0, rs.render_mask(BlackWhite(lattice), resize=resize, margin=1))
+    # the etch layers keep potrace's default turd size
+    traced = sfgen.trace_masks(masks, turd=[turd] + [2] * (layers - 1), workers=workers)
+    if sfgen.count_shapes(traced[0], turd=2000) != 1:
         msg = "There are disconnected elements in the base cut, turning on boundary layer."
         log(msg)
-        lattice.save_image(imgfn, scheme=BlackWhite(lattice, boundary=True), resize=resize, margin=1)
-        potrace(svgfn, imgfn, turd=2000)
-        assert check_basecut(svgfn), "Despite best efforts, base cut is still non-contiguous."
-    os.unlink(svgfn)
-    fnlist.insert(0, imgfn)
+        mask = rs.render_mask(BlackWhite(lattice, boundary=True), resize=resize, margin=1)
+        traced[0] = sfgen.trace_mask(mask, turd=turd)
+        assert sfgen.count_shapes(traced[0], turd=2000) == 1, "Despite best efforts, base cut is still non-contiguous."
     # adjusted for ponoko
     # cut layer is blue
     # etch layer are black, or shades of grey
     colors = ["#000000", "#111111", "#222222", "#333333", "#444444", "#555555"]
-    svgs = []
-    for (idx, fn) in enumerate(fnlist):
-        svgfn = os.path.splitext(fn)[0]
-        svgfn = "%s_laser.svg" % svgfn
-        svgs.append(svgfn)
-        if idx == 0:
-            potrace(svgfn, fn, turd=turd, size=size)
-        else:
-            potrace(svgfn, fn, size=size)
+    cut = {"fill": "none", "stroke": "rgb(0, 0, 255)", "stroke-opacity": "1", "stroke-width": ".01mm"}
+    svg_layers = [(traced[0], cut)]
+    svg_layers += [(contours, {"fill": color, "stroke": "none"}) for (contours, color) in zip(traced[1:], colors[1:])]
     svgfn = "%s_laser_merged.svg" % name
-    epsfn = "%s_laser_merged.eps" % name
-    merge_svg(svgs, colors, svgfn)
-    """
-    # move to eps
-    cmd = "%s %s -E %s" % (InkscapePath, svgfn, epsfn)
-    msg = "Running '%s'" % cmd
+    msg = "Saving %s..." % svgfn
     log(msg)
-    os.system(cmd)
-    """
+    sfgen.save_svg(svgfn, (resize, resize), svg_layers, size=args.target_size)
 
 # 3d pipeline
-def pipeline_3d(args, lattice, inches=3, dpi=96, turd=10):
+def pipeline_3d(args, lattice, inches=3, dpi=96, turd=10, thickness=3.0, tolerance=0.5):
+    import sfgen
+    rs = RenderSnowflake(lattice)
     resize = inches * dpi
     # try to save o'natural
-    imgfn = "%s_bw.bmp" % args.name
-    svgfn = "%s_bw.svg" % args.name
-    lattice.save_image(imgfn, scheme=BlackWhite(lattice), resize=resize, margin=1)
-    potrace(svgfn, imgfn, turd=2000)
-    if not check_basecut(svgfn):
+    mask = rs.render_mask(BlackWhite(lattice), resize=resize, margin=1)
+    contours = sfgen.trace_mask(mask, turd=turd, tolerance=tolerance)
+    if sfgen.count_shapes(contours, turd=2000) != 1:
         msg = "There are disconnected elements in the base cut, turning on boundary layer."
         log(msg)
-        lattice.save_image(imgfn, bw=True, boundary=True)
-        potrace(svgfn, imgfn, turd=2000)
-        assert check_basecut(svgfn), "Despite best efforts, base cut is still non-contiguous."
-    #
-    epsfn = "%s_3d.eps" % args.name
-    dxffn = "%s_3d.dxf" % args.name
-    cmd = "potrace -M .1 --tight -i -b eps -o %s %s" % (epsfn, imgfn)
-    msg = "Running '%s'" % cmd
-    log(msg)
-    os.system(cmd)
-    #
-    cmd = "pstoedit -dt -f dxf:-polyaslines %s %s" % (epsfn, dxffn)
-    msg = "Running '%s'" % cmd
-    log(msg)
-    os.system(cmd)
-    #
-    scad_fn = "%s_3d.scad" % args.name
+        mask = rs.render_mask(BlackWhite(lattice, boundary=True), resize=resize, margin=1)
+        contours = sfgen.trace_mask(mask, turd=turd, tolerance=tolerance)
+        assert sfgen.count_shapes(contours, turd=2000) == 1, "Despite best efforts, base cut is still non-contiguous."
+    # in millimeters, inches across and thickness high
     stlfn = "%s_3d.stl" % args.name
-    f = open(scad_fn, 'w')
-    scad_txt = 'scale([30, 30, 30]) linear_extrude(height=.18, layer="0") import("%s");\n' % dxffn
-    f.write(scad_txt)
-    f.close()
-    cmd = "/Applications/OpenSCAD.app/Contents/MacOS/OpenSCAD -o %s %s" % (stlfn, scad_fn)
-    msg = "Running '%s'" % cmd
+    scale = inches * 25.4 / resize
+    while True:
+        try:
+            count = sfgen.save_stl(stlfn, sfgen.extrude_contours(contours, thickness, scale=scale, height=resize))
+            break
+        except ValueError:
+            # simplifying can cross an outline over itself, so trace closer
+            if tolerance == 0:
+                raise
+            tolerance = tolerance / 2 if tolerance > 0.05 else 0
+            msg = "An outline crosses itself, tracing again to within %.3g pixels." % tolerance
+            log(msg)
+            contours = sfgen.trace_mask(mask, turd=turd, tolerance=tolerance)
+    msg = "Saved %s, %d triangles" % (stlfn, count)
     log(msg)
-    os.system(cmd)
-    #
-    cmd = "python /Applications/Cura/Cura.app/Contents/Resources/Cura/cura.py -s %s -i %s" % (stlfn, SNOWFLAKE_INI)
-    msg = "Running '%s'" % cmd
+    if os.path.exists(CuraPath):
+        cmd = "python %s -s %s -i %s" % (CuraPath, stlfn, SNOWFLAKE_INI)
+        msg = "Running '%s'" % cmd
+        log(msg)
+        os.system(cmd)
+
+# relief pipeline
+def pipeline_relief(args, lattice, inches=3, cells=1024, base=1.0, relief=3.0, tolerance=0.005):
+    import sfgen
+    stlfn = "%s_relief.stl" % args.name
+    count = sfgen.save_relief(stlfn, lattice, cells=cells, width=inches * 25.4, base=base, relief=relief, tolerance=tolerance, margin=1)
+    msg = "Saved %s, %d triangles" % (stlfn, count)
     log(msg)
-    os.system(cmd)
 
 SNOWFLAKE_DEFAULTS = {
     "size": 200,
@@ -750,6 +1029,7 @@ SNOWFLAKE_DEFAULTS = {
     "env": '',
     "pipeline_3d": False,
     "pipeline_lasercutter": False,
+    "pipeline_relief": False,
     "randomize": False,
     "max_steps": 0,
     "margin": .85,
@@ -757,15 +1037,39 @@ SNOWFLAKE_DEFAULTS = {
     "datalog": False,
     "debug": False,
     "movie": False,
+    "numpy": False,
+    "symmetric": False,
+    "halo": None,
+    "workers": 0,
+    "checkpoint": 0,
+    "resume": False,
+    "log_keyframes": 0,
+    "log_stride": 0,
+    "log_precision": 0.0,
+    "movie_file": None,
+    "movie_size": None,
+    "frame_stride": 1,
+    "fps": 30,
 }
 
 def run(args):
     log_output(args.name)
     msg = "Snowflake Generator v0.3"
     log(msg)
-    pfn = "%s.pickle" % args.name
+    pfn = "%s.lattice" % args.name
     ifn = "%s.png" % args.name
-    if os.path.exists(pfn):
+    cfn = "%s.checkpoint" % args.name
+    if not os.path.exists(pfn) and os.path.exists("%s.pickle" % args.name):
+        import sfgen
+        sfgen.convert_lattice("%s.pickle" % args.name, pfn)
+    grow = True
+    if args.resume and os.path.exists(cfn):
+        import sfgen
+        cl = sfgen.resume_lattice(cfn)
+        if args.workers:
+            cl.workers = args.workers
+    elif os.path.exists(pfn):
+        grow = False
         cl = CrystalLattice.load_lattice(pfn)
         #cl.save_image(ifn, bw=args.bw)
         #cl.save_image(ifn)
@@ -788,9 +1092,31 @@ def run(args):
         kw["margin"] = args.margin
         kw["datalog"] = args.datalog
         kw["debug"] = args.debug
-        cl = CrystalLattice(args.size, **kw)
+        latticetype = CrystalLattice
+        if args.workers:
+            import sfgen
+            latticetype = sfgen.ParallelLattice
+            kw["workers"] = args.workers
+        elif args.symmetric:
+            import sfgen
+            latticetype = sfgen.SymmetricLattice
+        elif args.numpy or args.halo != None:
+            import sfgen
+            latticetype = sfgen.ArrayLattice
+        if latticetype != CrystalLattice:
+            kw["halo"] = args.halo
+        cl = latticetype(args.size, **kw)
+        if args.log_keyframes or args.log_stride or args.log_precision:
+            cl.celllog_options = {"keyframes": args.log_keyframes, "stride": args.log_stride, "precision": args.log_precision}
+    if grow:
+        checkpoint = None
+        if args.checkpoint:
+            checkpoint = cfn
         try:
-            cl.grow()
+            cl.grow(checkpoint=checkpoint, checkpoint_steps=args.checkpoint)
+            # the run finished, so there is nothing left to resume
+            if os.path.exists(cfn):
+                os.remove(cfn)
         finally:
             cl.write_log()
             cl.save_lattice(pfn)
@@ -800,6 +1126,14 @@ def run(args):
         pipeline_3d(args, cl)
     if args.pipeline_lasercutter:
         pipeline_lasercutter(args, cl)
-    if args.movie:
+    if args.pipeline_relief:
+        pipeline_relief(args, cl)
+    if args.movie and os.path.exists("cell_log.index"):
+        import sfgen
+        movie = sfgen.StreamMovie(args.name, fn=args.movie_file, stride=args.frame_stride, fps=args.fps, resolution=args.movie_size, workers=args.workers)
+        movie.run()
+    elif args.movie:
         movie = RenderMovie(args.name)
         movie.run()
+    # the curve plots may still be drawing
+    join_plots()
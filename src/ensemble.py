@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+import time
+import random
+
+NUMPY_ENABLED = True
+try:
+    import numpy as np
+except ImportError:
+    NUMPY_ENABLED = False
+
+# local
+from sfgen import *
+
+class EnsembleLattice(object):
+    """
+    Grows many lattices of the same size side by side, with every cell field
+    stacked into one (members, rows, columns) array, so a step is the same
+    handful of array operations for the whole ensemble as it is for one
+    lattice.  Each member has its own environment, held as a vector of
+    parameters, and each stops on its own once its headroom() fails, at
+    which point it is handed back as an ArrayLattice and dropped from the
+    arrays.
+
+    Every member is padded by one empty cell all around, which stands in for
+    the ghost cell of an ArrayLattice, so diffusion is a sum of shifted
+    views.  The frontier, which is all the freezing and attachment rules
+    touch, is worked on as a list of flat indices into the padded arrays.
+
+    The members step every cell of the lattice, as an ArrayLattice without a
+    halo does, and their noise is hashed from a seed of their own, so each
+    member grows exactly the snowflake an ArrayLattice with hashed_noise and
+    the same noise seed would.
+    """
+    Params = ("beta", "theta", "alpha", "kappa", "mu", "upsilon", "sigma")
+    # same order as CrystalLattice.get_neighbors(), as (dx, dy)
+    NeighborOffsets = ArrayLattice.NeighborOffsets
+
+    def __init__(self, size, environments, margin=None, max_steps=0, noise_seeds=None):
+        assert NUMPY_ENABLED, "the ensemble engine requires numpy."
+        if noise_seeds == None:
+            noise_seeds = [random.getrandbits(63) for env in environments]
+        self.size = size
+        self.margin = margin
+        self.max_steps = max_steps
+        self.iteration = 1
+        # a lattice to borrow the topology from, and to hand finished members back as
+        self.template = ArrayLattice(size, margin=margin, max_steps=max_steps)
+        self.divisor = self.template.divisor[:self.template.ncells].reshape(size, size)
+        self.points = self.template.points.astype(np.uint64).reshape(size, size)
+        self.width = width = size + 2
+        self.offsets = [dy * width + dx for (dx, dy) in self.NeighborOffsets]
+        # neighbors SnowflakeCell.attachment_step() sees after they have stepped
+        self.stepped = [dy < 0 or (dy == 0 and dx < 0) for (dx, dy) in self.NeighborOffsets]
+        self.members = range(len(environments))
+        self.environments = list(environments)
+        self.noise_seeds = list(noise_seeds)
+        # the padded cells snowflake_radius() casts its ray through
+        ray = []
+        radius = 0
+        while radius < size / 2.0:
+            radius += 1
+            (x, y) = self.template.polar_to_xy((135, radius))
+            ray.append((y + 1) * width + x + 1)
+        self.ray = np.array(ray)
+        self._init_cells()
+        self._init_params()
+
+    def inner(self, values):
+        """
+        The view of a padded field without its padding.
+        """
+        return values[:, 1:-1, 1:-1]
+
+    def shifted(self, values, offset):
+        """
+        The view of a padded field that holds the neighbor at offset of
+        every cell.
+        """
+        (dx, dy) = offset
+        return values[:, 1 + dy:self.width - 1 + dy, 1 + dx:self.width - 1 + dx]
+
+    def _init_cells(self):
+        shape = (len(self.members), self.width, self.width)
+        gamma = np.array([env.gamma for env in self.environments])
+        self.diffusive_mass = np.zeros(shape)
+        self.inner(self.diffusive_mass)[:] = gamma[:, np.newaxis, np.newaxis]
+        self.boundary_mass = np.zeros(shape)
+        self.crystal_mass = np.zeros(shape)
+        self.attached = np.zeros(shape, dtype=bool)
+        self.boundary = np.zeros(shape, dtype=bool)
+        self.age = np.zeros(shape, dtype=np.int64)
+        self.attached_count = np.zeros(shape, dtype=np.int8)
+        # the padding is never part of the lattice
+        self.padding = np.ones(shape, dtype=bool)
+        self.inner(self.padding)[:] = False
+        center = self.size / 2 + 1
+        self.crystal_mass[:, center, center] = 1
+        self.attached[:, center, center] = True
+        for offset in self.NeighborOffsets:
+            self.inner(self.attached_count)[:] += self.shifted(self.attached, offset)
+        self.inner(self.boundary)[:] = ~self.inner(self.attached) & (self.inner(self.attached_count) > 0)
+
+    def _init_params(self):
+        for key in self.Params:
+            setattr(self, key, np.array([env[key] for env in self.environments]))
+
+    def hashed_coins(self):
+        """
+        ArrayLattice.hashed_coins() for every cell of every member.
+        """
+        (m1, m2, m3) = (0x9E3779B97F4A7C15, np.uint64(0xBF58476D1CE4E5B9), np.uint64(0x94D049BB133111EB))
+        offsets = [(seed + self.iteration * m1) & 0xFFFFFFFFFFFFFFFF for seed in self.noise_seeds]
+        z = self.points + np.array(offsets, dtype=np.uint64)[:, np.newaxis, np.newaxis]
+        z *= np.uint64(m1)
+        z = (z ^ (z >> np.uint64(30))) * m2
+        z = (z ^ (z >> np.uint64(27))) * m3
+        z ^= z >> np.uint64(31)
+        return (z >> np.uint64(63)) == 1
+
+    def step(self):
+        """
+        One step of every member, the same rules as ArrayLattice.step_cells().
+        """
+        dm = self.diffusive_mass
+        flat_dm = dm.reshape(-1)
+        flat_attached = self.attached.reshape(-1)
+        live = ~self.inner(self.attached)
+        boundary = self.inner(self.boundary)
+        own = self.inner(dm)
+        # diffusion, with the frontier worked out again below, since it is
+        # the only place with attached neighbors
+        next_dm = own.copy()
+        for offset in self.NeighborOffsets:
+            next_dm += self.shifted(dm, offset)
+        frontier = np.flatnonzero(self.boundary.reshape(-1) & ~flat_attached)
+        (member, rest) = np.divmod(frontier, self.width * self.width)
+        (y, x) = np.divmod(rest, self.width)
+        f_own = flat_dm[frontier]
+        f_next = f_own.copy()
+        for offset in self.offsets:
+            nbrs = frontier + offset
+            f_next += np.where(flat_attached[nbrs], f_own, flat_dm[nbrs])
+        next_dm[member, y - 1, x - 1] = f_next
+        next_dm /= self.divisor
+        self.inner(self.age)[:] += live
+        new_dm = dm.copy()
+        flat_new = new_dm.reshape(-1)
+        np.copyto(self.inner(new_dm), next_dm, where=live)
+        # freezing
+        acount = self.attached_count.reshape(-1)[frontier]
+        frozen = flat_new[frontier]
+        bm = self.boundary_mass.reshape(-1)[frontier] + (1 - self.kappa[member]) * frozen
+        cm = self.crystal_mass.reshape(-1)[frontier] + (self.kappa[member] * frozen)
+        flags = ((acount <= 2) & (bm > self.beta[member])) | (acount >= 4)
+        # melting
+        flat_new[frontier] = 0.0 + (self.mu[member] * bm + self.upsilon[member] * cm)
+        # attachment
+        three = np.flatnonzero(acount == 3)
+        if len(three):
+            cells = frontier[three]
+            summed = np.zeros(len(cells))
+            for (offset, stepped) in zip(self.offsets, self.stepped):
+                if stepped:
+                    summed += flat_new[cells + offset]
+                else:
+                    summed += flat_dm[cells + offset]
+            (theta, alpha) = (self.theta[member[three]], self.alpha[member[three]])
+            flags[three] = (bm[three] >= 1) | ((summed < theta) & (bm[three] >= alpha))
+        self.boundary_mass.reshape(-1)[frontier] = (1 - self.mu[member]) * bm
+        self.crystal_mass.reshape(-1)[frontier] = (1 - self.upsilon[member]) * cm
+        # noise
+        sigma = self.sigma[:, np.newaxis, np.newaxis]
+        quiet = live & ~boundary
+        values = self.inner(new_dm)
+        noisy = np.where(self.hashed_coins(), (1 - sigma) * values, (1 + sigma) * values)
+        np.copyto(values, noisy, where=quiet)
+        self.diffusive_mass = new_dm
+        self.attach(frontier[flags])
+        self.iteration += 1
+        # run curves
+        curves = False
+        for env in self.environments:
+            if env.curves != None:
+                env.step(self.iteration)
+                curves = True
+        if curves:
+            self._init_params()
+
+    def attach(self, cells):
+        if not len(cells):
+            return
+        crystal_mass = self.crystal_mass.reshape(-1)
+        boundary_mass = self.boundary_mass.reshape(-1)
+        attached = self.attached.reshape(-1)
+        crystal_mass[cells] = boundary_mass[cells] + crystal_mass[cells] + 0.0
+        boundary_mass[cells] = 0
+        attached[cells] = True
+        # recount around the new cells, and mark their neighbors as boundary
+        touched = np.unique(np.concatenate([cells + offset for offset in self.offsets]))
+        touched = touched[~self.padding.reshape(-1)[touched]]
+        counts = np.zeros(len(touched), dtype=np.int8)
+        for offset in self.offsets:
+            counts += attached[touched + offset]
+        self.attached_count.reshape(-1)[touched] = counts
+        self.boundary.reshape(-1)[touched[~attached[touched]]] = True
+
+    def snowflake_radius(self):
+        """
+        CrystalLattice.snowflake_radius() of every member.
+        """
+        edge = self.attached.reshape(len(self.members), -1)[:, self.ray] | self.boundary.reshape(len(self.members), -1)[:, self.ray]
+        radius = np.argmin(edge, axis=1) + 1
+        return np.where(edge.all(axis=1), int(round(self.size / 2.0)), radius)
+
+    def headroom(self):
+        """
+        CrystalLattice.headroom() of every member.
+        """
+        if self.max_steps and self.iteration >= self.max_steps:
+            return np.zeros(len(self.members), dtype=bool)
+        cutoff = int(round(self.margin * (self.size / 2.0)))
+        return self.snowflake_radius() <= cutoff
+
+    def lattice(self, idx):
+        """
+        Member idx, counting the current members, as an ArrayLattice.
+        """
+        header = self.template.lattice_header()
+        header["iteration"] = self.iteration
+        header["environment"] = self.environments[idx]
+        header["noise_seed"] = self.noise_seeds[idx]
+        header["far_field"] = self.environments[idx].gamma
+        fields = {}
+        for key in ArrayLattice.CellFields:
+            fields[key] = self.inner(getattr(self, key))[idx].ravel()
+        return ArrayLattice.from_fields(header, fields)
+
+    def drop(self, keep):
+        for key in ("diffusive_mass", "boundary_mass", "crystal_mass", "attached", "boundary", "age", "attached_count", "padding"):
+            setattr(self, key, getattr(self, key)[keep])
+        self.members = [self.members[idx] for idx in keep]
+        self.environments = [self.environments[idx] for idx in keep]
+        self.noise_seeds = [self.noise_seeds[idx] for idx in keep]
+        self._init_params()
+
+    def grow(self, callback=None):
+        """
+        Grow until every member has stopped.  Each member is passed to
+        callback, as (member number, ArrayLattice), as soon as it stops, and
+        the finished lattices are returned in member order.
+        """
+        finished = {}
+        total = len(self.members)
+        start = time.time()
+        while self.members:
+            self.step()
+            if self.iteration % 50 != 0:
+                continue
+            ok = self.headroom()
+            keep = list(np.flatnonzero(ok))
+            for idx in np.flatnonzero(~ok):
+                lattice = self.lattice(idx)
+                finished[self.members[idx]] = lattice
+                if callback != None:
+                    callback(self.members[idx], lattice)
+            if len(keep) < len(self.members):
+                self.drop(keep)
+            minutes = (time.time() - start) / 60.0
+            msg = "Step #%d, %d of %d flakes done, %.1f flakes per minute" % (self.iteration, len(finished), total, len(finished) / max(minutes, 1e-6))
+            log(msg)
+        return [finished[idx] for idx in sorted(finished)]
@@ -9,6 +9,7 @@ import os
 import sys
 import re
 import colorsys
+import collections
 from xml.dom.minidom import parse
 
 try:
@@ -18,18 +19,49 @@ except ImportError:
     from PIL import Image
     from PIL import ImageDraw
 
+NUMPY_ENABLED = True
+try:
+    import numpy as np
+except ImportError:
+    NUMPY_ENABLED = False
+
 from sfgen import *
 
 class ColorScheme(object):
+    """
+    Maps cells to RGB colors.  A scheme colors one cell at a time with
+    __call__, and every cell of the lattice at once with batch, which is
+    what RenderSnowflake uses when numpy is around.  Schemes that only
+    implement __call__ are batched one cell at a time.
+    """
     Name = "__ColorScheme__"
 
     def __init__(self, lattice):
         self.lattice = lattice
-        self.cells = self.lattice.cells
+
+    @property
+    def cells(self):
+        return self.lattice.cells
 
     def __call__(self, cell, **kw):
         pass
 
+    def batch(self, fields, **kw):
+        """
+        Color every cell from a dict of cell field arrays, as returned by
+        lattice.cell_fields(), into an (n, 3) uint8 array.
+        """
+        cells = getattr(self.lattice, "cells", None)
+        if cells == None:
+            # the array engines and replay frames have no cell objects, so
+            # build them from the fields
+            import sfgen
+            header = self.lattice.lattice_header()
+            if header["environment"] == None:
+                header["environment"] = sfgen.CrystalEnvironment()
+            cells = sfgen.CrystalLattice.from_fields(header, fields).cells
+        return np.array([self(cell, **kw) for cell in cells], dtype=np.uint8)
+
 class Grayscale(ColorScheme):
     Name = "grayscale"
 
@@ -46,6 +78,11 @@ class Grayscale(ColorScheme):
         color = (color, color, color)
         return color
 
+    def batch(self, fields, **kw):
+        mass = np.where(fields["attached"], fields["crystal_mass"], fields["diffusive_mass"])
+        color = np.minimum(255, (200 * mass).astype(int)).astype(np.uint8)
+        return np.repeat(color[:, np.newaxis], 3, axis=1)
+
 class BlackWhite(ColorScheme):
     Name = "blackwhite"
 
@@ -59,12 +96,87 @@ class BlackWhite(ColorScheme):
             color = (0xFF, 0xFF, 0xFF)
         return color
 
+    def batch(self, fields, **kw):
+        mask = np.asarray(fields["attached"], dtype=bool)
+        if self.boundary:
+            mask = mask | np.asarray(fields["boundary"], dtype=bool)
+        color = np.where(mask, 0xFF, 0).astype(np.uint8)
+        return np.repeat(color[:, np.newaxis], 3, axis=1)
+
 class Colorful(ColorScheme):
     Name = "colorful"
 
     def __call__(self, cell, **kw):
         return tuple([int(round(x * 0xff)) for x in colorsys.hsv_to_rgb(cell.age / float(self.lattice.iteration), 1, 1)])
 
+    def batch(self, fields, **kw):
+        # colorsys.hsv_to_rgb() with full saturation and value
+        hue = np.asarray(fields["age"]) / float(self.lattice.iteration)
+        sector = (hue * 6.0).astype(int)
+        f = (hue * 6.0) - sector
+        (p, q, t, v) = (np.zeros_like(f), 1.0 - f, 1.0 - (1.0 - f), np.ones_like(f))
+        sector = sector % 6
+        rgb = np.empty((len(hue), 3))
+        for (idx, channels) in enumerate([(v, t, p), (q, v, p), (p, v, t), (p, q, v), (t, p, v), (v, p, q)]):
+            mask = sector == idx
+            for channel in range(3):
+                rgb[mask, channel] = channels[channel][mask]
+        # round half away from zero, like round()
+        return np.floor(rgb * 0xff + 0.5).astype(np.uint8)
+
+def quantize(values, levels, bins=256):
+    """
+    Split values into levels groups, as one dimensional k-means would, and
+    return the levels - 1 thresholds between them, lowest first.  The
+    values are read once, into a histogram of bins buckets, and the best
+    split of the buckets is found exactly by dynamic programming, so the
+    answer is the same every time, and needs neither numpy nor scipy.
+    """
+    (lo, hi) = (min(values), max(values))
+    if levels < 2 or hi <= lo:
+        return []
+    scale = bins / float(hi - lo)
+    counts = [0] * bins
+    sums = [0.0] * bins
+    squares = [0.0] * bins
+    for value in values:
+        idx = min(int((value - lo) * scale), bins - 1)
+        counts[idx] += 1
+        sums[idx] += value
+        squares[idx] += value * value
+    # running totals, so the spread of any run of buckets is a subtraction
+    (count_to, sum_to, square_to) = ([0], [0.0], [0.0])
+    for idx in range(bins):
+        count_to.append(count_to[-1] + counts[idx])
+        sum_to.append(sum_to[-1] + sums[idx])
+        square_to.append(square_to[-1] + squares[idx])
+    def spread(start, end):
+        count = count_to[end] - count_to[start]
+        if count == 0:
+            return 0.0
+        total = sum_to[end] - sum_to[start]
+        return (square_to[end] - square_to[start]) - total * total / count
+    # best[end] is the least spread of the first end buckets in as many
+    # groups as there have been passes, and splits[level][end] where the
+    # last of those groups starts
+    best = [spread(0, end) for end in range(bins + 1)]
+    splits = []
+    for level in range(1, levels):
+        (last, best) = (best, [float("inf")] * (bins + 1))
+        split = [0] * (bins + 1)
+        for end in range(level + 1, bins + 1):
+            for start in range(level, end):
+                cost = last[start] + spread(start, end)
+                if cost < best[end]:
+                    (best[end], split[end]) = (cost, start)
+        splits.append(split)
+    thresholds = []
+    end = bins
+    for split in reversed(splits):
+        end = split[end]
+        thresholds.append(lo + end / scale)
+    return thresholds[::-1]
+
 class LaserScheme(ColorScheme):
     Name = "laser"
 
@@ -81,40 +193,164 @@ class LaserScheme(ColorScheme):
         self.layer = layer
 
     def _init_clusters(self):
-        import scipy.cluster.vq
-        import numpy
-        acells = [cell for cell in self.cells if cell and cell.attached]
-        fm = [cell.crystal_mass for cell in acells]
-        clusters = scipy.cluster.vq.kmeans2(numpy.array(fm), self.layers)
-        cluster_map = clusters[1]
-        self._layer_cache = {cell.xy: cluster for (cell, cluster) in zip(acells, cluster_map)}
+        # the layer of every cell, -1 for cells outside the crystal
+        self._layer_cache = self.lattice.crystal_layers(self.layers)
+        if NUMPY_ENABLED:
+            self._layer_cache = np.asarray(self._layer_cache, dtype=int)
 
     def __call__(self, cell, layer=None, **kw):
         if layer == None:
             layer = self.layer
-        if cell.xy in self._layer_cache and self._layer_cache[cell.xy] == layer:
+        if self._layer_cache[self.lattice._cell_index(cell.xy)] == layer:
             return self.scheme(cell, **kw)
         return (0, 0, 0)
 
+    def batch(self, fields, layer=None, **kw):
+        if layer == None:
+            layer = self.layer
+        colors = self.scheme.batch(fields, **kw)
+        colors[self._layer_cache != layer] = 0
+        return colors
+
+    def cell_layers(self, fields, **kw):
+        """
+        The layer of every cell the underlying scheme lights up, and -1 for
+        the rest, as an array.
+        """
+        lit = self.scheme.batch(fields, **kw).any(axis=1)
+        return np.where(lit, self._layer_cache, -1)
+
+class HexResampler(object):
+    """
+    Maps every pixel of an output image straight to the hex cell under it.
+
+    The image covers box, in the frame that save_image() has always cropped
+    in: the lattice turned 45 degrees and squeezed by X_SCALE_FACTOR, which
+    puts the three lattice axes 60 degrees apart with equal spacing.  Each
+    pixel center is taken back to lattice coordinates and rounded to the
+    nearest cell in cube coordinates, so the image is one gather through a
+    table of cell indices, with no resampling blur.  Pixels off the lattice
+    point one past the last cell, where render() puts black.
+
+    Tables are kept for the last few (size, resolution, box) asked for,
+    since a movie or a stack of layers reuses the same one.
+    """
+    CacheSize = 16
+    _cache = collections.OrderedDict()
+
+    def __init__(self, size, resolution, box):
+        self.size = size
+        self.resolution = resolution
+        self.box = box
+        self.table = self._build_table()
+
+    @classmethod
+    def get(cls, size, resolution, box):
+        key = (size, tuple(resolution), tuple(box))
+        if key in cls._cache:
+            resampler = cls._cache.pop(key)
+        else:
+            resampler = cls(*key)
+            while len(cls._cache) >= cls.CacheSize:
+                cls._cache.popitem(last=False)
+        cls._cache[key] = resampler
+        return resampler
+
+    def _build_table(self):
+        (width, height) = self.resolution
+        (x0, y0, x1, y1) = self.box
+        size = self.size
+        # pixel centers in the turned and squeezed frame, around its center
+        px = x0 + (np.arange(width) + 0.5) * (x1 - x0) / float(width)
+        py = y0 + (np.arange(height) + 0.5) * (y1 - y0) / float(height)
+        dx = px[np.newaxis, :] - round(size * X_SCALE_FACTOR) / 2.0
+        dy = py[:, np.newaxis] - size / 2.0
+        # lattice axes (1, 0) and (0, 1) land on (a, -b) and (a, b)
+        a = X_SCALE_FACTOR * math.sqrt(0.5)
+        b = math.sqrt(0.5)
+        x = (dx / a - dy / b) / 2.0 + (size - 1) / 2.0
+        y = (dx / a + dy / b) / 2.0 + (size - 1) / 2.0
+        # round to the nearest hex cell, in cube coordinates (x, -y, y - x)
+        cube = [x, -y, y - x]
+        rounded = [np.round(c) for c in cube]
+        error = [np.abs(r - c) for (r, c) in zip(rounded, cube)]
+        fix_x = (error[0] > error[1]) & (error[0] > error[2])
+        fix_y = ~fix_x & (error[1] > error[2])
+        rounded[0] = np.where(fix_x, -rounded[1] - rounded[2], rounded[0])
+        rounded[1] = np.where(fix_y, -rounded[0] - rounded[2], rounded[1])
+        cx = rounded[0].astype(int)
+        cy = (-rounded[1]).astype(int)
+        table = cy * size + cx
+        outside = (cx < 0) | (cx >= size) | (cy < 0) | (cy >= size)
+        table[outside] = size * size
+        return table.ravel()
+
+    def gather(self, values):
+        """
+        The value of the cell under every pixel, from an array of cell
+        values, as a (height, width, ...) array with zeros off the lattice.
+        """
+        (width, height) = self.resolution
+        values = np.concatenate([values, np.zeros((1,) + values.shape[1:], dtype=values.dtype)])
+        return values[self.table].reshape((height, width) + values.shape[1:])
+
+    def render(self, colors):
+        """
+        Build the image from an (n, 3) uint8 array of cell colors.
+        """
+        content = np.ascontiguousarray(self.gather(colors))
+        return Image.frombuffer("RGB", self.resolution, content, "raw", "RGB", 0, 1)
+
 class RenderSnowflake(object):
     ColorSchemes = {cls.Name: cls for cls in globals().values() if type(cls) == type and issubclass(cls, ColorScheme) and cls != ColorScheme}
 
     def __init__(self, lattice):
         self.lattice = lattice
-        self.cells = self.lattice.cells
 
     def save_layer(self, fn, scheme, layer, **kw):
         scheme.select_layer(layer)
         self.save_image(fn, scheme=scheme, **kw)
 
-    def save_layers(self, fn, layers, scheme=None, **kw):
+    def _layer_pixels(self, scheme, crop=True, resize=None, margin=None):
+        """
+        The colors of every layer of a LaserScheme, and the layer under
+        every pixel, -1 where there is none, from one resampling.
+        """
+        fields = {key: np.asarray(values) for (key, values) in self.lattice.cell_fields().items()}
+        resampler = self.resampler(crop=crop, resize=resize, margin=margin)
+        colors = resampler.gather(np.asarray(scheme.scheme.batch(fields), dtype=np.uint8))
+        layers = resampler.gather(scheme.cell_layers(fields) + 1) - 1
+        return (colors, layers)
+
+    def render_layers(self, layers, scheme=None, crop=True, resize=None, margin=None):
+        """
+        Every layer of a LaserScheme, as a list of (height, width) masks, as
+        render_mask() would give for each layer, at the cost of one.
+        """
+        if scheme == None:
+            scheme = LaserScheme(self.lattice, layers)
+        (colors, pixels) = self._layer_pixels(scheme, crop=crop, resize=resize, margin=margin)
+        return [pixels == layer for layer in range(layers)]
+
+    def save_layers(self, fn, layers, scheme=None, overwrite=True, rotate=True, scale=True, **kw):
         if scheme == None:
             scheme = LaserScheme(self.lattice, layers)
-        fnlist = []
-        for layer in range(layers):
-            _fn = fn % layer
-            fnlist.append(_fn)
-            self.save_layer(_fn, scheme, layer, **kw)
+        fnlist = [fn % layer for layer in range(layers)]
+        if not (NUMPY_ENABLED and rotate and scale):
+            for (layer, _fn) in enumerate(fnlist):
+                self.save_layer(_fn, scheme, layer, overwrite=overwrite, rotate=rotate, scale=scale, **kw)
+            return fnlist
+        # resample once, and cut every layer out of the same pixels
+        (colors, pixels) = self._layer_pixels(scheme, **kw)
+        (height, width) = pixels.shape
+        for (layer, _fn) in enumerate(fnlist):
+            if not overwrite and os.path.exists(_fn):
+                continue
+            msg = "Saving %s..." % _fn
+            log(msg)
+            content = np.ascontiguousarray(np.where((pixels == layer)[:, :, np.newaxis], colors, 0), dtype=np.uint8)
+            img = Image.frombuffer("RGB", (width, height), content, "raw", "RGB", 0, 1)
+            img.save(_fn)
         return fnlist
 
     def save_image(self, fn, scheme=None, overwrite=True, rotate=True, scale=True, crop=True, resize=None, margin=None):
@@ -125,9 +361,20 @@ class RenderSnowflake(object):
             #scheme = Colorful(self.lattice)
         msg = "Saving %s..." % fn
         log(msg)
-        content = str.join('', [str.join('', map(chr, scheme(cell))) for cell in self.cells])
-        img = Image.new("RGB", (self.lattice.size, self.lattice.size))
-        img.frombytes(content)
+        size = (self.lattice.size, self.lattice.size)
+        if NUMPY_ENABLED:
+            fields = {key: np.asarray(values) for (key, values) in self.lattice.cell_fields().items()}
+            content = np.ascontiguousarray(scheme.batch(fields), dtype=np.uint8)
+            if rotate and scale:
+                # straight from the hex cells to the output pixels
+                img = self.resample(content, crop=crop, resize=resize, margin=margin)
+                img.save(fn)
+                return
+            img = Image.frombuffer("RGB", size, content, "raw", "RGB", 0, 1)
+        else:
+            content = str.join('', [str.join('', map(chr, scheme(cell))) for cell in self.lattice.cells])
+            img = Image.new("RGB", size)
+            img.frombytes(content)
         del content
 
         # post-process
@@ -143,3 +390,34 @@ class RenderSnowflake(object):
                 print "WARNING: image after resize is not square."
             img = img.resize((resize, resize))
         img.save(fn)
+
+    def frame(self, crop=True, resize=None, margin=None):
+        """
+        The (resolution, box) of the image save_image() would save.
+        """
+        size = self.lattice.size
+        box = (0, 0, int(round(size * X_SCALE_FACTOR)), size)
+        if crop:
+            box = self.lattice.crop_snowflake(margin=margin)
+        resolution = (box[2] - box[0], box[3] - box[1])
+        if resize:
+            if resolution[0] != resolution[1]:
+                print "WARNING: image after resize is not square."
+            resolution = (resize, resize)
+        return (resolution, box)
+
+    def resampler(self, crop=True, resize=None, margin=None):
+        (resolution, box) = self.frame(crop=crop, resize=resize, margin=margin)
+        return HexResampler.get(self.lattice.size, resolution, box)
+
+    def resample(self, colors, crop=True, resize=None, margin=None):
+        return self.resampler(crop=crop, resize=resize, margin=margin).render(colors)
+
+    def render_mask(self, scheme, crop=True, resize=None, margin=None, **kw):
+        """
+        The image save_image() would save with scheme, as a (height, width)
+        array that is True wherever the image isn't black, for tracing.
+        """
+        fields = {key: np.asarray(values) for (key, values) in self.lattice.cell_fields().items()}
+        lit = scheme.batch(fields, **kw).any(axis=1)
+        return self.resampler(crop=crop, resize=resize, margin=margin).gather(lit)
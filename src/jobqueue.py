@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+
+import os
+import time
+import errno
+import select
+import signal
+import socket
+import sqlite3
+import logging
+import threading
+import multiprocessing
+import cPickle as pickle
+
+# local
+from sfgen import *
+
+SERVER_DIR = os.environ.get("SFGEN_SERVER_DIR", "/tmp/snowflake_server")
+
+class JobQueue(object):
+    """
+    A job queue in one sqlite file, that any number of processes on the same
+    machine can push to and pull from.  A pulled job is leased to its worker
+    for lease seconds, and the worker keeps the lease alive with heartbeats
+    while the job runs.  A job whose lease runs out, because its worker died
+    or hung, goes back on the queue, as does a job that failed, until it has
+    been tried max_attempts times.
+
+    Pushing a job also writes a byte to a fifo next to the database, which
+    wakes up a waiting worker, so idle workers don't poll.
+    """
+    Schema = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            queue TEXT,
+            name TEXT,
+            job BLOB,
+            state TEXT,
+            attempts INTEGER DEFAULT 0,
+            max_attempts INTEGER,
+            worker TEXT,
+            lease_expires REAL,
+            created REAL,
+            started REAL,
+            finished REAL,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (queue, state, id);
+    """
+
+    def __init__(self, fn=None):
+        if fn == None:
+            fn = os.path.join(SERVER_DIR, "queue.db")
+        self.fn = fn
+        self.fifo = "%s.wake" % fn
+        path = os.path.dirname(os.path.abspath(fn))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if not os.path.exists(self.fifo):
+            try:
+                os.mkfifo(self.fifo)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+        db = self.connect()
+        try:
+            db.executescript(self.Schema)
+        finally:
+            db.close()
+
+    def connect(self):
+        # one connection per call, so any thread can use the queue
+        db = sqlite3.connect(self.fn, timeout=60, isolation_level=None)
+        db.text_factory = str
+        return db
+
+    def _transaction(self, func, *args):
+        db = self.connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(db, *args)
+            except:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+            return result
+        finally:
+            db.close()
+
+    def push(self, queue, name, job, max_attempts=3):
+        def push(db):
+            sql = "INSERT INTO jobs (queue, name, job, state, max_attempts, created) VALUES (?, ?, ?, 'pending', ?, ?)"
+            return db.execute(sql, (queue, name, sqlite3.Binary(pickle.dumps(job, protocol=-1)), max_attempts, time.time())).lastrowid
+        jobid = self._transaction(push)
+        self.wake()
+        return jobid
+
+    def wake(self):
+        try:
+            fd = os.open(self.fifo, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError, err:
+            # nobody is waiting
+            if err.errno == errno.ENXIO:
+                return
+            raise
+        try:
+            os.write(fd, "\n")
+        except OSError, err:
+            if err.errno != errno.EAGAIN:
+                raise
+        finally:
+            os.close(fd)
+
+    def _expire(self, db):
+        now = time.time()
+        sql = "UPDATE jobs SET state = CASE WHEN attempts < max_attempts THEN 'pending' ELSE 'failed' END, worker = NULL, error = 'lease expired' WHERE state = 'running' AND lease_expires < ?"
+        if db.execute(sql, (now,)).rowcount:
+            msg = "Requeued jobs with expired leases"
+            log(msg)
+
+    def pull(self, queue, worker, lease):
+        """
+        Lease the oldest pending job on queue to worker, as (id, job), or
+        None when there is nothing to do.
+        """
+        def pull(db):
+            self._expire(db)
+            row = db.execute("SELECT id, job FROM jobs WHERE queue = ? AND state = 'pending' ORDER BY id LIMIT 1", (queue,)).fetchone()
+            if row == None:
+                return None
+            now = time.time()
+            sql = "UPDATE jobs SET state = 'running', worker = ?, attempts = attempts + 1, lease_expires = ?, started = ? WHERE id = ?"
+            db.execute(sql, (worker, now + lease, now, row[0]))
+            return (row[0], pickle.loads(str(row[1])))
+        return self._transaction(pull)
+
+    def heartbeat(self, jobid, worker, lease):
+        """
+        Extend the lease on a job.  Returns False when the job is no longer
+        leased to worker.
+        """
+        def heartbeat(db):
+            sql = "UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND state = 'running'"
+            return db.execute(sql, (time.time() + lease, jobid, worker)).rowcount == 1
+        return self._transaction(heartbeat)
+
+    def finish(self, jobid, worker, error=None):
+        """
+        Mark a job done, or with an error, put it back on the queue if it has
+        attempts left.
+        """
+        def finish(db):
+            if error == None:
+                sql = "UPDATE jobs SET state = 'done', finished = ?, error = NULL WHERE id = ? AND worker = ?"
+                db.execute(sql, (time.time(), jobid, worker))
+                return
+            sql = "UPDATE jobs SET state = CASE WHEN attempts < max_attempts THEN 'pending' ELSE 'failed' END, worker = NULL, finished = ?, error = ? WHERE id = ? AND worker = ?"
+            db.execute(sql, (time.time(), error, jobid, worker))
+        self._transaction(finish)
+        if error != None:
+            self.wake()
+
+    def release(self, jobid, worker):
+        """
+        Hand a job back without counting the attempt, for a worker shutting
+        down.
+        """
+        def release(db):
+            sql = "UPDATE jobs SET state = 'pending', worker = NULL, attempts = attempts - 1 WHERE id = ? AND worker = ? AND state = 'running'"
+            db.execute(sql, (jobid, worker))
+        self._transaction(release)
+        self.wake()
+
+    def counts(self, queue):
+        db = self.connect()
+        try:
+            return dict(db.execute("SELECT state, COUNT(*) FROM jobs WHERE queue = ? GROUP BY state", (queue,)).fetchall())
+        finally:
+            db.close()
+
+class SnowflakeJob(object):
+    """
+    Grows one snowflake, with the settings of the snowflake command.  By
+    default that's a curves snowflake with a data log, as the worker fleet
+    always grew them, checkpointed every Checkpoint steps so a retry picks
+    up where the last attempt left off.
+    """
+    Checkpoint = 500
+
+    def __init__(self, name, size=200, **settings):
+        self.name = name
+        self.settings = {"size": size, "curves": True, "datalog": True, "checkpoint": self.Checkpoint}
+        self.settings.update(settings)
+        self.settings["name"] = name
+
+    def __repr__(self):
+        return "SnowflakeJob(%r)" % self.name
+
+    def execute(self, root):
+        grow_job(reset_job(self.settings, root), root)
+
+def _logging_handlers():
+    return [handler for handler in logging.getLogger().handlers if handler.lock != None]
+
+def _acquire_logging():
+    logging._acquireLock()
+    for handler in _logging_handlers():
+        handler.acquire()
+
+def _release_logging():
+    for handler in reversed(_logging_handlers()):
+        handler.release()
+    logging._releaseLock()
+
+def _start_job(job, root):
+    """
+    Fork a process for job.  The other slots and the listener keep logging
+    while it forks, and a child forked while one of them is inside log()
+    would inherit that logging lock taken and hang on its own first log(),
+    so every logging lock is held across the fork.  The child lets go of its
+    copies in _execute().
+    """
+    _acquire_logging()
+    try:
+        proc = multiprocessing.Process(target=_execute, args=(job, root))
+        proc.start()
+    finally:
+        _release_logging()
+    return proc
+
+def _execute(job, root):
+    _release_logging()
+    # the job runs in a process of its own, so a crash can't take the worker with it
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    job.execute(root)
+
+class SnowflakeMaster(object):
+    def __init__(self, fn=None, queue="snowflake"):
+        self.queue = JobQueue(fn)
+        self.name = queue
+
+    def add_work(self, name, size=200, max_attempts=3, **settings):
+        job = SnowflakeJob(name, size=size, **settings)
+        return self.queue.push(self.name, name, job, max_attempts=max_attempts)
+
+class SnowflakeServer(object):
+    """
+    Runs jobs from the queue, one per slot, with as many slots as there are
+    cores by default.  Each job runs in a forked process in a directory of
+    its own under root.  Idle slots sleep until a job is pushed, or until
+    it is time to look for jobs whose leases have run out.  A job that was
+    cut short resumes from its checkpoint when it is retried.
+
+    On SIGINT or SIGTERM the server stops its jobs and hands them back to
+    the queue.
+    """
+    Lease = 60
+    Heartbeat = 15
+
+    def __init__(self, fn=None, queue="snowflake", root=SERVER_DIR, slots=None):
+        self.queue = JobQueue(fn)
+        self.name = queue
+        self.root = os.path.abspath(root)
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self.slots = slots or multiprocessing.cpu_count()
+        self.worker = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.running = True
+        self.wakeup = threading.Condition()
+        msg = "SnowflakeServer %s started with %d slots." % (self.worker, self.slots)
+        log(msg)
+
+    def stop(self, *args):
+        self.running = False
+        with self.wakeup:
+            self.wakeup.notify_all()
+
+    def listen(self):
+        """
+        Wake the idle slots whenever a job is pushed.
+        """
+        fd = os.open(self.queue.fifo, os.O_RDONLY | os.O_NONBLOCK)
+        # holding the write end open ourselves keeps the fifo from reading
+        # as closed between writers
+        keep = os.open(self.queue.fifo, os.O_WRONLY)
+        try:
+            while self.running:
+                (ready, _, _) = select.select([fd], [], [], self.Heartbeat)
+                if not ready:
+                    continue
+                try:
+                    os.read(fd, 4096)
+                except OSError, err:
+                    if err.errno != errno.EAGAIN:
+                        raise
+                with self.wakeup:
+                    self.wakeup.notify_all()
+        finally:
+            os.close(keep)
+            os.close(fd)
+
+    def run_job(self, jobid, job):
+        msg = "Executing %r" % job
+        log(msg)
+        start = time.time()
+        proc = _start_job(job, self.root)
+        while True:
+            proc.join(self.Heartbeat)
+            if proc.exitcode != None:
+                break
+            if not self.running:
+                proc.terminate()
+                proc.join()
+                self.queue.release(jobid, self.worker)
+                msg = "Handed %r back" % job
+                log(msg)
+                return
+            if not self.queue.heartbeat(jobid, self.worker, self.Lease):
+                # someone else may have the job by now, so leave it to them
+                proc.terminate()
+                proc.join()
+                msg = "Lost the lease on %r, stopped it" % job
+                log(msg)
+                return
+        error = None
+        if proc.exitcode != 0:
+            error = "exit code %d" % proc.exitcode
+        self.queue.finish(jobid, self.worker, error)
+        msg = "%r %s in %.1fs" % (job, error or "finished", time.time() - start)
+        log(msg)
+
+    def slot(self):
+        while self.running:
+            work = self.queue.pull(self.name, self.worker, self.Lease)
+            if work != None:
+                self.run_job(*work)
+                continue
+            with self.wakeup:
+                if self.running:
+                    # leases run out without anyone pushing, so look again now and then
+                    self.wakeup.wait(self.Lease / 2)
+
+    def loop(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        threads = [threading.Thread(target=self.listen)]
+        threads += [threading.Thread(target=self.slot) for idx in range(self.slots)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                # a join with a timeout leaves the main thread free for signals
+                thread.join(3600)
+        msg = "SnowflakeServer %s stopped." % self.worker
+        log(msg)
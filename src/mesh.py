@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+
+import os
+import math
+import struct
+
+NUMPY_ENABLED = True
+try:
+    import numpy as np
+except ImportError:
+    NUMPY_ENABLED = False
+
+# local
+from sfgen import *
+
+if NUMPY_ENABLED:
+    # one binary STL facet
+    STL_FACET = np.dtype([("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attribute", "<u2")])
+
+class StlWriter(object):
+    """
+    Writes triangles into a binary STL a batch at a time, so a mesh never
+    has to be held whole.  The triangle count in the header is filled in on
+    close().
+    """
+    def __init__(self, fn, header="sfgen"):
+        self.fn = fn
+        self.count = 0
+        self.f = open(fn, 'wb')
+        self.f.write(header[:80].ljust(80, ' '))
+        self.f.write(struct.pack("<I", 0))
+
+    def write(self, triangles):
+        """
+        Write an (n, 3, 3) array of triangles, each wound counter-clockwise
+        seen from outside.
+        """
+        triangles = np.asarray(triangles, dtype=float).reshape(-1, 3, 3)
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        length = np.sqrt((normals ** 2).sum(axis=1))
+        normals /= np.where(length > 0, length, 1)[:, np.newaxis]
+        facets = np.zeros(len(triangles), dtype=STL_FACET)
+        facets["normal"] = normals
+        facets["vertices"] = triangles
+        self.f.write(facets.tostring())
+        self.count += len(triangles)
+
+    def close(self):
+        self.f.seek(80)
+        self.f.write(struct.pack("<I", self.count))
+        self.f.close()
+
+def save_stl(fn, batches):
+    """
+    Write every batch of triangles from batches into a binary STL, and
+    return the number of triangles.
+    """
+    stl = StlWriter(fn)
+    try:
+        for triangles in batches:
+            stl.write(triangles)
+    finally:
+        stl.close()
+    return stl.count
+
+def _cross(o, a, b):
+    return (a[..., 0] - o[..., 0]) * (b[..., 1] - o[..., 1]) - (a[..., 1] - o[..., 1]) * (b[..., 0] - o[..., 0])
+
+def _crosses(a, b, starts, ends):
+    """
+    Whether segment a-b properly crosses any of the segments starts-ends.
+    """
+    d1 = _cross(starts, ends, a)
+    d2 = _cross(starts, ends, b)
+    d3 = _cross(a, b, starts)
+    d4 = _cross(a, b, ends)
+    crossed = (((d1 > 0) & (d2 < 0)) | ((d1 < 0) & (d2 > 0))) & (((d3 > 0) & (d4 < 0)) | ((d3 < 0) & (d4 > 0)))
+    return bool(crossed.any())
+
+def inside_polygon(point, polygon):
+    """
+    Whether point is inside polygon, an (n, 2) array, by the even-odd rule.
+    """
+    (x, y) = point
+    (x0, y0) = (polygon[:, 0], polygon[:, 1])
+    (x1, y1) = (np.roll(x0, -1), np.roll(y0, -1))
+    span = (y0 > y) != (y1 > y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+    return bool((span & (x < cross)).sum() % 2)
+
+def bridge_holes(outer, holes):
+    """
+    Join the holes to the counter-clockwise outer polygon, each along a
+    bridge that crosses no edge, into one polygon that ear clipping can
+    take.  Holes run clockwise.
+    """
+    polygon = outer
+    holes = sorted(holes, key=lambda hole: -hole[:, 0].max())
+    for (number, hole) in enumerate(holes):
+        start = int(np.argmax(hole[:, 0]))
+        point = hole[start]
+        edges = [polygon] + holes[number:]
+        starts = np.vstack(edges)
+        ends = np.vstack([np.roll(edge, -1, axis=0) for edge in edges])
+        # the nearest vertex that can be seen from the hole
+        order = np.argsort(((polygon - point) ** 2).sum(axis=1))
+        target = order[0]
+        for idx in order:
+            if not _crosses(point, polygon[idx], starts, ends):
+                target = idx
+                break
+        hole = np.vstack([hole[start:], hole[:start + 1]])
+        polygon = np.vstack([polygon[:target + 1], hole, polygon[target:]])
+    return polygon
+
+def triangulate_polygon(polygon):
+    """
+    Ear clip a counter-clockwise polygon, an (n, 2) array, into a list of
+    index triples into it.  A polygon that runs out of ears isn't simple,
+    and raises ValueError.
+    """
+    count = len(polygon)
+    nxt = range(1, count) + [0]
+    prv = [count - 1] + range(count - 1)
+    alive = np.ones(count, dtype=bool)
+    (xs, ys) = (polygon[:, 0], polygon[:, 1])
+    triangles = []
+    idx = 0
+    remaining = count
+    misses = 0
+    while remaining > 3:
+        (a, b, c) = (prv[idx], idx, nxt[idx])
+        (pa, pb, pc) = (polygon[a], polygon[b], polygon[c])
+        ear = _cross(pa, pb, pc) >= 0
+        if ear:
+            # no vertex of what is left may be inside the ear
+            d1 = (pb[0] - pa[0]) * (ys - pa[1]) - (pb[1] - pa[1]) * (xs - pa[0])
+            d2 = (pc[0] - pb[0]) * (ys - pb[1]) - (pc[1] - pb[1]) * (xs - pb[0])
+            d3 = (pa[0] - pc[0]) * (ys - pc[1]) - (pa[1] - pc[1]) * (xs - pc[0])
+            ear = not (alive & (d1 > 0) & (d2 > 0) & (d3 > 0)).any()
+        if not ear:
+            if misses >= remaining:
+                raise ValueError("polygon isn't simple, it has no ear left to clip.")
+            misses += 1
+            idx = c
+            continue
+        triangles.append((a, b, c))
+        alive[b] = False
+        nxt[a] = c
+        prv[c] = a
+        remaining -= 1
+        misses = 0
+        idx = a
+    triangles.append((prv[idx], idx, nxt[idx]))
+    return triangles
+
+def group_contours(contours):
+    """
+    Pair every outline with the holes inside it, as a list of
+    (outline, holes).
+    """
+    outlines = sorted([contour for contour in contours if contour.area > 0], key=lambda contour: contour.area)
+    groups = [(outline, []) for outline in outlines]
+    for hole in [contour for contour in contours if contour.area < 0]:
+        for (outline, holes) in groups:
+            if inside_polygon(hole.points[0], outline.points):
+                holes.append(hole)
+                break
+    return groups
+
+def extrude_contours(contours, thickness, scale=1.0, height=None):
+    """
+    Extrude traced contours, in pixel coordinates, into a closed solid
+    thickness high, one batch of triangles a shape.  Pixels are scale
+    across, and with the height of the image, y is turned to point up.
+    """
+    for (outline, holes) in group_contours(contours):
+        rings = []
+        for contour in [outline] + holes:
+            points = contour.points * scale
+            if height != None:
+                # turning y over turns the winding over, so turn it back
+                points[:, 1] = height * scale - points[:, 1]
+                points = points[::-1]
+            rings.append(points)
+        polygon = bridge_holes(rings[0], rings[1:])
+        index = np.array(triangulate_polygon(polygon))
+        top = np.zeros((len(index), 3, 3))
+        top[:, :, :2] = polygon[index]
+        top[:, :, 2] = thickness
+        bottom = top[:, ::-1].copy()
+        bottom[:, :, 2] = 0
+        walls = []
+        for ring in rings:
+            ahead = np.roll(ring, -1, axis=0)
+            (p0, p1, q0, q1) = [np.zeros((len(ring), 3)) for idx in range(4)]
+            for (corner, points, z) in ((p0, ring, 0), (p1, ring, thickness), (q0, ahead, 0), (q1, ahead, thickness)):
+                corner[:, :2] = points
+                corner[:, 2] = z
+            walls.append(np.stack([p0, q0, q1], axis=1))
+            walls.append(np.stack([p0, q1, p1], axis=1))
+        yield np.concatenate([top, bottom] + walls)
+
+def box_blur(values, radius, passes=3, band=256):
+    """
+    Blur a 2d array with passes of a box filter radius wide each way, which
+    comes close to a gaussian blur at a cost that doesn't grow with radius.
+    Each pass works through band rows or columns at a time, so the blur
+    only ever holds one more copy of values.
+    """
+    values = np.array(values, dtype=np.float32)
+    width = 2 * radius + 1
+    for idx in range(passes):
+        for axis in (0, 1):
+            blurred = np.empty_like(values)
+            for start in range(0, values.shape[1 - axis], band):
+                if axis == 0:
+                    strip = values[:, start:start + band]
+                else:
+                    strip = values[start:start + band].T
+                summed = np.pad(strip.astype(float), ((radius + 1, radius), (0, 0)), mode="edge").cumsum(axis=0)
+                strip = (summed[width:] - summed[:-width]) / width
+                if axis == 0:
+                    blurred[:, start:start + band] = strip
+                else:
+                    blurred[start:start + band] = strip.T
+            values = blurred
+    return values
+
+def relief_heightmap(lattice, cells, margin=None, smoothing=1.0, band=256):
+    """
+    The crystal mass of the lattice as a (cells + 1, cells + 1) heightmap
+    from 0 to 1, over the same crop as save_image(), with nothing off the
+    crystal.  It is blurred by smoothing hex cells, so the relief doesn't
+    show the cells.  The heightmap is resampled band rows at a time, so a
+    large one never needs a whole resampling table.
+    """
+    fields = lattice.cell_fields()
+    mass = np.where(np.asarray(fields["attached"], dtype=bool), np.asarray(fields["crystal_mass"], dtype=float), 0)
+    mass /= max(mass.max(), 1e-12)
+    ((width, height), box) = RenderSnowflake(lattice).frame(margin=margin, resize=cells + 1)
+    (x0, y0, x1, y1) = box
+    pitch = (y1 - y0) / float(height)
+    heights = np.empty((height, width), dtype=np.float32)
+    for start in range(0, height, band):
+        rows = min(band, height - start)
+        resampler = HexResampler(lattice.size, (width, rows), (x0, y0 + start * pitch, x1, y0 + (start + rows) * pitch))
+        heights[start:start + rows] = resampler.gather(mass)
+    # the crop is about a pixel a cell at the native size
+    radius = int(round(smoothing * width / float(x1 - x0)))
+    if radius > 0:
+        heights = box_blur(heights, radius)
+    return heights
+
+class HeightmapMesh(object):
+    """
+    Turns a square heightmap of 2^n + 1 samples a side into the triangles of
+    a solid relief: the heightmap on top of a flat plate.
+
+    The top is a quadtree of square leaves, each split while the heights
+    inside it stray more than tolerance from the plane of its corners, so
+    the triangles are small where the relief is steep and large where it
+    is flat.  Leaves are kept within one level of their neighbors, and a
+    leaf with smaller neighbors is fanned from its center through the
+    corners they share, so the surface has no cracks and the solid is
+    closed.
+
+    triangles() yields the mesh a batch of leaves at a time, so it can be
+    streamed to disk without ever being held whole.
+    """
+    # the largest leaf, which also bounds the memory finding leaves takes
+    MaxLeaf = 64
+
+    def __init__(self, heights, tolerance=0.01):
+        self.heights = np.asarray(heights, dtype=np.float32)
+        self.cells = len(self.heights) - 1
+        assert self.heights.shape == (self.cells + 1, self.cells + 1) and self.cells & (self.cells - 1) == 0, "heightmaps are 2^n + 1 samples square."
+        self.tolerance = tolerance
+        self.leaves = self._split()
+        self._balance()
+
+    def _errors(self, size, blocks, chunk=1 << 22):
+        """
+        How far the heights of each block stray from the plane of its corners.
+        """
+        (stride_y, stride_x) = self.heights.strides
+        count = self.cells / size
+        windows = np.lib.stride_tricks.as_strided(self.heights, shape=(count, count, size + 1, size + 1), strides=(size * stride_y, size * stride_x, stride_y, stride_x))
+        ramp = np.linspace(0, 1, size + 1)
+        (v, u) = (ramp[:, np.newaxis], ramp[np.newaxis, :])
+        errors = []
+        step = max(1, chunk / ((size + 1) ** 2))
+        for start in range(0, len(blocks[0]), step):
+            block = windows[blocks[0][start:start + step], blocks[1][start:start + step]]
+            corners = [block[:, y, x][:, np.newaxis, np.newaxis] for (y, x) in ((0, 0), (0, size), (size, 0), (size, size))]
+            plane = corners[0] * (1 - v) * (1 - u) + corners[1] * (1 - v) * u + corners[2] * v * (1 - u) + corners[3] * v * u
+            errors.append(np.abs(block - plane).reshape(len(block), -1).max(axis=1))
+        return np.concatenate(errors)
+
+    def _split(self):
+        # the leaves of every size, as (block rows, block columns)
+        leaves = {}
+        size = min(self.cells, self.MaxLeaf)
+        count = self.cells / size
+        active = (np.repeat(np.arange(count), count), np.tile(np.arange(count), count))
+        while size > 1 and len(active[0]):
+            split = self._errors(size, active) > self.tolerance
+            leaves[size] = (active[0][~split], active[1][~split])
+            active = self._children(active[0][split], active[1][split])
+            size /= 2
+        leaves[1] = active
+        return leaves
+
+    def _children(self, rows, cols):
+        rows = (rows[:, np.newaxis] * 2 + np.array([0, 0, 1, 1])).ravel()
+        cols = (cols[:, np.newaxis] * 2 + np.array([0, 1, 0, 1])).ravel()
+        return (rows, cols)
+
+    def _size_map(self):
+        """
+        The size of the leaf over every cell.
+        """
+        sizes = np.zeros((self.cells, self.cells), dtype=np.uint16)
+        for (size, (rows, cols)) in self.leaves.items():
+            if not len(rows):
+                continue
+            grid = np.zeros((self.cells / size, self.cells / size), dtype=bool)
+            grid[rows, cols] = True
+            sizes[np.repeat(np.repeat(grid, size, axis=0), size, axis=1)] = size
+        return sizes
+
+    def _balance(self):
+        # split every leaf with a neighbor less than half its size, until
+        # there are none left
+        while True:
+            sizes = self._size_map()
+            # the smallest leaf beside every cell
+            smallest = sizes.copy()
+            smallest[1:] = np.minimum(smallest[1:], sizes[:-1])
+            smallest[:-1] = np.minimum(smallest[:-1], sizes[1:])
+            smallest[:, 1:] = np.minimum(smallest[:, 1:], sizes[:, :-1])
+            smallest[:, :-1] = np.minimum(smallest[:, :-1], sizes[:, 1:])
+            changed = False
+            for size in sorted(self.leaves, reverse=True):
+                (rows, cols) = self.leaves[size]
+                if size < 4 or not len(rows):
+                    continue
+                count = self.cells / size
+                least = smallest.reshape(count, size, count, size).min(axis=3).min(axis=1)
+                split = least[rows, cols] < size / 2
+                if not split.any():
+                    continue
+                (child_rows, child_cols) = self._children(rows[split], cols[split])
+                (small_rows, small_cols) = self.leaves.get(size / 2, (np.zeros(0, dtype=int), np.zeros(0, dtype=int)))
+                self.leaves[size / 2] = (np.concatenate([small_rows, child_rows]), np.concatenate([small_cols, child_cols]))
+                self.leaves[size] = (rows[~split], cols[~split])
+                changed = True
+            if not changed:
+                self.sizes = sizes
+                return
+
+    def leaf_count(self):
+        return sum([len(rows) for (rows, cols) in self.leaves.values()])
+
+    def _surface(self, points, scale, base, relief):
+        """
+        Turn (..., 2) cell corners, as x, y with y down, into points on the
+        top of the relief, with y up.
+        """
+        (x, y) = (points[..., 0], points[..., 1])
+        return np.stack([x * scale, (self.cells - y) * scale, base + relief * self.heights[y, x]], axis=-1)
+
+    def _leaf_triangles(self, size, rows, cols):
+        """
+        The top triangles of a batch of leaves, as (n, 3, 2) cell corners,
+        wound counter-clockwise seen from above.
+        """
+        (y, x) = (rows * size, cols * size)
+        (x1, y1) = (x + size, y + size)
+        half = size / 2
+        last = self.cells - 1
+        # the sides with smaller leaves beyond, which have a corner halfway
+        nearer = [
+            (y > 0) & (self.sizes[np.maximum(y - 1, 0), x] < size),
+            (x1 < self.cells) & (self.sizes[y, np.minimum(x1, last)] < size),
+            (y1 < self.cells) & (self.sizes[np.minimum(y1, last), x] < size),
+            (x > 0) & (self.sizes[y, np.maximum(x - 1, 0)] < size),
+        ]
+        (tl, tr, br, bl) = [np.stack(corner, axis=-1) for corner in ((x, y), (x1, y), (x1, y1), (x, y1))]
+        plain = ~(nearer[0] | nearer[1] | nearer[2] | nearer[3])
+        triangles = [np.stack([tl[plain], br[plain], tr[plain]], axis=1), np.stack([tl[plain], bl[plain], br[plain]], axis=1)]
+        fan = ~plain
+        if size > 1 and fan.any():
+            center = np.stack([x + half, y + half], axis=-1)[fan]
+            mids = [np.stack(corner, axis=-1)[fan] for corner in ((x + half, y), (x1, y + half), (x + half, y1), (x, y + half))]
+            ends = [tl[fan], tr[fan], br[fan], bl[fan], tl[fan]]
+            for side in range(4):
+                (start, end, mid) = (ends[side], ends[side + 1], mids[side])
+                split = nearer[side][fan]
+                triangles.append(np.stack([center[~split], end[~split], start[~split]], axis=1))
+                triangles.append(np.stack([center[split], mid[split], start[split]], axis=1))
+                triangles.append(np.stack([center[split], end[split], mid[split]], axis=1))
+        return np.concatenate(triangles)
+
+    def _rim(self):
+        """
+        The corners of the top along the edge of the heightmap, in order,
+        counter-clockwise seen from above.
+        """
+        edges = [set(), set(), set(), set()]
+        for (size, (rows, cols)) in self.leaves.items():
+            (y, x) = (rows * size, cols * size)
+            for (edge, on, along) in ((0, y == 0, x), (1, x + size == self.cells, y), (2, y + size == self.cells, x), (3, x == 0, y)):
+                edges[edge].update(along[on].tolist())
+                edges[edge].update((along[on] + size).tolist())
+        top = [(x, 0) for x in sorted(edges[0])]
+        right = [(self.cells, y) for y in sorted(edges[1])]
+        bottom = [(x, self.cells) for x in sorted(edges[2], reverse=True)]
+        left = [(0, y) for y in sorted(edges[3], reverse=True)]
+        # every corner of the square is on two edges
+        return np.array(top[:-1] + right[:-1] + bottom[:-1] + left[:-1])[::-1]
+
+    def triangles(self, scale=1.0, base=1.0, relief=1.0, batch=1 << 16):
+        """
+        Yield the triangles of the relief, batch leaves at a time, with
+        cells scale across, a plate base thick, and relief at the height
+        of the highest point.
+        """
+        for size in sorted(self.leaves, reverse=True):
+            (rows, cols) = self.leaves[size]
+            for start in range(0, len(rows), batch):
+                corners = self._leaf_triangles(size, rows[start:start + batch], cols[start:start + batch])
+                yield self._surface(corners, scale, base, relief)
+        rim = self._rim()
+        top = self._surface(rim, scale, base, relief)
+        bottom = top.copy()
+        bottom[:, 2] = 0
+        (top_ahead, bottom_ahead) = (np.roll(top, -1, axis=0), np.roll(bottom, -1, axis=0))
+        walls = [np.stack([bottom, bottom_ahead, top_ahead], axis=1), np.stack([bottom, top_ahead, top], axis=1)]
+        center = np.array([self.cells * scale / 2.0, self.cells * scale / 2.0, 0])
+        plate = np.stack([np.repeat(center[np.newaxis], len(rim), axis=0), bottom_ahead, bottom], axis=1)
+        yield np.concatenate(walls + [plate])
+
+def save_relief(fn, lattice, cells=1024, width=76.2, base=1.0, relief=3.0, tolerance=0.005, smoothing=1.0, margin=None):
+    """
+    Save the crystal mass of the lattice as a relief, width millimeters
+    across, on a plate base thick, with the most crystal mass relief higher
+    again.  The heightmap is cells across, rounded up to a power of two,
+    and the mesh follows it to within tolerance of the relief height.
+    """
+    cells = 1 << int(math.ceil(math.log(cells, 2)))
+    heights = relief_heightmap(lattice, cells, margin=margin, smoothing=smoothing)
+    mesh = HeightmapMesh(heights, tolerance=tolerance)
+    msg = "Relief of %d leaves from a %dx%d heightmap" % (mesh.leaf_count(), cells + 1, cells + 1)
+    log(msg)
+    return save_stl(fn, mesh.triangles(scale=width / float(cells), base=base, relief=relief))
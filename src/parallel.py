@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import random
+import ctypes
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+# local
+from sfgen import *
+
+def shared_array(values):
+    """
+    Copy a numpy array into shared memory that forked processes can write to.
+    """
+    raw = RawArray(ctypes.c_char, values.nbytes)
+    shared = np.frombuffer(raw, dtype=values.dtype)
+    shared[:] = values
+    return shared
+
+class ParallelLattice(ArrayLattice):
+    """
+    An ArrayLattice that spreads each step over a pool of worker processes.
+    The cell fields live in shared memory, and every worker owns one strip
+    of consecutive rows of the active region.  The master steps the workers
+    through the four sub-steps in lockstep, so each sub-step sees the
+    finished halo rows its neighbors wrote in the one before.  The noise is
+    a sub-step of its own, so no worker writes noise into a row while its
+    neighbor still reads it to settle attachment.
+
+    The noise is always hashed per cell, which makes the snowflake the same
+    for any number of workers, and the same as a serial ArrayLattice grown
+    with hashed_noise.
+    """
+    Fields = ("boundary_mass", "crystal_mass", "attached", "boundary", "age", "attached_count")
+
+    def __init__(self, size, workers=None, **kw):
+        if not workers:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.pool = None
+        kw["hashed_noise"] = True
+        super(ParallelLattice, self).__init__(size, **kw)
+
+    def __getstate__(self):
+        state = super(ParallelLattice, self).__getstate__()
+        state["pool"] = None
+        return state
+
+    def _init_cells(self):
+        super(ParallelLattice, self)._init_cells()
+        self._share()
+
+    def _share(self):
+        for key in self.Fields:
+            setattr(self, key, shared_array(getattr(self, key)))
+        # diffusion reads one buffer and writes the other
+        self.buffers = [None, None]
+        self.buffers[self.iteration % 2] = shared_array(self.diffusive_mass)
+        self.buffers[(self.iteration + 1) % 2] = shared_array(self.diffusive_mass)
+        self.diffusive_mass = self.buffers[self.iteration % 2]
+
+    @classmethod
+    def from_fields(cls, header, fields):
+        obj = super(ParallelLattice, cls).from_fields(header, fields)
+        obj.workers = multiprocessing.cpu_count()
+        obj.pool = None
+        if obj.noise_seed == None:
+            obj.noise_seed = random.getrandbits(63)
+        obj._share()
+        return obj
+
+    def start(self):
+        if self.pool != None:
+            return
+        msg = "Starting %d workers..." % self.workers
+        log(msg)
+        self.pool = []
+        for number in range(self.workers):
+            (conn, child_conn) = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=self._work, args=(number, child_conn))
+            proc.daemon = True
+            proc.start()
+            self.pool.append((proc, conn))
+
+    def close(self):
+        if self.pool == None:
+            return
+        for (proc, conn) in self.pool:
+            conn.send(None)
+        for (proc, conn) in self.pool:
+            proc.join()
+        self.pool = None
+
+    def grow(self, **kw):
+        try:
+            super(ParallelLattice, self).grow(**kw)
+        finally:
+            self.close()
+
+    def _broadcast(self, phase):
+        msg = (phase, self.iteration, self.reach, dict(self.environment))
+        for (proc, conn) in self.pool:
+            conn.send(msg)
+        # every worker answering is the barrier between sub-steps
+        return [conn.recv() for (proc, conn) in self.pool]
+
+    def step(self):
+        self.log_status()
+        self.update_reach()
+        self.start()
+        dm = self.diffusive_mass
+        new_dm = self.buffers[(self.iteration + 1) % 2]
+        if len(self.rim):
+            for values in self.buffers:
+                values[self.rim] = self.far_field
+            live = self.active[~self.attached[self.active]]
+        self._broadcast(1)
+        if len(self.rim):
+            self.far_field -= (self.weight[live] * (new_dm[live] - dm[live])).sum() / self.far_weight
+        self._broadcast(2)
+        attaching = np.concatenate(self._broadcast(3))
+        self._broadcast(4)
+        self.diffusive_mass = new_dm
+        self.attach(attaching)
+        # run curves
+        self.iteration += 1
+        self.environment.step(self.iteration)
+
+    def _work(self, number, conn):
+        while True:
+            msg = conn.recv()
+            if msg == None:
+                break
+            (phase, self.iteration, reach, env) = msg
+            self.environment.update(env)
+            self.diffusive_mass = self.buffers[self.iteration % 2]
+            new_dm = self.buffers[(self.iteration + 1) % 2]
+            if phase == 1:
+                if reach != self.reach:
+                    self._set_reach(reach)
+                bounds = np.linspace(0, len(self.active), self.workers + 1).astype(int)
+                cells = self.active[bounds[number]:bounds[number + 1]]
+                new_dm[cells] = self.diffusive_mass[cells]
+                (live, boundary, diffused) = self.step_one(cells, new_dm)
+                conn.send(None)
+            elif phase == 2:
+                pending = self.step_two(live, boundary, new_dm)
+                conn.send(None)
+            elif phase == 3:
+                conn.send(self.step_three(pending, new_dm))
+            elif phase == 4:
+                self.step_four(pending, new_dm)
+                conn.send(None)
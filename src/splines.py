@@ -18,7 +18,6 @@ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
 
 """todo:
 
-- make calculation of multiple points more efficient; support a form of call which evaluates over a range or an iteratable of u values
 - allow subclasses to handle this themselves, so they can cache intermediate results
 - support slices in the spline subclasses, maybe - do this by supporting slice objects as parameters to __getitem__
 - does list() use slices? in 2.2, it appears to use getitem with scalar indices - and not to use len, but to rely on getting an IndexError!
@@ -32,9 +31,40 @@ except NameError:
 	True = 1 == 1
 	False = 1 == 0
 
+# evaluate_many() works on whole arrays of u values when numpy is around
+NUMPY_ENABLED = True
+try:
+	import numpy
+except ImportError:
+	NUMPY_ENABLED = False
+
 def tuples2points(ts):
 	return map(lambda t: Point(*t), ts)
 
+def points2array(ps):
+	"Turns a sequence of points into an array with a row of coordinates for each."
+	return numpy.array([tuple(p) for p in ps], dtype=float).reshape(-1, 2)
+
+def _polynomials(curves):
+	"Stacks the coefficients of a sequence of polynomial curves into one array, indexed by curve, order and coordinate. Lower order curves get zeros for their missing coefficients."
+	coefs = [curve.coefficients() for curve in curves]
+	order = max([len(c) for c in coefs])
+	arr = numpy.zeros((len(coefs), order, 2))
+	for i in range(len(coefs)):
+		arr[i, :len(coefs[i])] = points2array(coefs[i])
+	return arr
+
+def _polyval(coefs, i, u):
+	"Evaluates polynomial i[k] of coefs at u[k], for every k, summing the terms in the same order the curve classes do, so the results come out the same to the bit."
+	u = u[:, numpy.newaxis]
+	p = coefs[i, 0]
+	for k in range(1, coefs.shape[1]):
+		if (k == 1):
+			p = p + (coefs[i, k] * u)
+		else:
+			p = p + (coefs[i, k] * (u ** k))
+	return p
+
 class Point(object):
 	"A point. Actually a somewhat general vector, but never mind. Implements more behaviour than it strictly needs to."
 	__slots__ = ("x", "y")
@@ -85,6 +115,14 @@ class Curve(object):
 	def __call__(self, u):
 		"Finds the position of the curve at coordinate u."
 		raise NotImplementedError
+	def evaluate_many(self, us):
+		"Finds the position of the curve at every coordinate in us, in one go. Returns the coordinates as a pair of sequences (xs, ys), which are numpy arrays if numpy is available. This version just calls the curve for each u; subclasses which can do better, do."
+		ps = [self(u) for u in us]
+		xs = [p.x for p in ps]
+		ys = [p.y for p in ps]
+		if (NUMPY_ENABLED):
+			return (numpy.array(xs), numpy.array(ys))
+		return (xs, ys)
 
 class Line(Curve):
 	"A straight line."
@@ -94,6 +132,8 @@ class Line(Curve):
 		self.b = b
 	def __call__(self, u):
 		return self.a + (self.b * u)
+	def coefficients(self):
+		return [self.a, self.b]
 	def __str__(self):
 		return str(self.a) + " + " + str(self.b) + "u"
 	def __repr__(self):
@@ -114,6 +154,8 @@ class Quadratic(Curve):
 		self.c = c
 	def __call__(self, u):
 		return self.a + (self.b * u) + (self.c * (u ** 2))
+	def coefficients(self):
+		return [self.a, self.b, self.c]
 	def __str__(self):
 		return str(self.a) + " + " + str(self.b) + "u + " + str(self.c) + "u**2"
 	def __repr__(self):
@@ -136,6 +178,8 @@ class Cubic(Curve):
 		self.d = d
 	def __call__(self, u):
 		return self.a + (self.b * u) + (self.c * (u ** 2)) + (self.d * (u ** 3))
+	def coefficients(self):
+		return [self.a, self.b, self.c, self.d]
 	def __str__(self):
 		return str(self.a) + " + " + str(self.b) + "u + " + str(self.c) + "u**2 + " + str(self.d) + "u**3"
 	def __repr__(self):
@@ -174,6 +218,18 @@ class PiecewiseSpline(Spline):
 			i = int(u)
 		v = u - i
 		return self[i](v)
+	def coefficients(self):
+		"The coefficients of every piece, as an array indexed by piece, order and coordinate."
+		return _polynomials([self[i] for i in range(len(self))])
+	def evaluate_many(self, us):
+		if (not NUMPY_ENABLED):
+			return Spline.evaluate_many(self, us)
+		u = numpy.asarray(us, dtype=float)
+		n = len(self)
+		# the same choice of piece as __call__, a whole array at a time
+		i = numpy.where((u < 0.0), 0, numpy.where((u >= n), (n - 1), u.astype(int)))
+		p = _polyval(self.coefficients(), i, (u - i))
+		return (p[:, 0], p[:, 1])
 	def __len__(self):
 		"The length of a spline is the number of pieces in it, which is one less than the number of tight knots."
 		return len(self.knots) - ((2 * getattr(self, "looseKnots", 0)) + 1)
@@ -208,6 +264,21 @@ class NaturalCubicSpline(PiecewiseSpline):
 			d = ((p[i] - p[(i + 1)]) * 2.0) + e[i] + e[(i + 1)]
 			self.pieces.append(Cubic(a, b, c, d))
 		# i am always absolutely outraged that this voodoo works!
+	def coefficients(self):
+		"The same voodoo as calculate(), on arrays of coordinates rather than lists of points, and cached likewise."
+		if (not NUMPY_ENABLED):
+			return PiecewiseSpline.coefficients(self)
+		if (self.knots != getattr(self, "arrayknots", None)):
+			p = points2array(self.knots)
+			self.arrayknots = list(self.knots)
+			g = numpy.array(_gamma(len(p)))
+			e = _epsilon_array(g, _delta_array(p, g))
+			a = p[:-1]
+			b = e[:-1]
+			c = ((p[1:] - p[:-1]) * 3.0) - ((e[:-1] * 2.0) + e[1:])
+			d = ((p[:-1] - p[1:]) * 2.0) + e[:-1] + e[1:]
+			self.arraycoefs = numpy.concatenate([a, b, c, d], axis=1).reshape(-1, 4, 2)
+		return self.arraycoefs
 
 # don't ask what happened to alpha and beta
 
@@ -234,6 +305,26 @@ def _epsilon(g, d):
 	e.reverse()
 	return e
 
+# the same, for knots in an array with a row per knot; only the recurrences are left as loops
+
+def _delta_array(p, g):
+	n = len(p)
+	d = numpy.empty_like(p)
+	s = numpy.empty_like(p)
+	s[1:-1] = (p[2:] - p[:-2]) * 3.0
+	s[-1] = (p[-1] - p[-2]) * 3.0
+	d[0] = (p[1] - p[0]) * (g[0] * 3.0)
+	for i in range(1, n):
+		d[i] = (s[i] - d[(i - 1)]) * g[i]
+	return d
+
+def _epsilon_array(g, d):
+	e = numpy.empty_like(d)
+	e[-1] = d[-1]
+	for i in range((len(d) - 2), -1, -1):
+		e[i] = d[i] - (e[(i + 1)] * g[i])
+	return e
+
 class BlendedSpline(Spline):
 	"A blended spline is composed of a sequence of tangent curves which sit at the knots; the overall shape of the curve is found by blending together the tangents. The blending is such that, where the tangent to a knot k is given by tan(k), between two knots k and l, at a distance v from k, the curve is (1 - v) * tan(k) + v * tan(l); note that it follows from this that at a knot k, the curve is exactly equal to tan(k)."
 	def __getitem__(self, i):
@@ -266,6 +357,21 @@ class BlendedQuadraticSpline(BlendedSpline):
 			return Line.fit(end, proj)
 		else:
 			return Quadratic.fit(self.knots[(i - 1)], self.knots[i], self.knots[(i + 1)])
+	def evaluate_many(self, us):
+		if (not NUMPY_ENABLED):
+			return Spline.evaluate_many(self, us)
+		u = numpy.asarray(us, dtype=float)
+		coefs = _polynomials([self[i] for i in range(len(self))])
+		l = len(self) - 1
+		# blend the tangents either side of each u, then patch in the ends
+		i = numpy.clip(u.astype(int), 0, max(0, (l - 1)))
+		v = u - i
+		w = 1 - v
+		p = (_polyval(coefs, i, v) * w[:, numpy.newaxis]) + (_polyval(coefs, numpy.minimum((i + 1), l), -w) * v[:, numpy.newaxis])
+		ends = numpy.zeros(len(u), dtype=int)
+		p = numpy.where((u < 0.0)[:, numpy.newaxis], _polyval(coefs, ends, u), p)
+		p = numpy.where((u >= l)[:, numpy.newaxis], _polyval(coefs, (ends + l), (u - l)), p)
+		return (p[:, 0], p[:, 1])
 
 class BlendedQuarticSpline(BlendedSpline):
 	"I'm not going to implement this, but it would be interesting - hopefully, it would be smoother than the quadratic, which, compared to the natural cubic, is a bit angular."
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+import os
+import zlib
+import struct
+import subprocess
+import multiprocessing
+
+NUMPY_ENABLED = True
+try:
+    import numpy as np
+except ImportError:
+    NUMPY_ENABLED = False
+
+# local
+from sfgen import *
+
+class ApngEncoder(object):
+    """
+    Writes frames of raw RGB straight into an animated PNG, one frame at a
+    time.  A file cut short by an interrupted render is trimmed back to its
+    last whole frame and picked up from there, unless fresh.
+    """
+    Signature = "\x89PNG\r\n\x1a\n"
+
+    def __init__(self, fn, resolution, fps, count, level=6, fresh=False):
+        self.fn = fn
+        self.resolution = resolution
+        self.count = count
+        self.level = level
+        # frame delays are a ratio of two 16 bit numbers
+        if fps == int(fps):
+            self.delay = (1, int(fps))
+        else:
+            self.delay = (int(round(1000.0 / fps)), 1000)
+        self.done = 0
+        self.ended = False
+        if os.path.exists(fn) and not fresh:
+            self.done = self._recover()
+        if self.done == 0:
+            self.f = open(fn, 'wb')
+            self._write_header()
+
+    def _chunk(self, kind, data):
+        self.f.write(struct.pack(">I", len(data)))
+        self.f.write(kind)
+        self.f.write(data)
+        self.f.write(struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    def _write_header(self):
+        (width, height) = self.resolution
+        self.f.write(self.Signature)
+        self._chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        self._chunk("acTL", struct.pack(">II", self.count, 0))
+
+    def _recover(self):
+        """
+        Count the whole frames already in the file, and cut off the rest.
+        """
+        f = open(self.fn, 'r+b')
+        frames = 0
+        end = None
+        if f.read(len(self.Signature)) == self.Signature:
+            while True:
+                head = f.read(8)
+                if len(head) < 8:
+                    break
+                (length, kind) = struct.unpack(">I4s", head)
+                f.seek(length + 4, os.SEEK_CUR)
+                if f.tell() > os.fstat(f.fileno()).st_size:
+                    break
+                if kind == "IEND":
+                    self.ended = True
+                    frames = self.count
+                    end = f.tell()
+                    break
+                if kind in ("IDAT", "fdAT"):
+                    frames += 1
+                    end = f.tell()
+        if end == None:
+            f.close()
+            return 0
+        f.truncate(end)
+        f.seek(end)
+        self.f = f
+        return frames
+
+    def write(self, content):
+        (width, height) = self.resolution
+        rows = [content[row * width * 3:(row + 1) * width * 3] for row in range(height)]
+        # filter type 0 on every scanline
+        data = zlib.compress(str.join('', ["\0" + row for row in rows]), self.level)
+        sequence = max(0, self.done * 2 - 1)
+        control = struct.pack(">IIIIIHHBB", sequence, width, height, 0, 0, self.delay[0], self.delay[1], 0, 0)
+        self._chunk("fcTL", control)
+        if self.done == 0:
+            self._chunk("IDAT", data)
+        else:
+            self._chunk("fdAT", struct.pack(">I", sequence + 1) + data)
+        self.f.flush()
+        self.done += 1
+
+    def close(self):
+        if self.done == self.count and not self.ended:
+            self._chunk("IEND", "")
+            self.ended = True
+        self.f.close()
+
+class FFmpegEncoder(object):
+    """
+    Pipes frames of raw RGB into ffmpeg over stdin.  The movie is encoded
+    in segments of segment frames, each kept once it is finished, so an
+    interrupted render starts again from the last whole segment, unless
+    fresh.  Closing joins the segments into the movie without encoding them
+    again.
+    """
+    Binary = "ffmpeg"
+
+    def __init__(self, fn, resolution, fps, count, segment=300, codec="libx264", fresh=False):
+        self.fn = fn
+        self.resolution = resolution
+        self.fps = fps
+        self.count = count
+        self.segment = segment
+        self.codec = codec
+        (base, self.ext) = os.path.splitext(fn)
+        self.segment_dir = "%s.segments" % base
+        if not os.path.exists(self.segment_dir):
+            os.mkdir(self.segment_dir)
+        if fresh:
+            for segment_fn in os.listdir(self.segment_dir):
+                os.remove(os.path.join(self.segment_dir, segment_fn))
+        # the finished segments, in order
+        self.segments = []
+        while os.path.exists(self._segment_fn(len(self.segments))):
+            self.segments.append(self._segment_fn(len(self.segments)))
+        self.done = min(count, len(self.segments) * segment)
+        self.proc = None
+
+    def _segment_fn(self, number):
+        return os.path.join(self.segment_dir, "segment_%05d%s" % (number, self.ext))
+
+    def _start(self):
+        (width, height) = self.resolution
+        self.partfn = "%s.part%s" % (self._segment_fn(len(self.segments)), self.ext)
+        cmd = [self.Binary, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "%dx%d" % (width, height), "-r", str(self.fps), "-i", "-", "-c:v", self.codec, "-pix_fmt", "yuv420p", self.partfn]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        self.frames = 0
+
+    def _finish(self):
+        self.proc.stdin.close()
+        assert self.proc.wait() == 0, "%s failed to encode %s." % (self.Binary, self.partfn)
+        self.proc = None
+        fn = self._segment_fn(len(self.segments))
+        os.rename(self.partfn, fn)
+        self.segments.append(fn)
+
+    def write(self, content):
+        if self.proc == None:
+            self._start()
+        self.proc.stdin.write(content)
+        self.frames += 1
+        self.done += 1
+        if self.frames == self.segment or self.done == self.count:
+            self._finish()
+
+    def close(self):
+        if self.proc != None:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+        if self.done < self.count:
+            return
+        listfn = os.path.join(self.segment_dir, "segments.txt")
+        f = open(listfn, 'w')
+        for fn in self.segments:
+            f.write("file '%s'\n" % os.path.abspath(fn))
+        f.close()
+        cmd = [self.Binary, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", listfn, "-c", "copy", self.fn]
+        assert subprocess.call(cmd) == 0, "%s failed to join the segments of %s." % (self.Binary, self.fn)
+
+# each worker's replay log, color scheme and resampler
+_worker = {}
+
+def _init_worker(name, size, resolution, box, scheme):
+    _worker["celllog"] = CellLog(name)
+    _worker["size"] = size
+    _worker["resolution"] = resolution
+    _worker["box"] = box
+    _worker["scheme"] = scheme
+
+def _render_frame(idx):
+    frame = ReplayFrame(_worker["size"], *_worker["celllog"][idx])
+    colors = _worker["scheme"](frame).batch(frame.cell_fields())
+    img = HexResampler.get(_worker["size"], _worker["resolution"], _worker["box"]).render(colors)
+    return img.tobytes()
+
+class StreamMovie(object):
+    """
+    Renders the cell log of a run into a movie, without writing a single
+    frame to disk.  Frames are rendered by a pool of worker processes, each
+    reading its own run of frames from the log, and streamed in order into
+    ffmpeg, or into an animated PNG for .png and .apng files.
+
+    Every stride'th step becomes a frame.  All frames share the crop box of
+    the last one, so the crystal grows in place, and resolution defaults to
+    that box.  Rendering the same movie again resumes where it left off, as
+    long as the settings kept in <fn>.settings are the same, and starts over
+    otherwise.
+    Frames are ReplayFrames, so they show the attached cells the log kept,
+    but never any boundary mass.
+    """
+    Encoders = {".png": ApngEncoder, ".apng": ApngEncoder}
+
+    def __init__(self, name, fn=None, stride=1, fps=30, resolution=None, scheme=None, workers=None, margin=None, celllog="cell_log"):
+        assert NUMPY_ENABLED, "movie streaming requires numpy."
+        self.name = name
+        self.fn = fn or "%s.mp4" % name
+        self.stride = stride
+        self.fps = fps
+        self.resolution = resolution
+        self.scheme = scheme or Grayscale
+        self.workers = workers or multiprocessing.cpu_count()
+        self.margin = margin
+        self.celllog = celllog
+
+    def frames(self, replay):
+        return range(0, len(replay), self.stride)
+
+    def run(self):
+        replay = CellLog(self.celllog)
+        frames = self.frames(replay)
+        if not frames:
+            return
+        size = int(round(replay.ncells ** 0.5))
+        last = ReplayFrame(size, *replay[frames[-1]])
+        replay.close()
+        box = last.crop_snowflake(margin=self.margin)
+        resolution = self.resolution
+        if resolution == None:
+            # most codecs want even dimensions
+            resolution = (box[2] - box[0] + 1) & ~1, (box[3] - box[1] + 1) & ~1
+        resolution = tuple(resolution)
+        # a movie can only be resumed with the settings it was started with
+        settings = repr((self.stride, self.fps, resolution, len(frames), box, self.scheme.__name__))
+        settingsfn = "%s.settings" % self.fn
+        fresh = True
+        if os.path.exists(settingsfn):
+            f = open(settingsfn)
+            fresh = f.read() != settings
+            f.close()
+        encoder = self.Encoders.get(os.path.splitext(self.fn)[1].lower(), FFmpegEncoder)
+        encoder = encoder(self.fn, resolution, self.fps, len(frames), fresh=fresh)
+        if fresh:
+            f = open(settingsfn, 'w')
+            f.write(settings)
+            f.close()
+        if encoder.done:
+            msg = "Resuming %s at frame %d of %d" % (self.fn, encoder.done, len(frames))
+            log(msg)
+        todo = frames[encoder.done:]
+        pool = multiprocessing.Pool(self.workers, _init_worker, (self.celllog, size, resolution, box, self.scheme))
+        try:
+            # contiguous runs of frames keep each worker's log reads local
+            chunksize = max(1, min(16, len(todo) / (self.workers * 4)))
+            for (count, content) in enumerate(pool.imap(_render_frame, todo, chunksize)):
+                encoder.write(content)
+                if (count + 1) % 100 == 0:
+                    msg = "Rendered %d of %d frames" % (encoder.done, len(frames))
+                    log(msg)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            encoder.close()
+        msg = "Saved %s" % self.fn
+        log(msg)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+import os
+import time
+import random
+import sqlite3
+import itertools
+import traceback
+import multiprocessing
+
+# local
+from sfgen import *
+
+# the environment keys a sweep can vary
+SWEEP_KEYS = ("beta", "theta", "alpha", "kappa", "mu", "upsilon", "sigma", "gamma")
+
+def _load_prefix(fn, env, latticetype, size, kw):
+    """
+    The header of the prefix checkpoint in fn, or None if it can't be read
+    or wasn't grown with the same lattice and environment.
+    """
+    try:
+        # only the header is read from the mapped checkpoint
+        header = Checkpoint.load(fn, mmap=True).header
+    except Exception, err:
+        msg = "Can't read %s, growing it again: %r" % (fn, err)
+        log(msg)
+        return None
+    saved = header.get("environment") or {}
+    same = header.get("latticetype") == latticetype and header.get("size") == size
+    same = same and all([header[key] == val for (key, val) in kw.items() if key in header])
+    same = same and all([saved.get(key) == val for (key, val) in env.items()])
+    if not same:
+        msg = "%s was grown with other settings, growing it again" % fn
+        log(msg)
+        return None
+    return header
+
+def _grow_prefix(task):
+    """
+    Grow the shared prefix of a group of branches up to the branch step, and
+    checkpoint it.  Returns whether the flake finished growing on the way,
+    and the error, if growing it failed.
+    """
+    (fn, seed, env, latticetype, size, kw, branch_step) = task
+    try:
+        if os.path.exists(fn):
+            header = _load_prefix(fn, env, latticetype, size, kw)
+            if header != None:
+                return (fn, header["iteration"] < branch_step, None)
+        random.seed(seed)
+        lattice = latticetype(size, environment=CrystalEnvironment(**env), **kw)
+        finished = False
+        # the same steps, and the same headroom checks, as grow()
+        while lattice.iteration < branch_step:
+            lattice.step()
+            if lattice.iteration % 50 == 0 and not lattice.headroom():
+                finished = True
+                break
+        lattice.save_checkpoint(fn)
+    except Exception, err:
+        log(traceback.format_exc())
+        return (fn, False, repr(err))
+    return (fn, finished, None)
+
+def _grow_branch(task):
+    (fn, finished, name, params, path) = task
+    start = time.time()
+    try:
+        lattice = resume_lattice(fn)
+        lattice.environment.update(params)
+        lattice.environment.set_factory_settings()
+        if not finished:
+            lattice.grow()
+        lfn = os.path.join(path, "%s.lattice" % name)
+        ifn = os.path.join(path, "%s.png" % name)
+        lattice.save_lattice(lfn)
+        lattice.save_image(ifn)
+    except Exception, err:
+        log(traceback.format_exc())
+        return {"name": name, "status": "failed", "message": repr(err), "elapsed": time.time() - start}
+    record = {
+        "name": name,
+        "status": "done",
+        "iterations": lattice.iteration,
+        "radius": lattice.snowflake_radius(),
+        "crystal_mass": float(sum(lattice.cell_fields()["crystal_mass"])),
+        "elapsed": time.time() - start,
+        "lattice": lfn,
+        "image": ifn,
+    }
+    return record
+
+class ParameterSweep(object):
+    """
+    Grows a flake for every combination of the environment values in grid,
+    a dict of environment key to a list of values, over the base
+    environment.  Swept values take effect at branch_step, except for the
+    early keys, gamma among them, which set up the lattice and so take
+    effect from the start.  Every branch with the same early values shares
+    the same first branch_step steps, so that prefix is grown once,
+    checkpointed, and each branch resumes from the checkpoint instead of
+    growing it again.  With branch_step at 0 nothing is shared but the
+    starting lattice.
+
+    The random stream of a prefix is seeded from the sweep name and its
+    early values, and each branch picks up the stream where the prefix left
+    it, so a branch is the flake that growing from scratch would give.
+
+    Prefixes and branches are scheduled on one pool of worker processes,
+    each branch as soon as its prefix is done, and the results of every
+    branch go into one indexed sqlite table, results, in <name>.db.  A
+    branch that fails is recorded with status 'failed' and its error in
+    message, and the rest of the sweep carries on.  Running a sweep again
+    skips the branches that are already done, and picks up the prefixes
+    that were kept for the ones that failed, as long as they were grown
+    with the same settings.
+    """
+    def __init__(self, name, grid, branch_step=0, early=("gamma",), base=None, size=300, latticetype=None, workers=None, **kw):
+        for key in grid:
+            assert key in SWEEP_KEYS, "'%s' is not an environment key." % key
+        self.name = name
+        self.grid = grid
+        self.branch_step = branch_step
+        self.early = sorted(set(early) & set(grid))
+        self.base = dict(base or {})
+        assert "curves" not in self.base, "swept environments can't follow curves."
+        self.size = size
+        self.latticetype = latticetype or CrystalLattice
+        self.workers = workers or multiprocessing.cpu_count()
+        kw.setdefault("margin", SNOWFLAKE_DEFAULTS["margin"])
+        self.kw = kw
+        self.path = os.path.abspath(name)
+        self.dbfn = os.path.join(self.path, "%s.db" % os.path.basename(name))
+
+    def branches(self):
+        """
+        Every combination in the grid, as (name, params), in grid order.
+        """
+        keys = sorted(self.grid)
+        branches = []
+        for (idx, values) in enumerate(itertools.product(*[self.grid[key] for key in keys])):
+            name = "%s_%03d" % (os.path.basename(self.name), idx)
+            branches.append((name, dict(zip(keys, values))))
+        return branches
+
+    def prefixes(self, branches):
+        """
+        Group the branches by their early values, as a list of
+        (early values, branches).
+        """
+        groups = {}
+        order = []
+        for (name, params) in branches:
+            key = tuple([params[key] for key in self.early])
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append((name, params))
+        return [(dict(zip(self.early, key)), groups[key]) for key in order]
+
+    def open_db(self):
+        db = sqlite3.connect(self.dbfn)
+        columns = str.join(', ', ["%s REAL" % key for key in SWEEP_KEYS])
+        db.execute("CREATE TABLE IF NOT EXISTS results (name TEXT PRIMARY KEY, prefix TEXT, branch_step INTEGER, %s, status TEXT, message TEXT, iterations INTEGER, radius INTEGER, crystal_mass REAL, elapsed REAL, lattice TEXT, image TEXT)" % columns)
+        # results from before failed branches were recorded
+        if "message" not in [row[1] for row in db.execute("PRAGMA table_info(results)")]:
+            db.execute("ALTER TABLE results ADD COLUMN message TEXT")
+        for key in self.grid:
+            db.execute("CREATE INDEX IF NOT EXISTS results_%s ON results (%s)" % (key, key))
+        db.commit()
+        return db
+
+    def run(self):
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+        db = self.open_db()
+        done = set([row[0] for row in db.execute("SELECT name FROM results WHERE status = 'done'")])
+        branches = [branch for branch in self.branches() if branch[0] not in done]
+        groups = self.prefixes(branches)
+        msg = "Sweeping %d branches from %d prefixes of %d steps on %d workers" % (len(branches), len(groups), self.branch_step, self.workers)
+        log(msg)
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            tasks = []
+            tags = []
+            for (early, group) in groups:
+                env = CrystalEnvironment(**self.base)
+                env.update(early)
+                # the early values stand in for the prefix in its name and seed
+                tag = str.join('_', ["%s%s" % item for item in sorted(early.items())]) or "base"
+                fn = os.path.join(self.path, "prefix_%s_%d_%d.checkpoint" % (tag, self.size, self.branch_step))
+                seed = "%s/%s" % (os.path.basename(self.name), tag)
+                tags.append(tag)
+                tasks.append((fn, seed, dict(env), self.latticetype, self.size, self.kw, self.branch_step))
+            pending = []
+            # queue up the branches of each prefix as soon as it is grown
+            for (number, (fn, finished, error)) in enumerate(pool.imap(_grow_prefix, tasks)):
+                for (name, params) in groups[number][1]:
+                    result = None
+                    if error == None:
+                        result = pool.apply_async(_grow_branch, ((fn, finished, name, params, self.path),))
+                    pending.append((result, error, name, tags[number], params))
+            count = 0
+            failed = set()
+            for (result, error, name, tag, params) in pending:
+                record = {"name": name, "status": "failed", "message": error}
+                if result != None:
+                    try:
+                        record = result.get()
+                    except Exception, err:
+                        record["message"] = repr(err)
+                record["prefix"] = tag
+                record["branch_step"] = self.branch_step
+                env = CrystalEnvironment(**self.base)
+                env.update(params)
+                for key in SWEEP_KEYS:
+                    record[key] = env[key]
+                keys = sorted(record)
+                sql = "INSERT OR REPLACE INTO results (%s) VALUES (%s)" % (str.join(', ', keys), str.join(', ', ['?'] * len(keys)))
+                db.execute(sql, [record[key] for key in keys])
+                db.commit()
+                count += 1
+                if record["status"] == "failed":
+                    failed.add(tag)
+                    msg = "%s failed: %s (%d of %d)" % (name, record["message"], count, len(branches))
+                else:
+                    msg = "%s grew to %d steps in %.1fs (%d of %d)" % (record["name"], record["iterations"], record["elapsed"], count, len(branches))
+                log(msg)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            db.close()
+        if failed:
+            msg = "Branches from %d prefixes failed, their prefixes are kept for the next run" % len(failed)
+            log(msg)
+        # the prefixes are only worth keeping until every branch is done
+        for (tag, (fn, seed, env, latticetype, size, kw, branch_step)) in zip(tags, tasks):
+            if tag not in failed and os.path.exists(fn):
+                os.remove(fn)
+
+def run_sweep(args):
+    grid = {}
+    for keyval in args.grid:
+        (key, vals) = keyval.split('=', 1)
+        grid[key] = [float(val) for val in vals.split(',')]
+    early = ["gamma"] + (args.early or [])
+    sweep = ParameterSweep(args.name, grid, branch_step=args.branch_step, early=early, size=args.size, workers=args.processes, max_steps=args.max_steps, margin=args.margin)
+    sweep.run()
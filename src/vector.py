@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+import collections
+import multiprocessing
+
+NUMPY_ENABLED = True
+try:
+    import numpy as np
+except ImportError:
+    NUMPY_ENABLED = False
+
+# local
+from sfgen import *
+
+# a closed outline, as an (n, 2) array of x, y points, and the number of
+# pixels it encloses, negative for a hole
+Contour = collections.namedtuple("Contour", ("points", "area"))
+
+def polygon_area(points):
+    """
+    The area of a closed polygon, positive when it runs clockwise on screen,
+    with y pointing down.
+    """
+    (x, y) = (points[:, 0], points[:, 1])
+    return (np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y)) / 2.0
+
+def simplify_contour(points, tolerance):
+    """
+    Douglas-Peucker on a closed polygon, dropping every point within
+    tolerance of the line its neighbors make.
+    """
+    count = len(points)
+    if tolerance <= 0 or count < 4:
+        return points
+    # anchor on the first point and the point farthest from it
+    far = int(np.argmax(np.hypot(*(points - points[0]).T)))
+    ring = np.vstack([points, points[:1]])
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[far] = True
+    stack = [(0, far), (far, count)]
+    while stack:
+        (start, end) = stack.pop()
+        if end - start < 2:
+            continue
+        (a, b) = (ring[start], ring[end])
+        rest = ring[start + 1:end] - a
+        (dx, dy) = b - a
+        length = np.hypot(dx, dy)
+        if length == 0:
+            dist = np.hypot(rest[:, 0], rest[:, 1])
+        else:
+            dist = np.abs(dx * rest[:, 1] - dy * rest[:, 0]) / length
+        idx = int(np.argmax(dist))
+        if dist[idx] > tolerance:
+            keep[start + 1 + idx] = True
+            stack.append((start, start + 1 + idx))
+            stack.append((start + 1 + idx, end))
+    if keep.sum() < 3:
+        return points
+    return points[keep]
+
+def trace_mask(mask, turd=0, tolerance=0.5):
+    """
+    Trace the outlines of every shape in a (height, width) mask, by marching
+    squares, into a list of Contours in pixel coordinates.  Outlines run
+    clockwise on screen and holes counter-clockwise, so shapes fill by either
+    fill rule.  Pixels that only touch at a corner are separate shapes.
+
+    Shapes and holes of turd pixels or less are dropped, as potrace's turd
+    size does, and the outlines are simplified to within tolerance pixels.
+    """
+    assert NUMPY_ENABLED, "tracing requires numpy."
+    mask = np.pad(np.asarray(mask, dtype=bool), 1, mode="constant")
+    (height, width) = (mask.shape[0] - 2, mask.shape[1] - 2)
+    # every pixel side between the shape and the background is an edge,
+    # running clockwise around its pixel, as (x, y, direction)
+    # from its start, with east, south, west and north as 0 to 3
+    edges = []
+    (rows, cols) = np.nonzero(mask[1:, :] & ~mask[:-1, :])
+    edges.append((cols - 1, rows, 0))
+    (rows, cols) = np.nonzero(mask[:, :-1] & ~mask[:, 1:])
+    edges.append((cols, rows - 1, 1))
+    (rows, cols) = np.nonzero(mask[:-1, :] & ~mask[1:, :])
+    edges.append((cols, rows, 2))
+    (rows, cols) = np.nonzero(mask[:, 1:] & ~mask[:, :-1])
+    edges.append((cols, rows, 3))
+    x = np.concatenate([edge[0] for edge in edges])
+    y = np.concatenate([edge[1] for edge in edges])
+    direction = np.concatenate([np.repeat(edge[2], len(edge[0])) for edge in edges])
+    count = len(x)
+    if not count:
+        return []
+    step_x = np.array([1, 0, -1, 0])[direction]
+    step_y = np.array([0, 1, 0, -1])[direction]
+    stride = width + 1
+    start = y * stride + x
+    end = (y + step_y) * stride + x + step_x
+    # the edges leaving every corner; where two pixels meet at a corner,
+    # there are two, and the one that turns right keeps them apart
+    first = np.empty((height + 1) * stride, dtype=int)
+    last = np.empty((height + 1) * stride, dtype=int)
+    first[start[::-1]] = np.arange(count)[::-1]
+    last[start] = np.arange(count)
+    (first, last, end, direction) = (first.tolist(), last.tolist(), end.tolist(), direction.tolist())
+    # the marching squares outline runs through the middle of every edge
+    middle = np.column_stack((x + step_x / 2.0, y + step_y / 2.0))
+    corners = np.column_stack((x, y)).astype(float)
+    visited = [False] * count
+    contours = []
+    for edge in xrange(count):
+        if visited[edge]:
+            continue
+        loop = []
+        while not visited[edge]:
+            visited[edge] = True
+            loop.append(edge)
+            corner = end[edge]
+            turn = first[corner]
+            if turn != last[corner] and direction[turn] != (direction[edge] + 1) % 4:
+                turn = last[corner]
+            edge = turn
+        area = polygon_area(corners[loop])
+        if abs(area) <= turd:
+            continue
+        points = simplify_contour(middle[loop], tolerance)
+        contours.append(Contour(points, area))
+    return contours
+
+def count_shapes(contours, turd=0):
+    """
+    The number of separate shapes, not counting holes, larger than turd
+    pixels.
+    """
+    return len([contour for contour in contours if contour.area > turd])
+
+def _trace(task):
+    (mask, turd, tolerance) = task
+    return trace_mask(mask, turd=turd, tolerance=tolerance)
+
+def trace_masks(masks, turd=0, tolerance=0.5, workers=None):
+    """
+    trace_mask() every mask, on a pool of worker processes, with one turd
+    size for all of them or a list of them.
+    """
+    if not isinstance(turd, (list, tuple)):
+        turd = [turd] * len(masks)
+    tasks = [(mask, _turd or 0, tolerance) for (mask, _turd) in zip(masks, turd)]
+    workers = min(len(tasks), workers or multiprocessing.cpu_count())
+    if workers <= 1:
+        return map(_trace, tasks)
+    pool = multiprocessing.Pool(workers)
+    try:
+        traced = pool.map(_trace, tasks)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return traced
+
+def svg_path(contours):
+    """
+    The path data of a list of contours.
+    """
+    subpaths = []
+    for contour in contours:
+        points = ["%.2f,%.2f" % (x, y) for (x, y) in contour.points]
+        subpaths.append("M%s L%sZ" % (points[0], str.join(' ', points[1:])))
+    return str.join(' ', subpaths)
+
+def save_svg(fn, resolution, layers, size=None):
+    """
+    Write an SVG of the traced layers, a list of (contours, attributes), one
+    group each, over resolution pixels.  The drawing is size inches, as
+    (width, height), as potrace's -W and -H took, or a point a pixel.
+    """
+    (width, height) = resolution
+    if size == None:
+        size = (width / 72.0, height / 72.0)
+    lines = ['<?xml version="1.0" standalone="no"?>']
+    lines.append('<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="%gin" height="%gin" viewBox="0 0 %d %d">' % (size[0], size[1], width, height))
+    for (contours, attributes) in layers:
+        attributes = str.join(' ', ['%s="%s"' % item for item in sorted(attributes.items())])
+        lines.append('<g %s>' % attributes)
+        if contours:
+            lines.append('<path fill-rule="evenodd" d="%s"/>' % svg_path(contours))
+        lines.append('</g>')
+    lines.append('</svg>')
+    f = open(fn, 'w')
+    try:
+        f.write(str.join('\n', lines) + '\n')
+    finally:
+        f.close()
@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+
+import os
+from sfgen import *
+
+if __name__ == "__main__":
+    cwd = os.getcwd()
+    if not os.path.exists(SERVER_DIR):
+        os.mkdir(SERVER_DIR)
+    try:
+        log_output(os.path.join(SERVER_DIR, "server"))
+        ss = SnowflakeServer()
+        ss.loop()
+    finally:
+        os.chdir(cwd)
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 
-import aws
 import sys
+from sfgen import *
 
-ss = aws.SnowflakeServices()
-job = aws.SnowflakeJob(sys.argv[1])
-ss.send_work(job)
+master = SnowflakeMaster()
+for name in sys.argv[1:]:
+    master.add_work(name)